@@ -1,15 +1,23 @@
 #!/bin/sh
 
-while true; do
-    MAYBE=$(ls /data | wc -l)
-    for ID in $(seq $MAYBE $((MAYBE + 10))); do
-        RESULT="/data/$(hostname)/$ID"
-        if mkdir "$RESULT" 2>/dev/null; then
-            echo "$RESULT *(rw,fsid=$ID,insecure,no_root_squash)" >> /etc/exports
-            echo "$RESULT"
-            exportfs -a 2>/dev/null
-            exit 0
-        fi
-    done
+# usage: allocate_share.sh <host> <cwd>
+# share ids come from a counter rather than from counting what's there, so allocating is O(1) however many shares
+# this replica holds. the mkdir is still the real claim, in case the counter got lost.
+mkdir -p /data/$(hostname) /data/.womm-shares
+exec 9>/data/.womm-share-counter.lock
+flock 9
+# fsid=0 means something special to NFSv4
+ID=$(cat /data/.womm-share-counter 2>/dev/null || echo 1)
+until mkdir "/data/$(hostname)/$ID" 2>/dev/null; do
+    ID=$((ID + 1))
 done
+echo $((ID + 1)) > /data/.womm-share-counter
 
+RESULT="/data/$(hostname)/$ID"
+echo "$1:$2" > /data/.womm-shares/$ID.owner
+touch /data/.womm-shares/$ID.used
+echo "$RESULT *(rw,fsid=$ID,insecure,no_root_squash)" >> /etc/exports
+# export just the new share rather than rereading the whole table
+exportfs -o rw,fsid=$ID,insecure,no_root_squash "*:$RESULT" >/dev/null 2>&1
+echo "$RESULT"
+exit 0
@@ -0,0 +1,40 @@
+#!/bin/sh
+
+# result cache maintenance. entries live in /data/womm-cache/<xx>/<key>/ and their mtime is the last time they were used.
+
+CACHE=${WOMM_CACHE:-/data/womm-cache}
+mkdir -p $CACHE
+cd $CACHE || exit 1
+
+entries() {
+    # <mtime> <entry> <kilobytes>, least recently used first
+    find . -mindepth 3 -type f -printf '%k %P\n' | awk '{ split($2, a, "/"); s[a[1] "/" a[2]] += $1 } END { for (k in s) print k, s[k] }' > /tmp/womm-cache-sizes
+    find . -mindepth 2 -maxdepth 2 -type d -printf '%T@ %P\n' | sort -n | awk 'NR==FNR { size[$1]=$2; next } { print $1, $2, size[$2]+0 }' /tmp/womm-cache-sizes -
+    rm -f /tmp/womm-cache-sizes
+}
+
+case "$1" in
+    touch)
+        # keys on stdin
+        sed 's:^\(..\):\1/\1:' | xargs -r touch -c
+        ;;
+    evict)
+        LIMIT_KB=$(( $2 / 1024 ))
+        entries | awk -v limit=$LIMIT_KB '{ order[NR]=$2; size[NR]=$3; total += $3 } END { for (i = 1; i <= NR && total > limit; i++) { print order[i]; total -= size[i] } }' | xargs -r rm -rf
+        ;;
+    stats)
+        entries | awk '{ n++; total += $3 } END { printf "%d %d\n", n, total * 1024 }'
+        ;;
+    list)
+        entries | while read -r T E K; do
+            printf '%s %s %s %s\n' "$T" "${E#*/}" "$((K * 1024))" "$(head -c 200 "$E/cmd" | head -n 1)"
+        done
+        ;;
+    clear)
+        find . -mindepth 1 -maxdepth 1 -exec rm -rf {} +
+        ;;
+    *)
+        echo "Usage: $0 touch|evict <bytes>|stats|list|clear" >&2
+        exit 1
+        ;;
+esac
@@ -81,6 +81,12 @@ touch /tmp/.womm-env
 
 start "$@"
 
+# evict idle shares when the disk fills up, and enforce share quotas
+while true; do
+    sleep ${WOMM_REAP_INTERVAL:-60}
+    /opt/womm/share.sh reap
+done &
+
 # Ugly hack to do nothing and wait for SIGTERM
 while true; do
     sleep 5
@@ -0,0 +1,159 @@
+#!/bin/sh
+
+# share bookkeeping. next to each share /data/<hostname>/<id> we keep, in $META:
+#   <id>.owner  "<host>:<cwd>" of the directory it belongs to
+#   <id>.used   touched when a session starts and every minute while a task runs
+#   <id>.kb     the share's size, as last measured
+#   <id>.ro     present while the share is over quota, and therefore exported read-only
+#   <id>.sub    "<path> <fsid>" for each lazily shared subdirectory mounted into the share
+
+ROOT=/data/$(hostname)
+META=/data/.womm-shares
+SHARE_QUOTA_KB=$(( ${WOMM_SHARE_QUOTA:-0} / 1024 ))
+DISK_QUOTA_KB=$(( ${WOMM_DISK_QUOTA:-0} / 1024 ))
+IDLE=${WOMM_SHARE_IDLE:-3600}
+# how long a measured size is good for. du walks the whole share, so we don't do it every pass.
+MEASURE=${WOMM_SHARE_MEASURE:-900}
+mkdir -p $ROOT $META
+
+share_dir() {
+    case "$1" in
+        $ROOT/*) [ -d "$1" ] && echo "${1%/}" ;;
+        *) return 1 ;;
+    esac
+}
+
+usage_kb() {
+    # -x: a lazy share is an sshfs mount of somebody's laptop, don't go walking it
+    du -skx "$1" 2>/dev/null | cut -f1
+}
+
+cached_kb() {
+    # $1's size, measured again once the last measurement is older than $MEASURE
+    F=$META/$(basename $1).kb
+    if [ ! -s $F ] || [ $(( $(date +%s) - $(stat -c %Y $F) )) -gt $MEASURE ]; then
+        usage_kb $1 > $F.new && mv $F.new $F
+    fi
+    cat $F
+}
+
+mounted() {
+    # whether anything is mounted at or below $1
+    awk -v d="$1" '$2 == d || index($2, d "/") == 1 { found = 1 } END { exit !found }' /proc/mounts
+}
+
+write_exports() {
+    # regenerate the exports in one go, and only reexport if they changed
+    for DIR in $ROOT/*; do
+        [ -d "$DIR" ] || continue
+        ID=$(basename $DIR)
+        MODE=rw
+        [ -e $META/$ID.ro ] && MODE=ro
+        if [ -s $META/$ID.sub ]; then
+            # crossmnt lets clients see the subdirectories mounted into the share, which are exported on their own
+            echo "$DIR *($MODE,fsid=$ID,crossmnt,insecure,no_root_squash)"
+            while read -r SUB FSID; do
+                mountpoint -q "$SUB" && echo "$SUB *($MODE,fsid=$FSID,insecure,no_root_squash)"
+            done < $META/$ID.sub
+        else
+            echo "$DIR *($MODE,fsid=$ID,insecure,no_root_squash)"
+        fi
+    done > /etc/exports.new
+    if cmp -s /etc/exports.new /etc/exports; then
+        rm -f /etc/exports.new
+    else
+        mv /etc/exports.new /etc/exports
+        exportfs -ra
+    fi
+}
+
+over_disk_quota() {
+    # $1 is the kilobytes used by all shares. without a quota, we go by how full the disk is.
+    if [ $DISK_QUOTA_KB -gt 0 ]; then
+        [ $1 -gt $DISK_QUOTA_KB ]
+    else
+        [ $(df -P /data | awk 'NR==2 { sub("%", "", $5); print $5 }') -gt 90 ]
+    fi
+}
+
+case "$1" in
+    touch)
+        DIR=$(share_dir "$2") || exit 1
+        touch $META/$(basename $DIR).used
+        ;;
+    info)
+        # <bytes used> <quota bytes> <last used> <read-only>
+        DIR=$(share_dir "$2") || exit 1
+        ID=$(basename $DIR)
+        echo $(( $(usage_kb $DIR) * 1024 )) ${WOMM_SHARE_QUOTA:-0} $(stat -c %Y $META/$ID.used 2>/dev/null || echo 0) \
+            $([ -e $META/$ID.ro ] && echo 1 || echo 0)
+        ;;
+    export)
+        # a subdirectory of a share which was just mounted over with sshfs. fuse mounts need an fsid to be exported.
+        SUB=${2%/}
+        DIR=$(share_dir "$(echo "$SUB" | cut -d/ -f1-4)") || exit 1
+        case "$SUB" in
+            $DIR/*) ;;
+            *) exit 1 ;;
+        esac
+        ID=$(basename $DIR)
+        for i in 1 2 3 4 5 6 7 8 9 10; do
+            mountpoint -q "$SUB" && break
+            sleep 1
+        done
+        mountpoint -q "$SUB" || exit 1
+        exec 9>/data/.womm-share-counter.lock
+        flock 9
+        FSID=$(cat /data/.womm-share-counter 2>/dev/null || echo 1)
+        echo $((FSID + 1)) > /data/.womm-share-counter
+        { grep -v "^$SUB " $META/$ID.sub 2>/dev/null; echo "$SUB $FSID"; } > $META/$ID.sub.new
+        mv $META/$ID.sub.new $META/$ID.sub
+        write_exports
+        ;;
+    reap)
+        NOW=$(date +%s)
+        TOTAL=0
+        # sizes only matter for the quotas, or once the disk is filling up
+        SIZES=0
+        if [ $SHARE_QUOTA_KB -gt 0 ] || [ $DISK_QUOTA_KB -gt 0 ] || over_disk_quota 0; then
+            SIZES=1
+        fi
+        : > /tmp/womm-reap
+        for DIR in $ROOT/*; do
+            [ -d "$DIR" ] || continue
+            ID=$(basename $DIR)
+            # shares from before we kept track start their clock now. mounted lazy shares are in use right now, and
+            # evicting one would go deleting files on the other end of the mount.
+            if [ ! -e $META/$ID.used ] || mounted $DIR; then
+                touch $META/$ID.used
+            fi
+            KB=0
+            [ $SIZES = 1 ] && KB=$(cached_kb $DIR)
+            if [ $SHARE_QUOTA_KB -gt 0 ] && [ $KB -gt $SHARE_QUOTA_KB ]; then
+                touch $META/$ID.ro
+            else
+                rm -f $META/$ID.ro
+            fi
+            echo "$(stat -c %Y $META/$ID.used) $DIR $KB" >> /tmp/womm-reap
+            TOTAL=$((TOTAL + KB))
+        done
+
+        # least recently used first, and never anything that was used recently enough that it might be in use
+        exec 9>/data/.womm-share-counter.lock
+        flock 9
+        sort -n /tmp/womm-reap | while read -r USED DIR KB; do
+            over_disk_quota $TOTAL || break
+            [ $((NOW - USED)) -gt $IDLE ] || break
+            echo "Evicting $DIR ($(cat $META/$(basename $DIR).owner 2>/dev/null), ${KB}K)"
+            rm -rf $DIR $META/$(basename $DIR).*
+            TOTAL=$((TOTAL - KB))
+        done
+        rm -f /tmp/womm-reap
+
+        write_exports
+        ;;
+    *)
+        echo "Usage: $0 touch <share>|info <share>|export <share subdirectory>|reap" >&2
+        exit 1
+        ;;
+esac
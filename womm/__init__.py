@@ -3,3 +3,4 @@ __version__ = '0.1.6'
 from . import common
 from . import setup
 from . import parallel
+from .api import Session, AsyncSession, Result
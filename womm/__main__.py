@@ -2,8 +2,18 @@ import sys
 import os
 
 from .setup import cmd_setup
-from .parallel import cmd_parallel, cmd_shell, cmd_leader, cmd_logs, cmd_finish, cmd_status
-from .common import basedir, prefix_path
+from .parallel import cmd_parallel, cmd_shell, cmd_leader, cmd_attach, cmd_logs, cmd_finish, cmd_status, \
+    cmd_resume
+from .cache import cmd_cache
+from .locality import cmd_route
+from .reap import cmd_reap
+from .top import cmd_top
+from .plan import cmd_plan
+from .pipeline import cmd_pipeline
+from .sharepolicy import cmd_share_profile
+from .metrics import cmd_metrics
+from .bench import cmd_bench_share, cmd_bench_local
+from .common import basedir, prefix_path, exec_pod, parse_size
 from . import __version__
 
 def cmd_ssh():
@@ -13,13 +23,45 @@ def cmd_ssh():
         cmd = ['bestsh']
     if cmd[0] == '--':
         cmd.pop(0)
-    cmdline = 'export SHELL=sh; . /tmp/.womm-env; ' + ' '.join(cmd)
-    flags = '-it' if sys.stdout.isatty() else '-i'
-    os.execlp('kubectl', 'kubectl', 'exec', flags, pod, '--', 'sh', '-c', cmdline)
+    exec_pod(pod, cmd)
+
+def usage_cluster_setup():
+    print("""\
+Usage: womm cluster-setup [options]
+
+Options:
+  --replicas N        Run N filesystem servers, and spread the shares across them (default 1)
+  --share-quota SIZE  Export shares which grow past SIZE read-only until they shrink again
+  --disk-quota SIZE   Evict idle shares, least recently used first, once a server holds more than
+                      SIZE of them (default: once its disk is 90% full)
+""")
+    sys.exit(1)
 
 def cmd_cluster_setup():
+    settings = {'--replicas': 1, '--share-quota': 0, '--disk-quota': 0}
+    iterable = iter(sys.argv[2:])
+    for opt in iterable:
+        name, _, value = opt.partition('=')
+        if name not in settings:
+            usage_cluster_setup()
+        if not value:
+            value = next(iterable, '')
+        if name == '--replicas':
+            if not value.isdigit() or int(value) < 1:
+                usage_cluster_setup()
+            settings[name] = int(value)
+        else:
+            settings[name] = parse_size(value, name)
+    replicas = settings['--replicas']
+
     with open(basedir / 'cluster-setup.yml', 'r', encoding='utf-8') as fp:
-        sys.stdout.write(fp.read().replace('$VERSION', __version__))
+        template = fp.read() \
+            .replace('$VERSION', __version__) \
+            .replace('$REPLICAS', str(replicas)) \
+            .replace('$SHARE_QUOTA', str(settings['--share-quota'])) \
+            .replace('$DISK_QUOTA', str(settings['--disk-quota']))
+    template, per_replica = template.split('# {{per replica}}\n')
+    sys.stdout.write(template + '---\n'.join(per_replica.replace('$REPLICA', str(i)) for i in range(replicas)))
 
 def cmd_clear_prefix():
     try:
@@ -41,14 +83,34 @@ def main():
         cmd_setup()
     elif cmd == 'status':
         cmd_status()
+    elif cmd == 'top':
+        cmd_top()
+    elif cmd == 'plan':
+        cmd_plan()
     elif cmd == 'parallel':
         cmd_parallel()
+    elif cmd == 'pipeline':
+        cmd_pipeline()
     elif cmd == 'shell':
         cmd_shell()
     elif cmd == 'logs':
         cmd_logs()
+    elif cmd == 'metrics':
+        cmd_metrics()
     elif cmd == 'finish':
         cmd_finish()
+    elif cmd == 'resume':
+        cmd_resume()
+    elif cmd == 'reap':
+        cmd_reap()
+    elif cmd == 'cache':
+        cmd_cache()
+    elif cmd == 'share-profile':
+        cmd_share_profile()
+    elif cmd == 'bench-share':
+        cmd_bench_share()
+    elif cmd == 'bench-local':
+        cmd_bench_local()
     elif cmd == 'cluster-setup':
         cmd_cluster_setup()
     elif cmd == 'clear-prefix':
@@ -56,18 +118,33 @@ def main():
     # it's a secret to everyone.
     elif cmd == 'ssh':
         cmd_ssh()
+    elif cmd == 'route':
+        cmd_route()
     elif cmd == 'leader':
         cmd_leader()
+    elif cmd == 'attach':
+        cmd_attach()
     else:
         print('Usage: womm [cmd] [parameters]')
         print()
         print('Commands:')
         print('  setup       configure an image for the current directory')
         print('  status      show status of running tasks')
+        print('  top         show how much cpu, memory and nfs bandwidth tasks are actually using')
+        print('  plan        predict how long a parallel run will take and what it will cost')
         print('  parallel    run tasks in parallel')
+        print('  pipeline    run several steps of parallel jobs on the same pods, each feeding the next')
         print('  shell       get a shell in your execution environment')
         print('  logs        follow logs for an async task')
+        print('  metrics     print prometheus metrics for a running task')
         print('  finish      clean up resources for an async task')
+        print('  resume      restart the leader of an async task from its last checkpoint')
+        print('  reap        tear down orphaned tasks, and async tasks which finished long ago')
+        print('  cache       inspect the results cache for `parallel --cache`')
+        print('  share-profile')
+        print('              show how much of the directory .wommshare shares eagerly, lazily or not at all')
+        print('  bench-share measure reads, writes and metadata operations on the share from the pods')
+        print('  bench-local measure what each job costs a --local-procs jobslot')
         print('  cluster-setup')
         print('              print the kubernetes yaml to prepare the cluster')
         print('  clear-prefix')
@@ -0,0 +1,127 @@
+# fair-share admission for the womm tasks in a namespace with a ResourceQuota.
+#
+# every task asks for some number of pods and gets its fair share of what the quota has room for. pods are handed out
+# one at a time to whichever task has the smallest share so far, counting whichever resource it uses the most of, the
+# older task first on a tie, and no task gets more than it asked for. there's no controller: whoever runs a task, its
+# client or its leader, works out the same allocation from the same annotations every so often and scales its own
+# deployment to its part of it, so tasks grow and shrink as others start and finish. a task which gets no pods at all
+# waits its turn, oldest first. without a quota, every task gets everything it asks for.
+import heapq
+import json
+
+from .common import *  # pylint: disable=wildcard-import,unused-wildcard-import
+
+interval = 30
+# what each kind of quota limits, per pod. the pods' limits are their requests.
+quota_resources = {
+    'pods': 'pods',
+    'count/pods': 'pods',
+    'cpu': 'cpu',
+    'requests.cpu': 'cpu',
+    'limits.cpu': 'cpu',
+    'memory': 'mem',
+    'requests.memory': 'mem',
+    'limits.memory': 'mem',
+}
+# the task pods, not the leaders, which are jobs
+task_pods = 'womm_task,!job-name'
+task_pods_template = '{range .items[*]}{.spec.containers[0].resources.requests.cpu}{"\\t"}' \
+    '{.spec.containers[0].resources.requests.memory}{"\\n"}{end}'
+# what an async task's leader pod asks for, as in leader-job.yml. a leader which has yet to be let in by the quota is
+# kept room for before the task pods get any, since without it nobody would ever scale the task up.
+leader_cpu = '10m'
+leader_mem = '64Mi'
+
+def headroom():
+    # {resource: what's left of it} under the tightest quota, or None if nothing we use is limited
+    r = subprocess.run(
+        ['kubectl', 'get', 'resourcequota', '-o', 'json'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+    if r.returncode != 0:
+        return None
+    left = {}
+    for quota in json.loads(r.stdout.decode())['items']:
+        status = quota.get('status', {})
+        used = status.get('used', {})
+        for key, hard in status.get('hard', {}).items():
+            resource = quota_resources.get(key)
+            if resource is not None:
+                value = parse_quantity(hard) - parse_quantity(used.get(key, '0'))
+                left[resource] = min(left.get(resource, value), value)
+    return left or None
+
+def task_usage():
+    # what the tasks' pods have between them, which the quota counts as used
+    output = subprocess.run(
+        ['kubectl', 'get', 'pods', '-l', task_pods, '-o', 'jsonpath', '--template', task_pods_template],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    ).stdout.decode()
+    usage = {'pods': 0, 'cpu': 0., 'mem': 0.}
+    for line in output.splitlines():
+        cpu, _, mem = line.partition('\t')
+        usage['pods'] += 1
+        usage['cpu'] += parse_quantity(cpu or '0')
+        usage['mem'] += parse_quantity(mem or '0')
+    return usage
+
+def capacity():
+    # {resource: how much the tasks can have between them}, or None without a quota
+    left = headroom()
+    if left is None:
+        return None
+    usage = task_usage()
+    return {resource: value + usage[resource] for resource, value in left.items()}
+
+def pod_cost(cpu, mem):
+    return {'pods': 1, 'cpu': parse_quantity(cpu or '0'), 'mem': parse_quantity(mem or '0')}
+
+def allocate(tasks, capacity_):
+    # {task id: (pods asked for, pod_cost, creation timestamp)} -> {task id: pods granted}
+    left = dict(capacity_)
+    granted = {task_id: 0 for task_id in tasks}
+    heap = [(0., created, task_id) for task_id, (_, _, created) in tasks.items()]
+    heapq.heapify(heap)
+    while heap:
+        _, created, task_id = heapq.heappop(heap)
+        wanted, cost, _ = tasks[task_id]
+        if granted[task_id] >= wanted or any(cost[resource] > left[resource] for resource in left):
+            # it has all it wants, or all it can get
+            continue
+        for resource in left:
+            left[resource] -= cost[resource]
+        granted[task_id] += 1
+        share = max(
+            [granted[task_id] * cost[resource] / capacity_[resource] for resource in capacity_ if capacity_[resource]]
+            + [0.]
+        )
+        heapq.heappush(heap, (share, created, task_id))
+    return granted
+
+def shares(results, capacity_, new=None):
+    # {task id: pods granted} for every task whose deployment is up, from get_status. new is (task id, pods asked
+    # for, cpu, mem, async) of a task which is about to be created.
+    leaders = sum(1 for data in results.values() if data.async_ and data.requested_instances and not data.leader_pods)
+    tasks = {
+        task_id: (data.requested_instances, pod_cost(data.cpu, data.mem), data.created_time.timestamp())
+        for task_id, data in results.items()
+        if data.requested_instances
+    }
+    if new is not None:
+        task_id, requested, cpu, mem, async_ = new
+        tasks[task_id] = (requested, pod_cost(cpu, mem), time.time())
+        leaders += async_
+    leader = pod_cost(leader_cpu, leader_mem)
+    return allocate(tasks, {resource: value - leaders * leader[resource] for resource, value in capacity_.items()})
+
+def queue_positions(results):
+    # {task id: place in line} for the tasks waiting for their first pod
+    waiting = sorted(
+        (data.created_time, task_id) for task_id, data in results.items()
+        if data.requested_instances and not data.granted_instances
+    )
+    return {task_id: i + 1 for i, (_, task_id) in enumerate(waiting)}
@@ -0,0 +1,236 @@
+# a python api for programs which would otherwise run `womm parallel` over and over. a Session keeps one task
+# deployment up for as long as it's open and hands each command it's given to the next free jobslot, the same way
+# parallel would with the sshloginfile, so only the first command waits for the pods.
+#
+#   with womm.Session(kube_pods=20, procs_per_pod=2) as session:
+#       for result in session.map('./analyze {}', inputs):
+#           print(result.pod, result.returncode, result.stdout)
+#
+# it runs from the current directory, which has to have been through `womm setup`, like the command line.
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import ExitStack
+from collections import namedtuple, deque
+import threading
+import asyncio
+import shlex
+
+from .common import *  # pylint: disable=wildcard-import,unused-wildcard-import
+from .parallel import womm_session
+
+class Result(namedtuple('Result', ['command', 'returncode', 'stdout', 'stderr', 'pod', 'start', 'end'])):
+    __slots__ = ()
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+def expand(template, item):
+    # {} is the whole item and {1}, {2}... are the parts of a tuple, quoted for the shell, as with parallel. a template
+    # with neither gets the item on the end.
+    args = item if isinstance(item, tuple) else (item,)
+    quoted = [shlex.quote(str(arg)) for arg in args]
+    if not re.search(r'\{\d*\}', template):
+        template += ' {}'
+    return re.sub(r'\{(\d*)\}', lambda m: quoted[int(m.group(1)) - 1] if m.group(1) else ' '.join(quoted), template)
+
+class Slots:
+    # the jobslots on the pods which are running. a pod which stops running takes its jobslots with it, including the
+    # ones in use, and if it comes back it gets a new generation so that those can't be given back twice.
+    def __init__(self, procs_per_pod):
+        self.procs_per_pod = procs_per_pod
+        self.cond = threading.Condition()
+        self.free = deque()
+        self.live = {}
+        self.generation = 0
+        self.closed = False
+
+    def update(self, live):
+        with self.cond:
+            for pod in live:
+                if pod not in self.live:
+                    self.generation += 1
+                    self.live[pod] = self.generation
+                    self.free.extend([(pod, self.generation)] * self.procs_per_pod)
+            for pod in list(self.live):
+                if pod not in live:
+                    del self.live[pod]
+            self.cond.notify_all()
+
+    def take(self):
+        with self.cond:
+            while not self.closed:
+                while self.free:
+                    slot = self.free.popleft()
+                    if self.live.get(slot[0]) == slot[1]:
+                        return slot
+                self.cond.wait()
+            return None
+
+    def give(self, slot):
+        # returns whether the pod is still there
+        with self.cond:
+            if self.live.get(slot[0]) != slot[1]:
+                return False
+            self.free.append(slot)
+            self.cond.notify()
+            return True
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class Session:
+    def __init__(self, kube_pods=1, procs_per_pod=1, kube_cpu='1000m', kube_mem='512Mi', text=True, retries=2):
+        self.kube_pods = kube_pods
+        self.procs_per_pod = procs_per_pod
+        self.kube_cpu = kube_cpu
+        self.kube_mem = kube_mem
+        self.text = text
+        # how many times to run a command again when its pod went away under it
+        self.retries = retries
+        self.slots = Slots(procs_per_pod)
+        self.pool = None
+        self.stack = None
+        self.outstanding = set()
+        self.lock = threading.Lock()
+
+    @property
+    def window(self):
+        # how far map gets ahead of the results it has handed back
+        return 2 * self.kube_pods * self.procs_per_pod
+
+    def __enter__(self):
+        cfg = cfg_load()
+        if cfg is None:
+            raise RuntimeError('please run `womm setup` to initialize %s' % cwd)
+        connection_test()
+
+        def login_lines(live):
+            self.slots.update(live)
+            return [f'{self.procs_per_pod}/{sys.executable} -m womm ssh {pod}' for pod in live]
+
+        self.stack = ExitStack()
+        self.stack.enter_context(womm_session(
+            cfg,
+            self.kube_mem,
+            self.kube_cpu,
+            [],
+            self.kube_pods,
+            self.procs_per_pod,
+            ['api', os.path.basename(sys.argv[0]) or 'python'],
+            login_lines,
+        ))
+        # every worker holds at most one jobslot, so there's no use in more of them
+        self.pool = ThreadPoolExecutor(max_workers=self.kube_pods * self.procs_per_pod)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if exc_type is not None:
+                with self.lock:
+                    outstanding = list(self.outstanding)
+                for future in outstanding:
+                    future.cancel()
+            self.pool.shutdown(wait=True)
+        finally:
+            self.slots.close()
+            self.stack.close()
+
+    def run(self, cmdline):
+        attempt = 0
+        while True:
+            slot = self.slots.take()
+            if slot is None:
+                raise RuntimeError('the session is closed')
+            start = time.time()
+            r = subprocess.run(
+                pod_command(slot[0], cmdline),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=self.text,
+                check=False,
+            )
+            end = time.time()
+            if self.slots.give(slot) or r.returncode == 0 or attempt == self.retries:
+                return Result(cmdline, r.returncode, r.stdout, r.stderr, slot[0], start, end)
+            attempt += 1
+
+    def submit(self, cmd):
+        # cmd is a shell command line, or a list of arguments to quote into one
+        if not isinstance(cmd, str):
+            cmd = ' '.join(shlex.quote(str(arg)) for arg in cmd)
+        future = self.pool.submit(self.run, cmd)
+        with self.lock:
+            self.outstanding.add(future)
+        future.add_done_callback(self.forget)
+        return future
+
+    def forget(self, future):
+        with self.lock:
+            self.outstanding.discard(future)
+
+    def map(self, template, iterable, ordered=True):
+        # results as they come, in the order of iterable unless ordered is False. iterable is only read as far as
+        # there are jobslots to keep busy, so it can be endless.
+        pending = deque() if ordered else set()
+        for item in iterable:
+            future = self.submit(expand(template, item))
+            if ordered:
+                pending.append(future)
+            else:
+                pending.add(future)
+            while len(pending) >= self.window:
+                yield from self.next_results(pending, ordered)
+        while pending:
+            yield from self.next_results(pending, ordered)
+
+    @staticmethod
+    def next_results(pending, ordered):
+        if ordered:
+            yield pending.popleft().result()
+            return
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.discard(future)
+            yield future.result()
+
+class AsyncSession:
+    # Session for asyncio. submit is a coroutine, map an async generator.
+    def __init__(self, **kwargs):
+        self.session = Session(**kwargs)
+
+    async def __aenter__(self):
+        await asyncio.get_event_loop().run_in_executor(None, self.session.__enter__)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        await asyncio.get_event_loop().run_in_executor(None, self.session.__exit__, exc_type, exc_value, tb)
+
+    async def submit(self, cmd):
+        return await asyncio.wrap_future(self.session.submit(cmd))
+
+    async def map(self, template, iterable, ordered=True):
+        pending = deque() if ordered else set()
+        for item in iterable:
+            future = asyncio.wrap_future(self.session.submit(expand(template, item)))
+            if ordered:
+                pending.append(future)
+            else:
+                pending.add(future)
+            while len(pending) >= self.session.window:
+                for result in await self.next_results(pending, ordered):
+                    yield result
+        while pending:
+            for result in await self.next_results(pending, ordered):
+                yield result
+
+    @staticmethod
+    async def next_results(pending, ordered):
+        if ordered:
+            return [await pending.popleft()]
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for future in done:
+            pending.discard(future)
+        return [future.result() for future in done]
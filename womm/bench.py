@@ -0,0 +1,269 @@
+# `womm bench-share`: how the share holds up from the pods, under each nfs mount profile.
+#
+# every pod first writes a big file and a directory of small ones into .womm-bench in the share. then every pod reads
+# what the next pod wrote, so that nothing comes out of its own cache: the big file with direct io, then each small file
+# is looked up, opened, and opened again. opening again is where attribute caching and nocto show, since by default
+# every open asks the server whether the file changed. all the timing happens in the pods, which run together, so the
+# rates are for the whole set of pods.
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import threading
+import tempfile
+import shlex
+
+from tabulate import tabulate
+
+from .common import *  # pylint: disable=wildcard-import,unused-wildcard-import
+from .parallel import womm_session, int_arg, next_arg, fmt_seconds
+from . import localpool
+
+bench_dirname = '.womm-bench'
+default_pods = 4
+default_size = '256Mi'
+default_files = 2000
+default_local_procs = 4
+default_local_jobs = 200
+# how long to wait for all the pods, which might not all fit in the namespace's quota
+pods_timeout = 600
+
+write_script = '''\
+now() {{ date +%s.%N; }}
+d={dir}
+rm -rf "$d" && mkdir -p "$d/files" && cd "$d" || exit 1
+t0=$(now)
+dd if=/dev/zero of=data bs=1M count={mb} conv=fsync 2>/dev/null || exit 1
+t1=$(now)
+cd files || exit 1
+i=0; while [ $i -lt {files} ]; do echo $i > $i || exit 1; i=$((i+1)); done
+t2=$(now)
+echo $t0 $t1 $t2
+'''
+
+read_script = '''\
+now() {{ date +%s.%N; }}
+cd {dir} || exit 1
+t0=$(now)
+dd if=data of=/dev/null bs=1M iflag=direct 2>/dev/null || exit 1
+t1=$(now)
+cd files || exit 1
+i=0; while [ $i -lt {files} ]; do [ -e $i ] || exit 1; i=$((i+1)); done
+t2=$(now)
+i=0; while [ $i -lt {files} ]; do read x < $i || exit 1; i=$((i+1)); done
+t3=$(now)
+i=0; while [ $i -lt {files} ]; do read x < $i || exit 1; i=$((i+1)); done
+t4=$(now)
+echo $t0 $t1 $t2 $t3 $t4
+'''
+
+clean_script = '''\
+rm -rf {dir}
+rmdir {parent} 2>/dev/null
+true
+'''
+
+def usage_bench():
+    print("""\
+Usage: womm bench-share [options]
+
+Measure reads, writes and metadata operations against the share from several pods at once, with
+each nfs mount profile, to help choose a --nfs-profile for womm parallel.
+
+Options:
+  --kube-pods N       Benchmark from N pods at once (default 4)
+  --nfs-profile P     Benchmark the profile P, or a comma-separated list of mount options. Can be
+                      given more than once (default: every profile)
+  --size N            Write and read N bytes per pod (default 256Mi)
+  --files N           Create, look up and open N small files per pod (default 2000)
+  --kube-cpu N        Reserve N cpus per pod (default 1)
+  --kube-mem N        Reserve N memory per pod (default 512Mi)
+  --help              Show this message :)
+""")
+    sys.exit(0)
+
+def run_scripts(scripts):
+    # {pod: script} -> {pod: the numbers it printed}
+    def run(item):
+        pod, script = item
+        r = subprocess.run(
+            pod_command(pod, script),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=False,
+        )
+        try:
+            if r.returncode != 0:
+                raise ValueError
+            return pod, [float(x) for x in r.stdout.decode().split()]
+        except ValueError:
+            print('The benchmark failed in %s: %s' % (pod, r.stderr.decode(errors='replace').strip()))
+            sys.exit(1)
+
+    with ThreadPoolExecutor(max_workers=32) as pool:
+        return dict(pool.map(run, scripts.items()))
+
+def rate(amount, times, i):
+    # amount per second for each pod between its ith and i+1th timestamps, summed over the pods
+    return sum(amount / max(t[i + 1] - t[i], 1e-6) for t in times.values())
+
+def bench(cfg, name, options, pods, cpu, mem, size, files):
+    live_pods = set()
+    all_live = threading.Event()
+
+    def login_lines(live):
+        live_pods.clear()
+        live_pods.update(live)
+        if len(live) >= pods:
+            all_live.set()
+        return [f'1/{sys.executable} -m womm ssh {pod}' for pod in live]
+
+    with womm_session(cfg, mem, cpu, [], pods, 1, ['bench-share', name], login_lines, mount_options=options):
+        print('womm: %s: waiting for all %d pods' % (name, pods), file=sys.stderr)
+        if not all_live.wait(pods_timeout):
+            print('Only %d of the %d pods came up within %s. If other tasks share the quota, see `womm status -A`, '
+                  'or try fewer --kube-pods.' % (len(live_pods), pods, fmt_seconds(pods_timeout)))
+            sys.exit(1)
+        names = sorted(live_pods)[:pods]
+        # the share is mounted where the directory is
+        dirs = {pod: '%s/%s/%s' % (cwd, bench_dirname, pod) for pod in names}
+        mb = max(1, size // 1024**2)
+
+        print('womm: %s: writing' % name, file=sys.stderr)
+        written = run_scripts({
+            pod: write_script.format(dir=shlex.quote(dirs[pod]), mb=mb, files=files) for pod in names
+        })
+        print('womm: %s: reading' % name, file=sys.stderr)
+        # everyone reads the next pod's files
+        read = run_scripts({
+            pod: read_script.format(dir=shlex.quote(dirs[names[(i + 1) % len(names)]]), files=files)
+            for i, pod in enumerate(names)
+        })
+        run_scripts({
+            pod: clean_script.format(dir=shlex.quote(dirs[pod]), parent=shlex.quote(cwd + '/' + bench_dirname))
+            for pod in names
+        })
+
+    return [
+        name,
+        format_size(rate(mb * 1024**2, written, 0)) + '/s',
+        format_size(rate(mb * 1024**2, read, 0)) + '/s',
+        '%d' % rate(files, written, 1),
+        '%d' % rate(files, read, 1),
+        '%d' % rate(files, read, 2),
+        '%d' % rate(files, read, 3),
+    ]
+
+def cmd_bench_share():
+    pods = default_pods
+    profiles = []
+    size = parse_size(default_size, '--size')
+    files = default_files
+    cpu = '1000m'
+    mem = '512Mi'
+
+    iterable = iter(sys.argv[2:])
+    for opt in iterable:
+        name, eq, value = opt.partition('=')
+        if opt in ('--help', '-h', '-?') or name not in (
+            '--kube-pods', '--nfs-profile', '--size', '--files', '--kube-cpu', '--kube-mem'
+        ):
+            usage_bench()
+        if not eq:
+            value = next_arg(iterable, name)
+        if name == '--kube-pods':
+            pods = max(1, int_arg(value, name))
+        elif name == '--nfs-profile':
+            profiles.append((value, nfs_options(value, name)))
+        elif name == '--size':
+            size = parse_size(value, name)
+        elif name == '--files':
+            files = max(1, int_arg(value, name))
+        elif name == '--kube-cpu':
+            cpu = value
+        elif name == '--kube-mem':
+            mem = value
+
+    cfg = cfg_load()
+    if cfg is None:
+        print("Error: please run `womm setup` to initialize the current directory")
+        sys.exit(1)
+    if cfg['share_kind'] == 'none':
+        print("This directory isn't shared, so there's nothing to benchmark.")
+        sys.exit(1)
+    connection_test()
+
+    if not profiles:
+        profiles = list(nfs_profiles.items())
+    for _, options in profiles:
+        check_mount_options(cfg, options)
+    output = [bench(cfg, name, options, pods, cpu, mem, size, files) for name, options in profiles]
+    print('%d pods, each writing and reading %s and %d small files' % (pods, format_size(size), files))
+    print(tabulate(
+        output,
+        headers=['PROFILE', 'WRITE', 'READ', 'CREATE/S', 'LOOKUP/S', 'OPEN/S', 'REOPEN/S'],
+        disable_numparse=True,
+    ))
+
+def usage_bench_local():
+    print("""\
+Usage: womm bench-local [options]
+
+Measure what each job costs a --local-procs jobslot, running no-op jobs on the bare machine and in the
+local containers.
+
+Options:
+  --local-procs N     Use N local jobslots (default 4)
+  --jobs N            Run N jobs each way (default 200)
+  --help              Show this message :)
+""")
+    sys.exit(0)
+
+@contextmanager
+def bare_slots(procs):
+    yield ['%d/:' % procs]
+
+def cmd_bench_local():
+    procs = default_local_procs
+    jobs = default_local_jobs
+
+    iterable = iter(sys.argv[2:])
+    for opt in iterable:
+        name, eq, value = opt.partition('=')
+        if opt in ('--help', '-h', '-?') or name not in ('--local-procs', '--jobs'):
+            usage_bench_local()
+        if not eq:
+            value = next_arg(iterable, name)
+        if name == '--local-procs':
+            procs = max(1, int_arg(value, name))
+        elif name == '--jobs':
+            jobs = max(1, int_arg(value, name))
+
+    cfg = cfg_load()
+    if cfg is None:
+        print("Error: please run `womm setup` to initialize the current directory")
+        sys.exit(1)
+
+    output = []
+    for name, slots in (('bare', bare_slots(procs)), ('container', localpool.local_pool(cfg, procs))):
+        start = time.time()
+        with slots as lines, tempfile.NamedTemporaryFile('w', encoding='utf-8') as fp:
+            started = time.time()
+            fp.write(''.join(line + '\n' for line in lines))
+            fp.flush()
+            subprocess.run(
+                [str(basedir / 'parallel'), '--sshloginfile', fp.name, 'true', ':::'] + [str(i) for i in range(jobs)],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                check=True,
+            )
+            wall = time.time() - started
+        # each jobslot runs its share of the jobs one after the other, so this is what one job costs it
+        output.append([
+            name,
+            '%.1fs' % (started - start),
+            '%dms' % round(1000 * wall * procs / jobs),
+            '%.1f' % (jobs / wall),
+        ])
+
+    print('%d jobs on %d local jobslots' % (jobs, procs))
+    print(tabulate(output, headers=['SLOTS', 'STARTUP', 'PER JOB', 'JOBS/S'], disable_numparse=True))
@@ -0,0 +1,244 @@
+# result memoization for `womm parallel --cache`.
+#
+# a job's key is a hash of its fully expanded command line, the contents of any files in the share it mentions, and
+# the digest of the image it runs in. entries are stored on the first fs-server replica under /data/womm-cache and
+# moved around with rsync, the same way eager shares are.
+from datetime import datetime, timezone
+import tempfile
+import hashlib
+import shlex
+import json
+import csv
+
+from tabulate import tabulate
+
+from .common import *  # pylint: disable=wildcard-import,unused-wildcard-import
+
+cache_root = '/data/womm-cache'
+default_cache_size = 1024**3
+
+# options which we are willing to pass through to the parallel which dispatches the cache misses. anything else only
+# affects how the command lines are generated, which has already happened by then.
+passthrough_flags = {'-k', '--keep-order', '--group', '--ungroup', '-u', '--line-buffer', '--lb'}
+passthrough_args = {'-j', '--jobs', '--retries', '--timeout', '--halt', '--halt-on-error', '--delay'}
+
+def image_digest(image):
+    r = subprocess.run(
+        ['docker', 'image', 'inspect', '-f', '{{json .RepoDigests}} {{.Id}}', image],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+    if r.returncode == 0:
+        digests, image_id = r.stdout.decode().strip().rsplit(' ', 1)
+        repo = image.rsplit(':', 1)[0]
+        for digest in json.loads(digests) or []:
+            if digest.split('@')[0] == repo:
+                return digest.split('@')[1]
+        return image_id
+
+    r = subprocess.run(
+        ['docker', 'manifest', 'inspect', image],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+    if r.returncode == 0:
+        return json.loads(r.stdout.decode())['config']['digest']
+
+    print("Warning: could not find a digest for %s. Cache entries will be keyed on its name." % image, file=sys.stderr)
+    return image
+
+def file_hash(path, memo):
+    real = os.path.realpath(path)
+    if real not in memo:
+        h = hashlib.sha256()
+        with open(real, 'rb') as fp:
+            while True:
+                data = fp.read(1024 * 1024)
+                if not data:
+                    break
+                h.update(data)
+        memo[real] = h.hexdigest()
+    return memo[real]
+
+def referenced_files(cmdline):
+    try:
+        tokens = shlex.split(cmdline)
+    except ValueError:
+        tokens = cmdline.split()
+    result = set()
+    for token in tokens:
+        for candidate in (token, token.split('=', 1)[-1]):
+            real = os.path.realpath(candidate)
+            if (real == cwd or real.startswith(cwd + '/')) and os.path.isfile(real):
+                result.add(os.path.relpath(real, cwd))
+    return sorted(result)
+
+def job_key(cmdline, digest, share_kind, memo):
+    files = [] if share_kind == 'none' else referenced_files(cmdline)
+    blob = json.dumps([cmdline, digest, [(f, file_hash(f, memo)) for f in files]])
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+def entry_path(key):
+    return '%s/%s' % (key[:2], key)
+
+def dispatch_opts(opts):
+    result = []
+    iterable = iter(opts)
+    for opt in iterable:
+        name = opt.split('=', 1)[0]
+        if opt in passthrough_flags:
+            result.append(opt)
+        elif name in passthrough_args:
+            result.append(opt)
+            if '=' not in opt:
+                result.append(next(iterable, ''))
+    return result
+
+def rsync_cmd():
+    return ['rsync', '-e', '%s -m womm ssh %s' % (sys.executable, server_ref())]
+
+def server_cache_cmd(args, input_=None, stdout=None):
+    return subprocess.run(
+        ['kubectl', 'exec', '-i', server_ref(), '--', '/opt/womm/cache.sh'] + args,
+        input=input_,
+        stdin=None if input_ is not None else subprocess.DEVNULL,
+        stdout=stdout,
+        check=True,
+    )
+
+def run_parallel(cfg, parallel_opts, cache_size, session):
+    opts, rest = split_opts(parallel_opts)
+    if any(opt.split('=', 1)[0] in ('--pipe', '--pipepart', '--joblog', '--results') for opt in opts):
+        print('--cache cannot be used with --pipe, --pipepart, --joblog or --results.')
+        sys.exit(1)
+
+    with tempfile.TemporaryDirectory(prefix='womm-cache-') as tmp:
+        tmp = Path(tmp)
+        stdin_path = spool_stdin(tmp / 'stdin')
+        cmdlines = expand_cmdlines(opts, rest, stdin_path)
+
+        digest = image_digest(cfg['image'])
+        memo = {}
+        keys = [job_key(cmdline, digest, cfg['share_kind'], memo) for cmdline in cmdlines]
+
+        # grab whatever we already have
+        fetched = tmp / 'fetched'
+        fetched.mkdir()
+        (tmp / 'wanted').write_text(''.join(entry_path(key) + '/\n' for key in set(keys)))
+        subprocess.run(
+            rsync_cmd() + [
+                '-aqr',
+                '--ignore-missing-args',
+                '--files-from', str(tmp / 'wanted'),
+                ':' + cache_root + '/',
+                str(fetched) + '/',
+            ],
+            check=True,
+        )
+
+        failures = 0
+        gave_up = None
+        hits = set()
+        misses = []
+        for cmdline, key in zip(cmdlines, keys):
+            entry = fetched / entry_path(key)
+            if not (entry / 'status').exists():
+                misses.append((cmdline, key))
+                continue
+            hits.add(key)
+            sys.stdout.buffer.write((entry / 'stdout').read_bytes())
+            sys.stdout.flush()
+            sys.stderr.buffer.write((entry / 'stderr').read_bytes())
+            sys.stderr.flush()
+            if int((entry / 'status').read_text()) != 0:
+                failures += 1
+
+        print('womm: %d of %d jobs replayed from cache' % (len(cmdlines) - len(misses), len(cmdlines)),
+              file=sys.stderr)
+
+        if misses:
+            (tmp / 'misses').write_text(''.join(cmdline + '\n' for cmdline, _ in misses))
+            results = tmp / 'results'
+            joblog = tmp / 'joblog'
+            with session() as sshloginfile, open(tmp / 'misses', 'rb') as fp:
+                p = subprocess.run(
+                    [
+                        str(basedir / 'parallel'),
+                        '--sshloginfile', sshloginfile,
+                        '--joblog', str(joblog),
+                        '--results', str(results) + '/{#}/',
+                    ] + dispatch_opts(opts),
+                    stdin=fp,
+                    check=False,
+                )
+
+            store = tmp / 'store'
+            if not joblog.exists():
+                # parallel gave up before running any jobs, e.g. on bad options, and has said why. its exit status
+                # is the one that matters.
+                gave_up = p.returncode or 1
+            with open(joblog if joblog.exists() else os.devnull, 'r', encoding='utf-8', newline='') as fp:
+                for row in csv.DictReader(fp, delimiter='\t'):
+                    seq = int(row['Seq'])
+                    status = int(row['Exitval'])
+                    if status != 0:
+                        failures += 1
+                    if status < 0 or int(row['Signal']) != 0:
+                        # timed out or killed. not a result, don't remember it.
+                        continue
+                    cmdline, key = misses[seq - 1]
+                    entry = store / entry_path(key)
+                    entry.mkdir(parents=True, exist_ok=True)
+                    for stream in ('stdout', 'stderr'):
+                        try:
+                            os.rename(results / str(seq) / stream, entry / stream)
+                        except FileNotFoundError:
+                            (entry / stream).write_bytes(b'')
+                    (entry / 'cmd').write_text(cmdline + '\n')
+                    (entry / 'status').write_text('%d\n' % status)
+
+            if store.exists():
+                subprocess.run(rsync_cmd() + ['-aq', str(store) + '/', ':' + cache_root + '/'], check=True)
+
+        if hits:
+            server_cache_cmd(['touch'], input_=''.join(key + '\n' for key in hits).encode())
+        server_cache_cmd(['evict', str(cache_size)])
+
+    return gave_up or min(failures, 101)
+
+def usage_cache():
+    print("""\
+Usage: womm cache [command]
+
+Commands:
+  stats               Show the number and total size of cached results (default)
+  list                Show every cached result, least recently used first
+  evict SIZE          Evict least recently used results until the cache is at most SIZE bytes
+  clear               Throw away every cached result
+""")
+    sys.exit(0)
+
+def cmd_cache():
+    args = sys.argv[2:] or ['stats']
+    if args[0] in ('--help', '-h', '-?'):
+        usage_cache()
+
+    connection_test()
+    if args[0] == 'stats':
+        count, size = server_cache_cmd(['stats'], stdout=subprocess.PIPE).stdout.decode().split()
+        print('%s results, %s' % (count, format_size(int(size))))
+    elif args[0] == 'list':
+        output = []
+        for line in server_cache_cmd(['list'], stdout=subprocess.PIPE).stdout.decode().splitlines():
+            mtime, key, size, cmdline = (line.split(' ', 3) + [''])[:4]
+            used = datetime.fromtimestamp(float(mtime), timezone.utc).astimezone().strftime('%Y-%m-%d %H:%M')
+            output.append([key[:12], used, format_size(int(size)), cmdline])
+        print(tabulate(output, headers=['KEY', 'LAST USED', 'SIZE', 'COMMAND']))
+    elif args[0] == 'evict' and len(args) == 2:
+        server_cache_cmd(['evict', str(parse_size(args[1], 'evict'))])
+    elif args[0] == 'clear':
+        server_cache_cmd(['clear'])
+    else:
+        usage_cache()
@@ -0,0 +1,132 @@
+# what changed in a container, for deciding whether it's worth a `docker commit` and `docker push`.
+#
+# docker diff lists every changed path along with each of its parent directories, which after an apt or pip install
+# is hundreds of thousands of lines. they go into a trie so that everything after is linear in the size of the diff.
+from tabulate import tabulate
+
+from .common import *  # pylint: disable=wildcard-import,unused-wildcard-import
+
+# shell history is written by every session, and is no reason to commit one
+history_patterns = [
+    r'/\.(bash|ash|sh|zsh|python)_history$',
+    r'/\.lesshst$',
+    r'/\.viminfo$',
+]
+# `womm shell --local` additionally ignores the environment, which only `womm setup` means to save
+shell_patterns = history_patterns + [r'^/tmp/\.womm-env$']
+
+class Node:
+    __slots__ = ('children', 'kind', 'size', 'files')
+
+    def __init__(self):
+        self.children = {}
+        self.kind = None
+        self.size = 0
+        self.files = 0
+
+def parse_diff(output):
+    root = Node()
+    for line in output.splitlines():
+        kind, _, path = line.partition(' ')
+        node = root
+        for part in path.strip('/').split('/'):
+            child = node.children.get(part)
+            if child is None:
+                child = node.children[part] = Node()
+            node = child
+        node.kind = kind
+    return root
+
+def container_diff(container):
+    r = subprocess.run(
+        ['docker', 'diff', container],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=False,
+    )
+    if r.returncode != 0:
+        print(r.stderr.decode(errors='replace').strip())
+        sys.exit(1)
+    return parse_diff(os.fsdecode(r.stdout))
+
+def prune(root, patterns):
+    # drops the changes matching any of the patterns, along with the directories which are only listed because of
+    # them. returns whether anything is left.
+    return prune_node(root, re.compile('|'.join(patterns)), '')
+
+def prune_node(node, regex, path):
+    if path and regex.search(path):
+        return False
+    listed_children = bool(node.children)
+    for name, child in list(node.children.items()):
+        if not prune_node(child, regex, path + '/' + name):
+            del node.children[name]
+    if node.children:
+        return True
+    # a changed directory with nothing changed inside it had its own metadata changed
+    return node.kind is not None and (node.kind != 'C' or not listed_children)
+
+def upper_dir(container):
+    r = subprocess.run(
+        ['docker', 'container', 'inspect', '-f', '{{.GraphDriver.Data.UpperDir}}', container],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+    path = r.stdout.decode().strip()
+    if r.returncode != 0 or not path or path == '<no value>' or not os.access(path, os.R_OK | os.X_OK):
+        return None
+    return path
+
+def measure(root, container):
+    # fills in the size and file count of every node from the container's writable layer, and returns the total size.
+    # the layer usually belongs to root, in which case all we can get out of docker is the total.
+    upper = upper_dir(container)
+    if upper is None:
+        r = subprocess.run(
+            ['docker', 'container', 'inspect', '--size', '-f', '{{.SizeRw}}', container],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=False,
+        )
+        output = r.stdout.decode().strip()
+        return int(output) if r.returncode == 0 and output.isdigit() else None
+
+    stack = [(root, upper, False)]
+    while stack:
+        node, path, done = stack.pop()
+        if done:
+            for child in node.children.values():
+                node.size += child.size
+                node.files += child.files
+        elif node.children:
+            stack.append((node, path, True))
+            stack.extend((child, path + '/' + name, False) for name, child in node.children.items())
+        elif node.kind != 'D':
+            try:
+                node.size = os.lstat(path).st_size
+            except OSError:
+                pass
+            node.files = 1
+    return root.size
+
+def breakdown(root, depth=3, limit=10):
+    # the biggest changed directories, no deeper than depth unless there's only one way down
+    rows = []
+    stack = [(root, '', 0)]
+    while stack:
+        node, path, level = stack.pop()
+        if path and (level >= depth and len(node.children) != 1 or not node.children):
+            rows.append((node.size, node.files, path + ('/' if node.children else '')))
+            continue
+        stack.extend((child, path + '/' + name, level + 1) for name, child in node.children.items())
+    rows.sort(key=lambda row: -row[0])
+    output = [[format_size(size), files, path] for size, files, path in rows[:limit]]
+    if len(rows) > limit:
+        rest = rows[limit:]
+        output.append([
+            format_size(sum(row[0] for row in rest)),
+            sum(row[1] for row in rest),
+            '(%d more)' % len(rest),
+        ])
+    return tabulate(output, headers=['SIZE', 'FILES', 'PATH'], disable_numparse=True)
@@ -10,6 +10,8 @@ import json
 import time
 import subprocess
 import base64
+import hashlib
+import re
 
 from . import __version__
 
@@ -18,7 +20,13 @@ cwd = os.path.realpath(os.getcwd())
 hostname = platform.node()
 prefix_path = Path(os.path.expanduser('~/.womm_prefix'))
 portforward_path = Path(os.path.expanduser('~/.womm_forwarding'))
+log_offsets_path = Path(os.path.expanduser('~/.womm_logs'))
 img_default = 'ubuntu:22.04'
+# where async leaders keep their checkpoints, relative to the root of the share
+state_dirname = '.womm-state'
+# coordinators and leaders annotate their task this often, and are presumed dead if they miss a few
+heartbeat_interval = 60
+heartbeat_timeout = 300
 basedir = Path(__file__).resolve().parent
 
 # cfg schema:
@@ -50,6 +58,34 @@ def get_prefix():
 
     return prefix
 
+quantity_suffixes = {
+    'Ki': 1024, 'Mi': 1024**2, 'Gi': 1024**3, 'Ti': 1024**4, 'Pi': 1024**5,
+    'k': 1000, 'K': 1000, 'M': 1000**2, 'G': 1000**3, 'T': 1000**4, 'P': 1000**5,
+    'm': 0.001,
+}
+
+def parse_quantity(s):
+    # kubernetes-style quantities, e.g. 1500m, 512Mi, 10G
+    s = s.strip()
+    for suffix, multiplier in sorted(quantity_suffixes.items(), key=lambda kv: -len(kv[0])):
+        if s.endswith(suffix):
+            return float(s[:-len(suffix)]) * multiplier
+    return float(s)
+
+def parse_size(s, arg):
+    try:
+        return int(parse_quantity(s))
+    except ValueError:
+        print('Expected size argument to %s, got %s' % (arg, s))
+        sys.exit(1)
+
+def format_size(n):
+    for suffix in ('', 'K', 'M', 'G', 'T'):
+        if abs(n) < 1024 or suffix == 'T':
+            break
+        n /= 1024
+    return ('%d%s' if suffix == '' else '%.1f%s') % (n, suffix)
+
 def make_id():
     return ''.join(random.choice(string.ascii_lowercase) for _ in range(8))
 
@@ -78,20 +114,36 @@ def cfg_store(cfg):
     with open(cfg_path, 'w', encoding='utf-8') as fp:
         json.dump(cfg, fp)
 
-def get_share_container():
+def get_share_container(local_path=None):
     return subprocess.run(
-        ['docker', 'ps', '-q', '--filter', 'label=womm-lazy-share=' + cwd],
+        ['docker', 'ps', '-q', '--filter', 'label=womm-lazy-share=' + (local_path or cwd)],
         stdout=subprocess.PIPE,
         check=True
     ).stdout.decode().strip()
 
-def teardown_share():
+def get_share_containers():
+    # {local path: container} for every lazy share of the current directory, whole or in part
+    result = {}
+    for line in subprocess.run(
+        ['docker', 'ps', '--filter', 'label=womm-lazy-root=' + cwd, '--format', '{{.ID}} {{.Label "womm-lazy-share"}}'],
+        stdout=subprocess.PIPE,
+        check=True
+    ).stdout.decode().splitlines():
+        container, local_path = line.split(' ', 1)
+        result[local_path] = container
+    # from before subdirectories could be shared lazily
     container = get_share_container()
+    if container:
+        result.setdefault(cwd, container)
+    return result
+
+def teardown_share(keep=()):
+    containers = [container for local_path, container in get_share_containers().items() if local_path not in keep]
 
-    if not container:
+    if not containers:
         return
 
-    subprocess.run(['docker', 'kill', container], check=True)
+    subprocess.run(['docker', 'kill'] + containers, stdout=subprocess.DEVNULL, check=True)
     time.sleep(1)  # uhhhhhhh give time for the kill to propagate to an unmount?
 
 def get_local_ip():
@@ -101,9 +153,41 @@ def get_local_ip():
         stdout=subprocess.PIPE,
     ).stdout.decode().strip()
 
+def server_replicas():
+    # the number of fs-server replicas, or 0 if the cluster is still running the old single-replica deployment
+    global _server_replicas  # pylint: disable=global-statement
+    if _server_replicas is None:
+        r = subprocess.run(
+            ['kubectl', 'get', 'statefulset', 'womm-server', '-o', 'jsonpath', '--template', '{ .spec.replicas }'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=False,
+        )
+        _server_replicas = int(r.stdout.decode().strip() or 0) if r.returncode == 0 else 0
+    return _server_replicas
+_server_replicas = None
+
+def share_replica(share_path):
+    # shares live at /data/<server hostname>/<n>, and statefulset pods are named after their ordinal
+    match = re.match(r'^/data/womm-server-(\d+)/', share_path or '')
+    return int(match.group(1)) if match else None
+
+def server_ref(share_path=None):
+    # the kubectl exec target for the fs-server holding share_path. anything that isn't a share lives on replica 0.
+    replica = share_replica(share_path)
+    if replica is None and (share_path is not None or not server_replicas()):
+        return 'deploy/womm-server'
+    return 'pod/womm-server-%d' % (replica or 0)
+
+def place_share(replicas):
+    # rendezvous hashing: a directory always lands on the same replica, and adding replicas only moves the shares
+    # which the new replicas win
+    key = '%s:%s' % (hostname, cwd)
+    return max(range(replicas), key=lambda i: hashlib.sha256(('%s:%d' % (key, i)).encode()).digest())
+
 def connection_test():
     if subprocess.run(
-        ['kubectl', 'exec', '-i', 'deploy/womm-server', '--', 'true'],
+        ['kubectl', 'exec', '-i', server_ref(), '--', 'true'],
         check=False,
         stdin=subprocess.DEVNULL,
     ).returncode != 0:
@@ -112,26 +196,30 @@ def connection_test():
         print("If you're just getting started, you may want: 'womm cluster-setup | kubectl create -f -'")
         sys.exit(1)
 
-def get_server_clusterip():
+def get_server_clusterip(share_path):
+    # by name: each replica has its own service, and the old single-replica deployment's is plain womm-server
+    replica = share_replica(share_path)
+    service = 'womm-server' if replica is None else 'womm-server-%d' % replica
     return subprocess.run(
         [
             'kubectl',
             'get',
             'svc',
-            '-l',
-            'app=womm-server',
+            service,
             '-o',
             'jsonpath',
             '--template',
-            '{ .items[0].spec.clusterIP }',
+            '{ .spec.clusterIP }',
         ],
         check=True,
         stdout=subprocess.PIPE,
     ).stdout.decode().strip()
 
 def allocate_share():
+    replicas = server_replicas()
+    server = 'pod/womm-server-%d' % place_share(replicas) if replicas else 'deploy/womm-server'
     return subprocess.run(
-        ['kubectl', 'exec', '-i', 'deploy/womm-server', '--', '/opt/womm/allocate_share.sh'],
+        ['kubectl', 'exec', '-i', server, '--', '/opt/womm/allocate_share.sh', hostname, cwd],
         check=True,
         stdin=subprocess.DEVNULL,
         stdout=subprocess.PIPE,
@@ -139,15 +227,84 @@ def allocate_share():
 
 def is_share_allocated(path):
     return subprocess.run(
-        ['kubectl', 'exec', '-i', 'deploy/womm-server', '--', 'ls', path],
+        ['kubectl', 'exec', '-i', server_ref(path), '--', 'ls', path],
+        check=False,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    ).returncode == 0
+
+def touch_share(path):
+    # marks the share as in use, so the server won't evict it. False if it has been evicted already.
+    return subprocess.run(
+        ['kubectl', 'exec', '-i', server_ref(path), '--', '/opt/womm/share.sh', 'touch', path],
         check=False,
         stdin=subprocess.DEVNULL,
         stdout=subprocess.DEVNULL,
         stderr=subprocess.DEVNULL,
     ).returncode == 0
 
+def share_info(path):
+    # (bytes used, quota in bytes or 0, last used, read-only), or None if we can't tell
+    r = subprocess.run(
+        ['kubectl', 'exec', '-i', server_ref(path), '--', '/opt/womm/share.sh', 'info', path],
+        check=False,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    if r.returncode != 0:
+        return None
+    used, quota, last_used, read_only = r.stdout.decode().split()
+    return int(used), int(quota), float(last_used), read_only == '1'
+
+def ensure_share(cfg):
+    # servers from before share.sh existed can't touch, but they don't evict either
+    if cfg['share_kind'] == 'none' or touch_share(cfg['share_path']) or is_share_allocated(cfg['share_path']):
+        return
+    print("Your share was evicted from the server for sitting idle. Allocating a new one.", file=sys.stderr)
+    cfg['share_path'] = allocate_share()
+    cfg_store(cfg)
+
+# nfs mount options for the task pods, for --nfs-profile. without one, the share is mounted with whatever the kubelet
+# picks. the attribute caching in metadata-heavy means a pod can take a minute to see files which other pods or the
+# client changed, and nocto skips revalidating a file on every open, so it's for jobs which only read what's there.
+nfs_profiles = {
+    'default': [],
+    'read-heavy': ['nconnect=8', 'rsize=1048576', 'wsize=1048576', 'actimeo=30'],
+    'write-heavy': ['nconnect=8', 'rsize=1048576', 'wsize=1048576'],
+    'metadata-heavy': ['nconnect=4', 'actimeo=60', 'nocto', 'lookupcache=all'],
+}
+
+def nfs_options(s, arg):
+    # a profile, or a comma-separated list of mount options
+    if s in nfs_profiles:
+        return nfs_profiles[s]
+    options = [option for option in s.split(',') if option]
+    if not options or not all(re.match(r'^[a-z0-9_]+(=[A-Za-z0-9_.:]+)?$', option) for option in options):
+        print('Expected %s or a comma-separated list of nfs mount options for %s, got %s' % (
+            ', '.join(nfs_profiles), arg, s))
+        sys.exit(1)
+    return options
+
+def check_mount_options(cfg, mount_options):
+    # mount options need a persistent volume, and those belong to the whole cluster rather than the namespace, so
+    # plenty of people can't create them. better to say so now than to leave a deployment behind which can't start.
+    if not mount_options or cfg['share_kind'] == 'none':
+        return
+    r = subprocess.run(
+        ['kubectl', 'auth', 'can-i', 'create', 'persistentvolumes'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+    if r.stdout.decode().strip() != 'yes':
+        print("--nfs-profile needs to create a persistentvolume, which you aren't allowed to do in this cluster. "
+              "Leave it out, or ask a cluster admin for the permission.")
+        sys.exit(1)
+
 def setup_lazy_share(remote_path, local_path):
-    if get_share_container():
+    if get_share_container(local_path):
         return
 
     kubeconfig = base64.b64encode(subprocess.run(
@@ -156,6 +313,14 @@ def setup_lazy_share(remote_path, local_path):
         stdout=subprocess.PIPE
     ).stdout).decode()
 
+    if local_path != cwd:
+        # part of an eager share, mounted over a directory in it
+        subprocess.run(
+            ['kubectl', 'exec', '-i', server_ref(remote_path), '--', 'mkdir', '-p', remote_path],
+            stdin=subprocess.DEVNULL,
+            check=True
+        )
+
     subprocess.run(['docker', 'pull', 'rhelmot/womm-export:' + __version__], check=True)
     subprocess.run(
         [
@@ -169,8 +334,12 @@ def setup_lazy_share(remote_path, local_path):
             'REMOTE_PATH=' + remote_path,
             '-e',
             'KUBECONFIG_B64=' + kubeconfig,
+            '-e',
+            'SERVER_POD=' + server_ref(remote_path),
             '--label',
             'womm-lazy-share=' + local_path,
+            '--label',
+            'womm-lazy-root=' + cwd,
             'rhelmot/womm-export:' + __version__,
         ],
         check=True,
@@ -184,11 +353,70 @@ def setup_lazy_share(remote_path, local_path):
     ).stdout:
         raise Exception("Lazy share container failed to start. What did I do wrong?")
 
-    subprocess.run(
-        ['kubectl', 'exec', '-i', 'deploy/womm-server', '--', 'exportfs', '-a'],
+    if local_path == cwd:
+        subprocess.run(
+            ['kubectl', 'exec', '-i', server_ref(remote_path), '--', 'exportfs', '-a'],
+            stdin=subprocess.DEVNULL,
+            check=True
+        )
+    elif subprocess.run(
+        ['kubectl', 'exec', '-i', server_ref(remote_path), '--', '/opt/womm/share.sh', 'export', remote_path],
         stdin=subprocess.DEVNULL,
-        check=True
-    )
+        check=False
+    ).returncode != 0:
+        print("Couldn't export %s from the filesystem server." % remote_path)
+        print("If the server is older than this version of womm, you may need to rerun womm cluster-setup.")
+        sys.exit(1)
+
+def split_opts(parallel_opts):
+    # returns (options, command and input sources)
+    if '--' in parallel_opts:
+        i = parallel_opts.index('--')
+        return parallel_opts[:i], parallel_opts[i+1:]
+    return parallel_opts, []
+
+def split_command(rest):
+    # returns (command, input sources)
+    for i, arg in enumerate(rest):
+        if arg in (':::', '::::', ':::+', '::::+'):
+            return rest[:i], rest[i:]
+    return rest, []
+
+def spool_stdin(path):
+    # save stdin to path so that it can be fed to parallel more than once. returns None if there's nothing to save.
+    if sys.stdin.isatty():
+        return None
+    with open(path, 'wb') as fp:
+        for chunk in iter(lambda: sys.stdin.buffer.read(1024 * 1024), b''):
+            fp.write(chunk)
+    return path
+
+def expand_cmdlines(opts, rest, stdin_path):
+    # ask parallel what it would run, in sequence order
+    fp = open(stdin_path, 'rb') if stdin_path is not None else None  # pylint: disable=consider-using-with
+    try:
+        return subprocess.run(
+            [str(basedir / 'parallel'), '--dry-run', '-k'] + opts + ['--'] + rest,
+            stdin=fp,
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout.decode().splitlines()
+    finally:
+        if fp is not None:
+            fp.close()
+
+def pod_command(pod, cmdline, tty=False):
+    # kubectl exec running cmdline in the pod's environment, as left by `womm setup`
+    cmdline = 'export SHELL=sh; . /tmp/.womm-env; ' + cmdline
+    return ['kubectl', 'exec', '-it' if tty else '-i', pod, '--', 'sh', '-c', cmdline]
+
+def exec_pod(pod, cmd):
+    cmdline = ' '.join(cmd)
+    if os.environ.get('WOMM_RECORD_USAGE'):
+        from .sizing import wrap_command  # pylint: disable=import-outside-toplevel
+        cmdline = wrap_command(cmdline)
+    args = pod_command(pod, cmdline, sys.stdout.isatty())
+    os.execlp(args[0], *args)
 
 def choice(options, default=None):
     if not callable(options):
@@ -0,0 +1,156 @@
+# locality-aware job placement for `womm parallel --kube-locality`.
+#
+# instead of giving parallel one sshlogin per pod, we give it a single sshlogin with all the jobslots, which connects
+# to a router running in the coordinator. the router knows each job's locality key (by sequence number) and picks a
+# pod for it: whichever pod last handled that key, or else its owner on a consistent hash ring. if that pod is full,
+# the job waits for it, unless some other pod falls idle, in which case the idle pod steals it.
+import contextlib
+import threading
+import tempfile
+import hashlib
+import shutil
+import bisect
+import socket
+
+from .common import *  # pylint: disable=wildcard-import,unused-wildcard-import
+
+virtual_nodes = 64
+steal_after = 5
+
+def ring_hash(s):
+    return int.from_bytes(hashlib.sha1(s.encode()).digest()[:8], 'big')
+
+class PodPool:
+    def __init__(self, procs_per_pod):
+        self.procs_per_pod = int(procs_per_pod)
+        self.busy = {}
+        self.live = set()
+        self.owner = {}
+        self.ring = []
+        self.cond = threading.Condition()
+
+    def update(self, live):
+        with self.cond:
+            for pod in list(self.busy):
+                if pod not in live and self.busy[pod] == 0:
+                    del self.busy[pod]
+            for pod in live:
+                self.busy.setdefault(pod, 0)
+            self.live = set(live)
+            self.ring = sorted((ring_hash('%s#%d' % (pod, i)), pod) for pod in live for i in range(virtual_nodes))
+            self.cond.notify_all()
+
+    def preferred(self, key):
+        pod = self.owner.get(key)
+        if pod in self.live:
+            return pod
+        if not self.ring:
+            return None
+        i = bisect.bisect(self.ring, (ring_hash(key), '')) % len(self.ring)
+        return self.ring[i][1]
+
+    def free(self, pod):
+        return pod in self.live and self.busy[pod] < self.procs_per_pod
+
+    def pick(self, key, waited):
+        live = sorted(self.live, key=lambda pod: self.busy[pod])
+        if key is not None:
+            pod = self.preferred(key)
+            if pod is not None and self.free(pod):
+                return pod
+        # work stealing. an idle pod is always fair game, and after a while any free slot is. a job without a key has
+        # no pod of its own to wait for, so any free slot will do for it from the start.
+        for candidate in live:
+            if self.busy[candidate] == 0 or ((waited or key is None) and self.free(candidate)):
+                return candidate
+        return None
+
+    def acquire(self, key=None):
+        waited = False
+        with self.cond:
+            while True:
+                pod = self.pick(key, waited)
+                if pod is not None:
+                    self.busy[pod] += 1
+                    if key is not None:
+                        self.owner[key] = pod
+                    return pod
+                if not self.cond.wait(steal_after):
+                    waited = True
+
+    def release(self, pod):
+        with self.cond:
+            self.busy[pod] -= 1
+            if pod not in self.live and self.busy[pod] == 0:
+                del self.busy[pod]
+            self.cond.notify_all()
+
+def serve_connection(conn, pool, keys):
+    with conn:
+        fp = conn.makefile('rwb')
+        seq = fp.readline().decode().strip()
+        try:
+            key = keys[int(seq) - 1]
+        except (ValueError, IndexError):
+            key = None
+        pod = pool.acquire(key)
+        try:
+            fp.write(pod.encode() + b'\n')
+            fp.flush()
+            # the client hands its end of the socket to kubectl exec, so EOF means the job is over
+            while conn.recv(4096):
+                pass
+        except OSError:
+            pass
+        finally:
+            pool.release(pod)
+
+def serve(sock, pool, keys):
+    while True:
+        try:
+            conn, _ = sock.accept()
+        except OSError:
+            return
+        threading.Thread(target=serve_connection, args=(conn, pool, keys), daemon=True).start()
+
+@contextlib.contextmanager
+def router(procs_per_pod, keys):
+    # yields (pool, sshlogin command)
+    pool = PodPool(procs_per_pod)
+    # parallel is picky about what goes in the host part of an sshlogin, so that's just a name in $TMPDIR
+    name = 'womm-route-' + make_id()
+    tmp = os.path.join(tempfile.gettempdir(), name)
+    os.mkdir(tmp, 0o700)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(os.path.join(tmp, 'sock'))
+        sock.listen(128)
+        threading.Thread(target=serve, args=(sock, pool, keys), daemon=True).start()
+        yield pool, '%s -m womm route %s' % (sys.executable, name)
+    finally:
+        sock.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def cmd_route():
+    # the sshlogin command which parallel runs for each job
+    path = os.path.join(tempfile.gettempdir(), sys.argv[2], 'sock')
+    cmd = sys.argv[3:]
+    if cmd and cmd[0] == '--':
+        cmd.pop(0)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    sock.sendall(os.environ.get('PARALLEL_SEQ', '').encode() + b'\n')
+    pod = b''
+    while not pod.endswith(b'\n'):
+        data = sock.recv(1)
+        if not data:
+            sys.exit(255)
+        pod += data
+    sock.set_inheritable(True)
+    exec_pod(pod.decode().strip(), cmd or ['bestsh'])
+
+def locality_keys(parallel_opts, template, stdin_path):
+    opts, rest = split_opts(parallel_opts)
+    _, sources = split_command(rest)
+    return expand_cmdlines(opts, [template] + sources, stdin_path)
@@ -0,0 +1,270 @@
+# log storage for the async leader.
+#
+# each stream (stdout, stderr) is a directory of numbered segments. the live segment is plain text, and once it is
+# rotated out it gets gzipped. an index file records the byte offset, line offset and start time of every segment, so
+# readers can seek to any point in the stream without touching earlier segments.
+#
+# $dir/lock           held (flock) by the leader for as long as it is alive
+# $dir/complete       created once the leader has finished writing
+# $dir/$stream/index  "<seq> <byte offset> <line offset> <unix time>" per segment
+# $dir/$stream/00000000.log[.gz]
+from pathlib import Path
+import threading
+import fcntl
+import gzip
+import shutil
+import time
+import os
+
+streams = ('stdout', 'stderr')
+segment_max_bytes = 4 * 1024 * 1024
+segment_max_age = 60
+held_locks = []
+
+def segment_path(stream_dir, seq):
+    return Path(stream_dir) / ('%08d.log' % seq)
+
+def read_index(stream_dir):
+    try:
+        with open(Path(stream_dir) / 'index', 'r', encoding='utf-8') as fp:
+            lines = fp.read().splitlines()
+    except FileNotFoundError:
+        return []
+    result = []
+    for line in lines:
+        parts = line.split()
+        if len(parts) != 4:
+            # torn write from a dying leader
+            continue
+        result.append((int(parts[0]), int(parts[1]), int(parts[2]), float(parts[3])))
+    return result
+
+def open_segment(stream_dir, seq):
+    # the writer compresses a segment by writing the .gz and then unlinking the plain file, so there is a window where
+    # we can see neither. try a few times before giving up.
+    path = segment_path(stream_dir, seq)
+    for _ in range(20):
+        try:
+            return open(path, 'rb')
+        except FileNotFoundError:
+            pass
+        try:
+            return gzip.open(str(path) + '.gz', 'rb')
+        except FileNotFoundError:
+            pass
+        time.sleep(0.05)
+    raise FileNotFoundError(path)
+
+class LogWriter:
+    def __init__(self, stream_dir):
+        self.stream_dir = Path(stream_dir)
+        self.stream_dir.mkdir(parents=True, exist_ok=True)
+        index = read_index(self.stream_dir)
+        if index:
+            # picking up after a previous leader. start a fresh segment at the end of the old one.
+            seq, byte_offset, line_offset, _ = index[-1]
+            with open_segment(self.stream_dir, seq) as fp:
+                data = fp.read()
+            self.bytes = byte_offset + len(data)
+            self.lines = line_offset + data.count(b'\n')
+            if segment_path(self.stream_dir, seq).exists():
+                self.compress(seq)
+            self.seq = seq + 1
+        else:
+            self.bytes = 0
+            self.lines = 0
+            self.seq = 0
+        self.index_fp = open(self.stream_dir / 'index', 'a', encoding='utf-8')  # pylint: disable=consider-using-with
+        self.fp = None
+        self.start_segment()
+
+    def start_segment(self):
+        self.fp = open(segment_path(self.stream_dir, self.seq), 'ab')  # pylint: disable=consider-using-with
+        self.segment_bytes = 0
+        self.segment_start = time.time()
+        self.index_fp.write('%d %d %d %f\n' % (self.seq, self.bytes, self.lines, self.segment_start))
+        self.index_fp.flush()
+
+    def compress(self, seq):
+        path = segment_path(self.stream_dir, seq)
+        tmp = str(path) + '.gz.tmp'
+        with open(path, 'rb') as fin, gzip.open(tmp, 'wb') as fout:
+            shutil.copyfileobj(fin, fout)
+        os.rename(tmp, str(path) + '.gz')
+        os.unlink(path)
+
+    def rotate(self):
+        self.fp.close()
+        old = self.seq
+        self.seq += 1
+        self.start_segment()
+        self.compress(old)
+
+    def write(self, data):
+        if self.segment_bytes and (
+            self.segment_bytes >= segment_max_bytes or time.time() - self.segment_start >= segment_max_age
+        ):
+            self.rotate()
+        self.fp.write(data)
+        self.fp.flush()
+        self.segment_bytes += len(data)
+        self.bytes += len(data)
+        self.lines += data.count(b'\n')
+
+    def close(self):
+        self.fp.close()
+        self.index_fp.close()
+
+def pump(pipe, writer):
+    try:
+        while True:
+            data = os.read(pipe.fileno(), 65536)
+            if not data:
+                break
+            writer.write(data)
+    finally:
+        writer.close()
+
+def hold_lock(log_dir):
+    log_dir = Path(log_dir)
+    log_dir.mkdir(parents=True, exist_ok=True)
+    # lock before the file appears under its real name, so that anyone who can see it will also see it locked
+    tmp = log_dir / ('lock.%d' % os.getpid())
+    fp = open(tmp, 'a', encoding='utf-8')  # pylint: disable=consider-using-with
+    fcntl.flock(fp, fcntl.LOCK_EX)
+    os.rename(tmp, log_dir / 'lock')
+    # the fd is deliberately kept open forever - the lock is released by the kernel when we exit, however we exit
+    held_locks.append(fp)
+
+def record_process(log_dir, p):
+    # p is a Popen with stdout and stderr both set to PIPE
+    log_dir = Path(log_dir)
+    try:
+        os.unlink(log_dir / 'complete')
+    except FileNotFoundError:
+        pass
+    threads = [
+        threading.Thread(target=pump, args=(pipe, LogWriter(log_dir / stream)), daemon=True)
+        for pipe, stream in zip((p.stdout, p.stderr), streams)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    code = p.wait()
+    (log_dir / 'complete').touch()
+    return code
+
+def completion_event(log_dir):
+    # set as soon as the leader lets go of its lock. the kernel wakes us, no polling involved.
+    log_dir = Path(log_dir)
+    event = threading.Event()
+
+    def waiter():
+        # the leader might not have started yet
+        while True:
+            try:
+                fp = open(log_dir / 'lock', 'r', encoding='utf-8')  # pylint: disable=consider-using-with
+                break
+            except FileNotFoundError:
+                time.sleep(0.25)
+        with fp:
+            fcntl.flock(fp, fcntl.LOCK_SH)
+        event.set()
+
+    if (log_dir / 'complete').exists():
+        event.set()
+    else:
+        threading.Thread(target=waiter, daemon=True).start()
+    return event
+
+def offset_for_line(stream_dir, line):
+    index = read_index(stream_dir)
+    if not index:
+        return 0
+    entry = index[0]
+    for candidate in index:
+        if candidate[2] > line:
+            break
+        entry = candidate
+    seq, byte_offset, line_offset, _ = entry
+    skip = line - line_offset
+    with open_segment(stream_dir, seq) as fp:
+        for _ in range(skip):
+            data = fp.readline()
+            if not data:
+                break
+            byte_offset += len(data)
+    return byte_offset
+
+def total_lines(stream_dir):
+    index = read_index(stream_dir)
+    if not index:
+        return 0
+    seq, _, line_offset, _ = index[-1]
+    with open_segment(stream_dir, seq) as fp:
+        return line_offset + fp.read().count(b'\n')
+
+def offset_for_tail(stream_dir, count):
+    return offset_for_line(stream_dir, max(0, total_lines(stream_dir) - count))
+
+def offset_for_time(stream_dir, since):
+    # only as precise as the segments: we start from the beginning of the segment that was live at `since`.
+    result = None
+    for _, byte_offset, _, start_time in read_index(stream_dir):
+        if start_time > since:
+            break
+        result = byte_offset
+    return 0 if result is None else result
+
+def follow(stream_dir, offset, out, done):
+    # copy the stream to the binary file out, starting from byte offset, until done is set and everything is copied
+    index = []
+    while not index:
+        index = read_index(stream_dir)
+        if not index:
+            if done.wait(0.25):
+                index = read_index(stream_dir)
+                if not index:
+                    return
+    i = 0
+    while i + 1 < len(index) and index[i + 1][1] <= offset:
+        i += 1
+
+    seq, byte_offset, _, _ = index[i]
+    fp = open_segment(stream_dir, seq)
+    try:
+        remaining = offset - byte_offset
+        while remaining > 0:
+            skipped = len(fp.read(min(remaining, 65536)))
+            if not skipped:
+                break
+            remaining -= skipped
+
+        while True:
+            data = fp.read(65536)
+            if data:
+                out.write(data)
+                out.flush()
+                continue
+            # at the end of this segment. has a newer one started? the writer only indexes the next segment after it
+            # is done with this one, so whatever is left in this one is now readable.
+            index = read_index(stream_dir)
+            if any(entry[0] == seq + 1 for entry in index):
+                data = fp.read()
+                if data:
+                    out.write(data)
+                    out.flush()
+                fp.close()
+                seq += 1
+                fp = open_segment(stream_dir, seq)
+                continue
+            if done.is_set():
+                data = fp.read()
+                if data:
+                    out.write(data)
+                    out.flush()
+                return
+            done.wait(0.25)
+    finally:
+        fp.close()
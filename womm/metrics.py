@@ -0,0 +1,310 @@
+# prometheus metrics for a running task, from whoever runs its gnu parallel: the client for a synchronous task, or the
+# leader pod for an async one.
+#
+# everything is worked out when the endpoint is scraped and not before, so a task nobody is watching pays nothing.
+# finished jobs come from parallel's joblog, of which each scrape only reads what was appended since the last one.
+# running jobs are parallel's children, the pods are the lines of the sshloginfile, and bytes in and out are what
+# parallel itself has read (its input and the jobs' output) and written (the output, passed on).
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from contextlib import contextmanager
+import threading
+import bisect
+import json
+
+import psutil
+
+from .common import *  # pylint: disable=wildcard-import,unused-wildcard-import
+
+# where the leader pod serves them
+leader_port = 9464
+duration_buckets = (1, 5, 15, 60, 300, 900, 3600, 4 * 3600)
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# freed jobslots we remember per host, waiting for a job to have started in them
+max_freed = 1024
+
+def usage_metrics():
+    print("""\
+Usage: womm metrics <id>
+
+Print the prometheus metrics of a running task: jobs queued, running, done and failed, how long jobs
+take and how long freed jobslots wait for their next job, live pods, and bytes in and out.
+""")
+    sys.exit(0)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name):
+        lines = []
+        total = 0
+        for le, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            lines.append('%s_bucket{le="%s"} %d' % (name, le, total))
+        lines.append('%s_sum %.3f' % (name, self.sum))
+        lines.append('%s_count %d' % (name, total))
+        return lines
+
+class Metrics:
+    def __init__(self, joblog, parallel_opts):
+        self.joblog = joblog
+        self.parallel_opts = parallel_opts
+        # filled in once they exist
+        self.sshloginfile = None
+        self.process = None
+        self.total = None
+        self.port = None
+        self.io = (0, 0)
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.offset = 0
+        self.partial = b''
+        self.done = 0
+        self.failed = 0
+        self.durations = Histogram(duration_buckets)
+        self.latencies = Histogram(latency_buckets)
+        # {host: sorted finish times}
+        self.freed = {}
+
+    def tail(self):
+        try:
+            with open(self.joblog, 'rb') as fp:
+                fp.seek(self.offset)
+                data = fp.read()
+        except FileNotFoundError:
+            return
+        self.offset += len(data)
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.record(line.decode(errors='replace').split('\t'))
+
+    def record(self, fields):
+        # Seq Host Starttime JobRuntime Send Receive Exitval Signal Command
+        try:
+            host = fields[1]
+            start = float(fields[2])
+            runtime = float(fields[3])
+            failed = int(fields[6]) != 0 or int(fields[7]) != 0
+        except (IndexError, ValueError):
+            # the header
+            return
+        self.done += 1
+        self.failed += failed
+        self.durations.observe(runtime)
+        # the job went into the jobslot freed most recently before it started on the same host. jobs are logged as
+        # they finish, and whatever freed that jobslot finished before this job did, so it's been logged already.
+        freed = self.freed.setdefault(host, [])
+        i = bisect.bisect_right(freed, start)
+        if i:
+            self.latencies.observe(start - freed.pop(i - 1))
+        bisect.insort(freed, start + runtime)
+        if len(freed) > max_freed:
+            del freed[0]
+
+    def pods(self):
+        if self.sshloginfile is None:
+            return 0
+        try:
+            with open(self.sshloginfile, 'r', encoding='utf-8') as fp:
+                return sum(1 for line in fp if ' womm ssh ' in line)
+        except FileNotFoundError:
+            return 0
+
+    def process_stats(self):
+        # (running jobs, bytes read, bytes written). once parallel is gone, the counters stay where it left them.
+        if self.process is None:
+            return 0, 0, 0
+        try:
+            p = psutil.Process(self.process.pid)
+            io = p.io_counters()
+            self.io = io.read_chars, io.write_chars
+            return (sum(1 for child in p.children() if is_job(child)),) + self.io
+        except (psutil.Error, AttributeError):
+            return (0,) + self.io
+
+    def render(self):
+        with self.lock:
+            self.tail()
+            running, read, written = self.process_stats()
+            metrics = [
+                ('womm_jobs_done_total', 'counter', 'Jobs which have finished', self.done),
+                ('womm_jobs_failed_total', 'counter', 'Jobs which have finished with a nonzero exit code or a signal',
+                 self.failed),
+                ('womm_jobs_running', 'gauge', 'Jobs which are running', running),
+            ]
+            if self.total is not None:
+                queued = max(0, self.total - self.done - running)
+                metrics.append(('womm_jobs_queued', 'gauge', 'Jobs which have yet to start', queued))
+                if self.done:
+                    eta = round((queued + running) * (time.time() - self.start) / self.done, 1)
+                    metrics.append(('womm_eta_seconds', 'gauge', 'Estimated time until the last job finishes', eta))
+            metrics += [
+                ('womm_pods_live', 'gauge', 'Pods which are ready for jobs', self.pods()),
+                ('womm_bytes_in_total', 'counter', 'Bytes parallel has read, its input and the output of jobs', read),
+                ('womm_bytes_out_total', 'counter', 'Bytes parallel has written, mostly the output of jobs', written),
+            ]
+
+            lines = []
+            for name, kind, help_, value in metrics:
+                lines += ['# HELP %s %s' % (name, help_), '# TYPE %s %s' % (name, kind), '%s %s' % (name, value)]
+            lines += [
+                '# HELP womm_job_duration_seconds How long finished jobs took, kubectl exec and all',
+                '# TYPE womm_job_duration_seconds histogram',
+            ] + self.durations.render('womm_job_duration_seconds') + [
+                '# HELP womm_dispatch_latency_seconds How long a freed jobslot waited for its next job',
+                '# TYPE womm_dispatch_latency_seconds histogram',
+            ] + self.latencies.render('womm_dispatch_latency_seconds')
+            return '\n'.join(lines) + '\n'
+
+def is_job(process):
+    # parallel has other children now and then, e.g. asking hosts how many cores they have, without a job number
+    try:
+        return 'PARALLEL_SEQ' in process.environ()
+    except psutil.Error:
+        return False
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def serve(metrics, host, port):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):  # pylint: disable=invalid-name
+            if self.path not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    server = Server((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def split_joblog(parallel_opts):
+    # returns (the joblog the user gave or None, the other options, the command and input sources)
+    opts, rest = split_opts(parallel_opts)
+    joblog = None
+    result = []
+    iterable = iter(opts)
+    for opt in iterable:
+        if opt in ('--joblog', '--jl'):
+            joblog = next(iterable, None)
+        elif opt.startswith('--joblog='):
+            joblog = opt.split('=', 1)[1]
+        else:
+            result.append(opt)
+    if joblog is not None:
+        # parallel appends to a joblog given as +path
+        joblog = joblog.lstrip('+')
+    return joblog, result, rest
+
+# options which put more than one argument, or line, into each job
+grouping_opts = ('--max-args', '--max-lines', '--max-replace-args', '--xargs', '--pipe', '--pipepart')
+grouping_short_opts = ('-N', '-n', '-L', '-l', '-X', '-m')
+
+def groups_args(opt):
+    if opt.startswith('--'):
+        return opt.partition('=')[0] in grouping_opts
+    return opt[:2] in grouping_short_opts
+
+def count_jobs(parallel_opts):
+    # the number of jobs, including the ones a resumed task has done already, if we can tell without reading the
+    # input: from --total-jobs, or when the arguments are all on the command line. otherwise there's no queue or eta.
+    _, opts, rest = split_joblog(parallel_opts)
+    iterable = iter(opts)
+    for opt in iterable:
+        name, eq, value = opt.partition('=')
+        if name in ('--total-jobs', '--total'):
+            value = value if eq else next(iterable, '')
+            return int(value) if value.isdigit() else None
+    _, sources = split_command(rest)
+    if not sources or any(groups_args(opt) for opt in opts) or any(arg in ('::::', '::::+') for arg in sources):
+        return None
+    # the number of arguments of each source, grouped with the sources they're linked to by :::+
+    groups = []
+    for arg in sources:
+        if arg == ':::' or not groups:
+            groups.append([0])
+        elif arg == ':::+':
+            groups[-1].append(0)
+        else:
+            groups[-1][-1] += 1
+    if '--link' in opts or '--xapply' in opts:
+        groups = [sum(groups, [])]
+    # linked sources go round until the longest one is done
+    total = 1
+    for group in groups:
+        total *= max(group)
+    return total
+
+@contextmanager
+def exporter(parallel_opts, joblog, host='127.0.0.1', port=0):
+    # yields the Metrics, whose parallel_opts log to a joblog: the user's if they gave one, else joblog
+    given, _, _ = split_joblog(parallel_opts)
+    if given is None:
+        opts, rest = split_opts(parallel_opts)
+        parallel_opts = opts + ['--joblog', str(joblog)] + (['--'] + rest if '--' in parallel_opts else [])
+    metrics = Metrics(given or joblog, parallel_opts)
+    metrics.total = count_jobs(parallel_opts)
+    server = serve(metrics, host, port)
+    metrics.port = server.server_address[1]
+    try:
+        yield metrics
+    finally:
+        server.shutdown()
+        server.server_close()
+
+fetch_script = '''
+import sys, urllib.request
+sys.stdout.write(urllib.request.urlopen(sys.argv[1], timeout=10).read().decode())
+'''
+
+def cmd_metrics():
+    args = sys.argv[2:]
+    if len(args) != 1 or args[0].startswith('-'):
+        usage_metrics()
+    task_id = args[0]
+
+    deploy = subprocess.run(
+        ['kubectl', 'get', 'deploy', 'womm-task-' + task_id, '-o', 'json'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+    if deploy.returncode != 0:
+        print("No deployment for %s. Either it doesn't exist or it has already completed." % task_id)
+        sys.exit(1)
+    annotations = json.loads(deploy.stdout.decode())['metadata']['annotations']
+
+    port = annotations.get('womm-metrics-port')
+    if port is not None:
+        # a synchronous task, run from somewhere
+        if annotations['womm-host'] != hostname:
+            print('%s is running on %s. Ask for its metrics there.' % (task_id, annotations['womm-host']))
+            sys.exit(1)
+        url = 'http://127.0.0.1:%s/metrics' % port
+        r = subprocess.run([sys.executable, '-c', fetch_script, url], check=False)
+    else:
+        url = 'http://127.0.0.1:%d/metrics' % leader_port
+        r = subprocess.run(
+            ['kubectl', 'exec', '-i', 'job/womm-leader-' + task_id, '--', 'python3', '-c', fetch_script, url],
+            stdin=subprocess.DEVNULL,
+            check=False,
+        )
+    if r.returncode != 0:
+        print('Could not get metrics for %s. Is it still running?' % task_id)
+        sys.exit(1)
@@ -1,8 +1,10 @@
 # pylint: disable=consider-using-with
 from contextlib import contextmanager
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 import tempfile
+import codecs
 import threading
 import json
 import re
@@ -14,10 +16,20 @@ import dateutil.parser
 
 from .common import *  # pylint: disable=wildcard-import,unused-wildcard-import
 from . import __version__
-
-def make_deployment(parallelism, cfg, job_mem, job_cpu, pwd, cmd):
+from . import logstore
+from . import cache
+from . import locality
+from . import staging
+from . import changes
+from . import sharepolicy
+from . import sizing
+from . import metrics
+from . import localpool
+from . import admission
+
+def make_deployment(parallelism, cfg, job_mem, job_cpu, pwd, cmd, staging_=None, mount_options=None, async_=False):
     image = cfg['image']
-    nfs_server = get_server_clusterip() if cfg['share_kind'] != 'none' else None
+    nfs_server = get_server_clusterip(cfg['share_path']) if cfg['share_kind'] != 'none' else None
     nfs_path = cfg['share_path'] if cfg['share_kind'] != 'none' else None
     cmd_str = ' '.join("'%s'" % arg.replace('"', '\\"') for arg in cmd)
 
@@ -32,18 +44,34 @@ def make_deployment(parallelism, cfg, job_mem, job_cpu, pwd, cmd):
         secrets_line2 = "  - name: " + cfg['secret_name']
 
     task_id = make_id()
+    granted = admission_grant(task_id, parallelism, job_cpu, job_mem, async_)
     with open(basedir / 'task-deployment.yml', 'r', encoding='utf-8') as fp:
         deployment_yml = fp.read()
 
+    extras = staging.render(staging_) if staging_ is not None else {}
+    for placeholder in ('$EXTRA_MOUNTS', '$SIDECARS', '$POD_EXTRA', '$EXTRA_VOLUMES'):
+        deployment_yml = deployment_yml.replace(placeholder + '\n', extras.get(placeholder, ''))
+
+    if mount_options and nfs_server is not None:
+        # an inline nfs volume can't have mount options, a persistent volume can
+        with open(basedir / 'share-volume.yml', 'r', encoding='utf-8') as fp:
+            deployment_yml = fp.read().replace('$MOUNT_OPTIONS', json.dumps(mount_options)) + deployment_yml
+        share_volume = 'persistentVolumeClaim:\n  claimName: womm-share-$ID'
+    else:
+        share_volume = 'nfs:\n  server: $NFS_SERVER\n  path: "$NFS_PATH"'
+    deployment_yml = deployment_yml.replace('$SHARE_VOLUME\n', staging.indent(share_volume, 10))
+
     deployment_yml = deployment_yml \
         .replace('$ID', task_id) \
         .replace('$PARALLELISM', str(parallelism)) \
+        .replace('$GRANTED', str(granted)) \
         .replace('$IMAGE', image) \
         .replace('$JOB_MEM', job_mem) \
         .replace('$JOB_CPU', job_cpu) \
         .replace('$HOST', hostname) \
         .replace('$CONTROLLER_PID', str(os.getpid())) \
         .replace('$PWD', pwd) \
+        .replace('$NOW', str(int(time.time()))) \
         .replace('$CMD', cmd_str) \
         .replace('$NAMESPACE_LINE', namespace_line) \
         .replace('$SECRETS_LINE1', secrets_line1) \
@@ -61,28 +89,75 @@ def make_deployment(parallelism, cfg, job_mem, job_cpu, pwd, cmd):
 
     return task_id
 
-def delete_deployment(task_id):
-    subprocess.run(['kubectl', 'delete', 'deploy', 'womm-task-' + task_id], check=True, stdout=sys.stderr)
+def admission_grant(task_id, parallelism, job_cpu, job_mem, async_):
+    # how many pods a new task starts with, which is all of them unless there's a quota to share
+    capacity = admission.capacity()
+    if capacity is None:
+        return parallelism
+    granted = admission.shares(get_status(), capacity, (task_id, parallelism, job_cpu, job_mem, async_))[task_id]
+    if granted == 0:
+        print("womm: the namespace's quota is taken, so %s waits for its turn. See `womm status -A`." % task_id,
+              file=sys.stderr)
+    elif granted < parallelism:
+        print("womm: %s starts with %d of its %d pods, its share of the namespace's quota" % (
+            task_id, granted, parallelism
+        ), file=sys.stderr)
+    return granted
+
+def delete_deployment(task_id, wait_pods=False):
+    # wait_pods waits for the pods to be gone too, e.g. so that their scratch uploaders are done
+    subprocess.run(
+        ['kubectl', 'delete', 'deploy', 'womm-task-' + task_id, '--ignore-not-found']
+        + (['--cascade=foreground'] if wait_pods else []),
+        check=True,
+        stdout=sys.stderr
+    )
+    delete_volumes([task_id])
 
-def make_leader(task_id, procs_per_pod, parallel_opts):
+def delete_volumes(task_ids):
+    # the share's persistent volume, from --nfs-profile. kubernetes holds on to them until the pods are gone, so there's
+    # no waiting. leaders may not delete persistent volumes, which stay behind released until `womm reap` runs locally.
+    subprocess.run(
+        ['kubectl', 'delete', 'pvc,pv', '-l', 'womm_task in (%s)' % ','.join(task_ids), '--wait=false'],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+
+def make_leader(task_id, cfg, procs_per_pod, parallel_opts, cmd_str=None):
+    # cmd_str is given when resuming a task, in which case the leader already has its arguments and input in the
+    # share, and is told so with --resume in place of them
     with open(basedir / 'leader-job.yml', 'r', encoding='utf-8') as fp:
         job_yml = fp.read()
 
+    resume = cmd_str is not None
     args_str = ' '.join("'%s'" % arg.replace("'", "'\\''") for arg in parallel_opts)
-    cmd_str = ' '.join("'%s'" % arg.replace('"', '\\"') for arg in ['parallel'] + parallel_opts)
+    if not resume:
+        cmd_str = ' '.join("'%s'" % arg.replace('"', '\\"') for arg in ['parallel'] + parallel_opts)
 
     job_yml = job_yml \
         .replace('$ID', task_id) \
         .replace('$VERSION', __version__) \
-        .replace('$PROCS_PER_POD', str(procs_per_pod)) \
+        .replace('$PROCS_PER_POD', '--resume' if resume else str(procs_per_pod)) \
         .replace('$ARGS', args_str) \
         .replace('$HOST', hostname) \
         .replace('$CONTROLLER_PID', str(os.getpid())) \
         .replace('$PWD', cwd) \
+        .replace('$NOW', str(int(time.time()))) \
         .replace('$CMD', cmd_str)
 
+    if cfg['share_kind'] != 'none':
+        job_yml = job_yml \
+            .replace('$NFS_SERVER', get_server_clusterip(cfg['share_path'])) \
+            .replace('$NFS_PATH', cfg['share_path'])
+    else:
+        job_yml = job_yml.split('# {{snip here}}')[0]
+
     subprocess.run(['kubectl', 'create', '-f', '-'], input=job_yml.encode(), check=True, stdout=sys.stderr)
 
+    if resume:
+        return
+
     # hack hack hack
     subprocess.run(
         ['kubectl', 'wait', 'pods', '-l', 'job-name=womm-leader-' + task_id, '--for', 'condition=ready'],
@@ -100,8 +175,164 @@ def make_leader(task_id, procs_per_pod, parallel_opts):
 def delete_leader(task_id):
     subprocess.run(['kubectl', 'delete', 'job', 'womm-leader-' + task_id], check=True, stdout=sys.stderr)
 
+def delete_tasks(task_ids):
+    # everything in one call, however many tasks there are
+    if not task_ids:
+        return
+    subprocess.run(
+        ['kubectl', 'delete', '--ignore-not-found', '--wait=false']
+        + ['jobs/womm-leader-' + task_id for task_id in task_ids]
+        + ['deploy/womm-task-' + task_id for task_id in task_ids],
+        check=True,
+        stdout=sys.stderr,
+    )
+    delete_volumes(task_ids)
+
+def annotate(resource, key, value):
+    # returns kubectl's complaint if it failed, else None
+    r = subprocess.run(
+        ['kubectl', 'annotate', '--overwrite', resource, '%s=%s' % (key, value)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=False,
+    )
+    return (r.stderr.decode(errors='replace').strip() or 'failed') if r.returncode != 0 else None
+
 @contextmanager
-def watch_deployment(task_id, always_entries, procs_per_pod):
+def heartbeat(resource, share_path=None):
+    # lets `womm reap` tell that whoever is in charge of the task is still alive, from anywhere. the share is touched
+    # too, so that the server doesn't evict it from under a task which runs for longer than shares are left idle.
+    stop = threading.Event()
+
+    def beat():
+        reported = False
+        while not stop.wait(heartbeat_interval):
+            error = annotate(resource, 'womm-heartbeat', int(time.time()))
+            if error is not None and not reported:
+                # once is enough. for a leader this goes to its log, where `womm logs` shows it
+                reported = True
+                print('womm: could not update the heartbeat of %s, so it may look orphaned: %s' % (resource, error),
+                      file=sys.stderr)
+                print('womm: if the womm-leader role is from an older version, run `womm cluster-setup | kubectl '
+                      'apply -f -`', file=sys.stderr)
+            if share_path is not None:
+                touch_share(share_path)
+
+    threading.Thread(target=beat, daemon=True).start()
+    try:
+        yield
+    finally:
+        stop.set()
+
+def scale(task_id, pods):
+    patch = {'spec': {'replicas': pods}, 'metadata': {'annotations': {'womm-granted-pods': str(pods)}}}
+    subprocess.run(
+        ['kubectl', 'patch', 'deploy', 'womm-task-' + task_id, '--type', 'merge', '-p', json.dumps(patch)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+
+@contextmanager
+def fair_share(task_id):
+    # keeps the task at its share of the namespace's quota as other tasks start and finish. shrinking takes pods away
+    # from under their jobs, which parallel's --retries will run again elsewhere.
+    stop = threading.Event()
+
+    def regulate():
+        while not stop.wait(admission.interval):
+            try:
+                results = get_status()
+            except subprocess.CalledProcessError:
+                continue
+            data = results.get(task_id)
+            if data is None or not data.requested_instances:
+                continue
+            capacity = admission.capacity()
+            granted = data.requested_instances if capacity is None else admission.shares(results, capacity)[task_id]
+            if granted != data.target_instances or granted != data.granted_instances:
+                scale(task_id, granted)
+
+    threading.Thread(target=regulate, daemon=True).start()
+    try:
+        yield
+    finally:
+        stop.set()
+
+class LoginFile:
+    # the sshloginfile parallel reads. pods only go in once they're running and the share is synced, which is when
+    # the synced future completes.
+    def __init__(self, always_entries, login_lines, synced=None, start=None):
+        self.fp = tempfile.NamedTemporaryFile('w', encoding='utf-8')  # pylint: disable=consider-using-with
+        self.name = self.fp.name
+        self.always_entries = always_entries
+        self.login_lines = login_lines
+        self.synced = synced
+        self.start = start
+        self.live = set()
+        self.first_running = None
+        self.reported = False
+        self.lock = threading.Lock()
+        self.write()
+        if synced is not None:
+            synced.add_done_callback(self.synced_done)
+
+    def ready(self):
+        return self.synced is None or self.synced.done() and self.synced.exception() is None
+
+    def synced_done(self, synced):
+        self.write()
+        if synced.exception() is not None:
+            # the pods will never be ready. whatever is reading the file might be running jobs in the local jobslots
+            # already, and would go on to run every one of them there, so it's stopped now rather than after the fact.
+            print('womm: syncing the share failed, stopping', file=sys.stderr)
+            for child in psutil.Process().children():
+                try:
+                    if self.name in child.cmdline():
+                        child.terminate()
+                except psutil.Error:
+                    pass
+
+    def update(self, name, running):
+        if running:
+            self.live.add(name)
+            if self.first_running is None:
+                self.first_running = time.time()
+        else:
+            self.live.discard(name)
+        self.write()
+
+    def write(self):
+        with self.lock:
+            if self.fp.closed:
+                return
+            ready = self.ready()
+            self.fp.seek(0)
+            self.fp.truncate()
+            self.fp.write(''.join(f'{x}\n' for x in self.always_entries))
+            if ready:
+                self.fp.write(''.join(f'{x}\n' for x in self.login_lines(self.live)))
+            self.fp.flush()
+            if ready and self.live and not self.reported and self.start is not None:
+                self.reported = True
+                now = time.time()
+                print('womm: first pod ready for jobs after %s (running after %s, share synced after %s)' % (
+                    fmt_seconds(now - self.start),
+                    fmt_seconds(self.first_running - self.start),
+                    fmt_seconds(self.synced.result() - self.start),
+                ), file=sys.stderr)
+
+    def close(self):
+        with self.lock:
+            self.fp.close()
+
+def fmt_seconds(seconds):
+    return '%dm%02ds' % divmod(round(seconds), 60) if seconds >= 60 else '%ds' % round(seconds)
+
+@contextmanager
+def watch_deployment(task_id, always_entries, procs_per_pod, login_lines=None, synced=None, start=None):
+    if login_lines is None:
+        login_lines = lambda live: [f'{procs_per_pod}/{sys.executable} -m womm ssh {pod}' for pod in live]  # pylint: disable=unnecessary-lambda-assignment
     p = subprocess.Popen(
         [
             'kubectl',
@@ -115,27 +346,26 @@ def watch_deployment(task_id, always_entries, procs_per_pod):
         ],
         stdout=subprocess.PIPE
     )
-    fp = tempfile.NamedTemporaryFile('w', encoding='utf-8')
+    login_file = LoginFile(always_entries, login_lines, synced, start)
     thread = threading.Thread(
         target=watch_deployment_thread,
-        args=(fp, p.stdout, always_entries, procs_per_pod),
+        args=(login_file, p.stdout),
         daemon=True
     )
     thread.start()
 
     try:
-        while os.stat(fp.name).st_size == 0:
+        while os.stat(login_file.name).st_size == 0:
+            if synced is not None and synced.done() and synced.exception() is not None:
+                raise synced.exception()
             time.sleep(0.5)
 
-        yield fp.name
+        yield login_file.name
     finally:
         p.kill()
-        fp.close()
+        login_file.close()
 
-def watch_deployment_thread(fp, pipe, always_entries, procs_per_pod):
-    fp.write(''.join(f'{x}\n' for x in always_entries))
-
-    live = set()
+def watch_deployment_thread(login_file, pipe):
     try:
         while True:
             line = pipe.readline().decode()
@@ -144,15 +374,7 @@ def watch_deployment_thread(fp, pipe, always_entries, procs_per_pod):
             name, status = line.split()
             if name == 'NAME':
                 continue
-            if status == 'Running':
-                live.add(name)
-            else:
-                live.discard(name)
-            fp.seek(0)
-            fp.truncate()
-            fp.write(''.join(f'{x}\n' for x in always_entries))
-            fp.write(''.join(f'{procs_per_pod}/{sys.executable} -m womm ssh {pod}\n' for pod in live))
-            fp.flush()
+            login_file.update(name, status == 'Running')
     except: # pylint: disable=bare-except
         pass
 
@@ -162,12 +384,29 @@ Usage: womm parallel [options] -- [command]
 
 Options:
   --kube-pods N       Spin up N pods to dispatch jobs to
-  --local-procs N     In addition to the kube pods, use N local jobslots
+  --local-procs N     In addition to the kube pods, use N local jobslots, each in a container of the
+                      directory's image
   --procs-per-pod N   Assign N jobslots per pod (default 1)
+  --kube-auto         Size pods and jobslots per pod from the recorded usage of past runs of the same
+                      command, instead of just suggesting it
+  --kube-oom-risk P   When sizing from past runs, leave room for all but the hungriest P% of jobs
+                      (default 5)
   --kube-cpu N        Reserve N cpus per pod (default 1)
   --kube-mem N        Reserve N memory per pod (default 512Mi)
   --async             Run the coordinator in the cluster, requiring manual log collection and
                       cleanup, but adding resilience against network failures
+  --stage PATH        Copy PATH (a file or directory which jobs only read) out of the share once per
+                      node and let pods read it from there. Can be given more than once
+  --scratch DIR       Give each pod a local DIR, and move the files jobs write there into the share
+                      in the background
+  --nfs-profile P     Mount the share in the pods with the nfs options for P: read-heavy, write-heavy,
+                      metadata-heavy, or a comma-separated list of mount options. Compare them with
+                      womm bench-share
+  --kube-locality T   Send jobs which expand the template T to the same thing to the same pod, so
+                      that they can share its page cache, e.g. --kube-locality {1}
+  --cache             Replay the results of jobs which have been run before with the same command
+                      line, referenced files and image instead of running them again
+  --cache-size N      Evict least recently used cached results beyond N bytes (default 1G)
   --citation          Silence the GNU parallel citation message
   --help              Show this message :)
 
@@ -195,6 +434,13 @@ def int_arg(s, arg):
         print('Expected integer argument to %s, got %s' % (arg, s))
         sys.exit(1)
 
+def float_arg(s, arg):
+    try:
+        return float(s)
+    except ValueError:
+        print('Expected number argument to %s, got %s' % (arg, s))
+        sys.exit(1)
+
 def next_arg(iterable, arg):
     try:
         r = next(iterable)
@@ -214,6 +460,13 @@ def cmd_parallel():
     local_procs = 0
     procs_per_pod = 1
     async_ = False
+    cache_size = None
+    locality_template = None
+    stage_inputs = []
+    scratch = None
+    kube_auto = False
+    oom_risk = sizing.default_oom_risk
+    mount_options = None
 
     iterable = iter(enumerate(parallel_opts))
     for i, opt in iterable:
@@ -255,6 +508,54 @@ def cmd_parallel():
         elif opt == '--async':
             async_ = True
             parallel_opts[i] = None
+        elif opt == '--kube-auto':
+            kube_auto = True
+            parallel_opts[i] = None
+        elif opt.startswith('--kube-oom-risk='):
+            oom_risk = float_arg(opt.split('=', 1)[1], '--kube-oom-risk')
+            parallel_opts[i] = None
+        elif opt == '--kube-oom-risk':
+            oom_risk = float_arg(next_arg(iterable, '--kube-oom-risk')[1], '--kube-oom-risk')
+            parallel_opts[i] = None
+            parallel_opts[i+1] = None
+        elif opt.startswith('--stage='):
+            stage_inputs.append(opt.split('=', 1)[1])
+            parallel_opts[i] = None
+        elif opt == '--stage':
+            stage_inputs.append(next_arg(iterable, '--stage')[1])
+            parallel_opts[i] = None
+            parallel_opts[i+1] = None
+        elif opt.startswith('--scratch='):
+            scratch = opt.split('=', 1)[1]
+            parallel_opts[i] = None
+        elif opt == '--scratch':
+            scratch = next_arg(iterable, '--scratch')[1]
+            parallel_opts[i] = None
+            parallel_opts[i+1] = None
+        elif opt.startswith('--nfs-profile='):
+            mount_options = nfs_options(opt.split('=', 1)[1], '--nfs-profile')
+            parallel_opts[i] = None
+        elif opt == '--nfs-profile':
+            mount_options = nfs_options(next_arg(iterable, '--nfs-profile')[1], '--nfs-profile')
+            parallel_opts[i] = None
+            parallel_opts[i+1] = None
+        elif opt.startswith('--kube-locality='):
+            locality_template = opt.split('=', 1)[1]
+            parallel_opts[i] = None
+        elif opt == '--kube-locality':
+            locality_template = next_arg(iterable, '--kube-locality')[1]
+            parallel_opts[i] = None
+            parallel_opts[i+1] = None
+        elif opt == '--cache':
+            cache_size = cache_size or cache.default_cache_size
+            parallel_opts[i] = None
+        elif opt.startswith('--cache-size='):
+            cache_size = parse_size(opt.split('=', 1)[1], '--cache-size')
+            parallel_opts[i] = None
+        elif opt == '--cache-size':
+            cache_size = parse_size(next_arg(iterable, '--cache-size')[1], '--cache-size')
+            parallel_opts[i] = None
+            parallel_opts[i+1] = None
         elif opt == '--citation':
             sys.exit(subprocess.run([basedir / 'parallel', '--citation'], check=False).returncode)
         elif opt in ('--help', '-h', '-?'):
@@ -271,10 +572,7 @@ def cmd_parallel():
         sys.exit(1)
 
     connection_test()
-
-    if not is_share_allocated(cfg['share_path']):
-        print("Error: server has rebooted. Please run `womm setup` to reinitialize share")
-        sys.exit(1)
+    check_mount_options(cfg, mount_options)
 
     if parallelism == 0:
         print('You need to specify --kube-pods <num> - otherwise why are you using this program?')
@@ -284,23 +582,85 @@ def cmd_parallel():
         print('Conflict between --async and --local-procs. You cannot use both.')
         sys.exit(1)
 
-    if async_ and cfg['share_kind'] == 'lazy':
-        print('You cannot use a lazy share with an async task. What if your network connection goes away?')
+    if async_ and (cfg['share_kind'] == 'lazy' or
+                   cfg['share_kind'] != 'none' and 'lazy' in sharepolicy.load_rules().values()):
+        print('You cannot use a lazy share with an async task, not even for part of the directory. '
+              'What if your network connection goes away?')
+        sys.exit(1)
+
+    if async_ and cache_size is not None:
+        print('Conflict between --async and --cache. You cannot use both.')
+        sys.exit(1)
+
+    if locality_template is not None and (async_ or cache_size is not None):
+        print('--kube-locality cannot be used with --async or --cache.')
         sys.exit(1)
 
     parallel_opts = [x for x in parallel_opts if x is not None]
-    always_lines = [] if local_procs == 0 else ['%d/:' % local_procs]
+    staging_ = staging.make_staging(cfg, stage_inputs, scratch)
+    usage_key = sizing.usage_key(parallel_opts)
+    cpu, mem, parallelism, procs_per_pod = sizing.size_task(
+        usage_key, cpu, mem, parallelism, procs_per_pod, oom_risk, kube_auto
+    )
     cmd = ['parallel'] + parallel_opts
 
     if async_:
+        # the leader runs parallel, so there are no local jobslots
         session_start_share(cfg)
-        task_id = make_deployment(parallelism, cfg, mem, cpu, cwd, cmd)
-        make_leader(task_id, procs_per_pod, parallel_opts)
+        task_id = make_deployment(parallelism, cfg, mem, cpu, cwd, cmd, staging_, mount_options, async_=True)
+        make_leader(task_id, cfg, procs_per_pod, parallel_opts)
         print("Task started. View output with 'womm logs %s'." % task_id)
-    else:
-        with womm_session(cfg, mem, cpu, always_lines, parallelism, procs_per_pod, cmd) as sshloginfile:
-            cmd = [str(basedir / 'parallel'), '--sshloginfile', sshloginfile] + parallel_opts
-            sys.exit(subprocess.run(cmd, check=False).returncode)
+        return
+
+    with localpool.local_pool(cfg, local_procs) as always_lines:
+        if cache_size is not None:
+            sys.exit(cache.run_parallel(
+                cfg,
+                parallel_opts,
+                cache_size,
+                lambda: womm_session(
+                    cfg, mem, cpu, always_lines, parallelism, procs_per_pod, cmd, staging_=staging_,
+                    mount_options=mount_options
+                ),
+            ))
+        elif locality_template is not None:
+            sys.exit(run_locality(
+                cfg, mem, cpu, always_lines, parallelism, procs_per_pod, cmd, parallel_opts, locality_template,
+                staging_, usage_key, mount_options
+            ))
+        else:
+            with tempfile.TemporaryDirectory(prefix='womm-metrics-') as tmp, \
+                    metrics.exporter(parallel_opts, Path(tmp) / 'joblog') as metrics_, \
+                    womm_session(
+                        cfg, mem, cpu, always_lines, parallelism, procs_per_pod, cmd, staging_=staging_,
+                        usage_key=usage_key, metrics_=metrics_, mount_options=mount_options
+                    ) as sshloginfile:
+                metrics_.sshloginfile = sshloginfile
+                cmd = [str(basedir / 'parallel'), '--sshloginfile', sshloginfile] + metrics_.parallel_opts
+                metrics_.process = subprocess.Popen(cmd, env=sizing.record_env())
+                sys.exit(metrics_.process.wait())
+
+def run_locality(
+    cfg, mem, cpu, always_lines, parallelism, procs_per_pod, cmd, parallel_opts, template, staging_, usage_key,
+    mount_options
+):
+    with tempfile.TemporaryDirectory(prefix='womm-locality-') as tmp:
+        stdin_path = spool_stdin(Path(tmp) / 'stdin')
+        keys = locality.locality_keys(parallel_opts, template, stdin_path)
+
+        with locality.router(procs_per_pod, keys) as (pool, route_cmd):
+            def login_lines(live):
+                pool.update(live)
+                return [f'{len(live) * procs_per_pod}/{route_cmd}'] if live else []
+
+            with womm_session(
+                cfg, mem, cpu, always_lines, parallelism, procs_per_pod, cmd, login_lines, staging_, usage_key,
+                mount_options=mount_options
+            ) as sshloginfile, open(stdin_path or os.devnull, 'rb') as fp:
+                cmd = [str(basedir / 'parallel'), '--sshloginfile', sshloginfile] + parallel_opts
+                return subprocess.run(
+                    cmd, stdin=fp if stdin_path else None, env=sizing.record_env(), check=False
+                ).returncode
 
 def cmd_shell():
     cpu = '1000m'
@@ -339,35 +699,17 @@ def cmd_shell():
         cmd += [cfg['image']]
         try:
             subprocess.run(cmd, check=False)
-            r = subprocess.run(
-                ['docker', 'diff', tmp_container],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                check=False,
-            )
-            if r.stderr:
-                print(r.stderr)
-                sys.exit(1)
-            changed = {line.split()[1] for line in r.stdout.splitlines()}
-            blacklist = [
-                re.compile(rb'/\.bash_history$'),
-                re.compile(rb'/\.ash_history$'),
-                re.compile(rb'/\.zsh_history$'),
-                re.compile(rb'^/tmp/\.womm-env$'),
-            ]
-
-            for blacklist_line in blacklist:
-                while True:
-                    for changed_file in changed:
-                        if blacklist_line.search(changed_file):
-                            pathparts = changed_file.split(b'/')
-                            changed = {line for line in changed if line.split(b'/') != pathparts[:line.count(b'/') + 1]}
-                            break
-                    else:
-                        break
-
-            if changed:
-                print('It looks like you made changes to the container. Would you like to commit them? y/n')
+            root = changes.container_diff(tmp_container)
+            if changes.prune(root, changes.shell_patterns):
+                size = changes.measure(root, tmp_container)
+                if root.files:
+                    print(changes.breakdown(root))
+                    print()
+                if size is not None:
+                    print('It looks like you made %s of changes to the container. Would you like to commit them? y/n'
+                          % format_size(size))
+                else:
+                    print('It looks like you made changes to the container. Would you like to commit them? y/n')
                 if choice(['y', 'n'], 'y') == 'y':
                     subprocess.run(['docker', 'commit', tmp_container, cfg['image']], check=True)
                     subprocess.run(['docker', 'push', cfg['image']], check=True)
@@ -376,16 +718,16 @@ def cmd_shell():
     else:
         connection_test()
 
-        if not is_share_allocated(cfg['share_path']):
-            print("Error: server has rebooted. Please run `womm setup` to reinitialize share")
-            sys.exit(1)
-
         with womm_session(cfg, mem, cpu, [], 1, 1, ['shell']) as sshloginfile:
             with open(sshloginfile, 'r', encoding='utf-8') as fp:
                 cmd = fp.read().split('/', 1)[1].strip()
             subprocess.run(cmd, shell=True, check=False)
 
 def session_start_share(cfg):
+    ensure_share(cfg)
+    sync_share(cfg)
+
+def sync_share(cfg):
     if cfg['share_kind'] == 'eager-2':
         date1 = datetime.fromisoformat(
             subprocess.run(['date', '+%FT%T%:z', '-u'], stdout=subprocess.PIPE, check=True).stdout.strip().decode()
@@ -393,7 +735,7 @@ def session_start_share(cfg):
         tstart = datetime.now(timezone.utc)
         date2 = datetime.fromisoformat(
             subprocess.run(
-                ['kubectl', 'exec', 'deploy/womm-server', '--', 'date', '+%FT%T%:z', '-u'],
+                ['kubectl', 'exec', server_ref(cfg['share_path']), '--', 'date', '+%FT%T%:z', '-u'],
                 stdout=subprocess.PIPE,
                 check=True
             ).stdout.strip().decode()
@@ -405,18 +747,26 @@ def session_start_share(cfg):
                     "This is dangerous while sending your filesystem to the cloud eagerly with syncback.")
 
     if cfg['share_kind'] in ('eager-1', 'eager-2'):
+        rules = sharepolicy.load_rules()
+        lazy_paths = sharepolicy.lazy_paths(rules)
+        # anything which used to be lazy and isn't anymore has to be unmounted before rsync can fill it in
+        teardown_share(keep=[cwd + '/' + path for path in lazy_paths])
         subprocess.run(
             [
                 'rsync',
                 '-azq',
                 '-e',
-                '%s -m womm ssh deploy/womm-server' % sys.executable,
+                '%s -m womm ssh %s' % (sys.executable, server_ref(cfg['share_path'])),
                 '--delete',
+                '--exclude', '/' + state_dirname,
+            ] + sharepolicy.rsync_filters(rules) + [
                 cwd + '/',
                 ':' + cfg['share_path'],
             ],
             check=True
         )
+        for path in lazy_paths:
+            setup_lazy_share(cfg['share_path'] + '/' + path, cwd + '/' + path)
     elif cfg['share_kind'] == 'lazy':
         setup_lazy_share(cfg['share_path'], cwd)
 
@@ -427,7 +777,9 @@ def session_finish_share(cfg):
                 'rsync',
                 '-azqu',
                 '-e',
-                '%s -m womm ssh deploy/womm-server' % sys.executable,
+                '%s -m womm ssh %s' % (sys.executable, server_ref(cfg['share_path'])),
+                '--exclude', '/' + state_dirname,
+            ] + sharepolicy.rsync_filters(sharepolicy.load_rules()) + [
                 # it would be really nice to put --delete here but that is SUCH a footgun
                 ':' + cfg['share_path'] + '/',
                 cwd,
@@ -444,49 +796,291 @@ def womm_session(
     kube_pods,
     procs_per_pod,
     cmd,
+    login_lines=None,
+    staging_=None,
+    usage_key=None,
+    metrics_=None,
+    mount_options=None,
 ):
-    session_start_share(cfg)
-    task_id = make_deployment(kube_pods, cfg, mem, cpu, cwd, cmd)
+    ensure_share(cfg)
+    start = time.time()
+
+    def sync():
+        sync_share(cfg)
+        return time.time()
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        # while an eager share syncs, the pods can be scheduled, pull the image and mount the share. lazy shares have
+        # to be mounted on the server before anything mounts them from it, though, and staged inputs are copied out of
+        # the share as soon as the pods start.
+        synced = pool.submit(sync)
+        if cfg['share_kind'] not in ('eager-1', 'eager-2') or staging_ is not None and staging_.inputs:
+            synced.result()
+        task_id = make_deployment(kube_pods, cfg, mem, cpu, cwd, cmd, staging_, mount_options)
+        created = time.time()
+        if metrics_ is not None:
+            # for `womm metrics`
+            annotate('deploy/womm-task-' + task_id, 'womm-metrics-port', metrics_.port)
 
+        try:
+            with heartbeat('deploy/womm-task-' + task_id, cfg['share_path'] if cfg['share_kind'] != 'none' else None), \
+                    fair_share(task_id), \
+                    watch_deployment(task_id, always_lines, procs_per_pod, login_lines, synced, start) as sshloginfile:
+                yield sshloginfile
+        finally:
+            if usage_key is not None:
+                sizing.collect(task_id, usage_key, cpu, mem, kube_pods, procs_per_pod, created)
+            sync_error = synced.exception()
+            if staging_ is not None and staging_.scratch is not None:
+                # the pods' uploaders have to be done before there's anything to sync back
+                delete_deployment(task_id, wait_pods=True)
+                if sync_error is None:
+                    session_finish_share(cfg)
+            else:
+                deleted = pool.submit(delete_deployment, task_id)
+                if sync_error is None:
+                    session_finish_share(cfg)
+                deleted.result()
+            if sync_error is not None:
+                raise sync_error
+
+def leader_state_dir(task_id):
+    # the leader job mounts the share here, so that everything survives the leader pod going away
+    if os.path.ismount('/womm-share'):
+        return Path('/womm-share') / state_dirname / task_id
+    return Path('/tmp/womm-state')
+
+def leader_share_path():
+    # the share the leader job mounts at /womm-share, if there is one
     try:
-        with watch_deployment(task_id, always_lines, procs_per_pod) as sshloginfile:
-            yield sshloginfile
-    finally:
-        delete_deployment(task_id)
-        session_finish_share(cfg)
+        with open('/proc/mounts', 'r', encoding='utf-8') as fp:
+            for line in fp:
+                source, target = line.split()[:2]
+                if target == '/womm-share':
+                    return source.partition(':')[2]
+    except FileNotFoundError:
+        pass
+    return None
+
+def leader_log_dir(task_id):
+    return leader_state_dir(task_id) / 'logs'
 
 def cmd_leader():
     task_id = sys.argv[2]
-    procs_per_pod = sys.argv[3]
-    parallel_opts = sys.argv[4:]
+    resumed = sys.argv[3:] == ['--resume']
+    state_dir = leader_state_dir(task_id)
+    state_dir.mkdir(parents=True, exist_ok=True)
 
-    with watch_deployment(task_id, [], procs_per_pod) as sshloginfile:
-        cmd = [str(basedir / 'parallel'), '--sshloginfile', sshloginfile] + parallel_opts
-        subprocess.run(cmd, check=False)
+    try:
+        with open(state_dir / 'args.json', 'r', encoding='utf-8') as fp:
+            procs_per_pod, parallel_opts = json.load(fp)
+        print('Resuming task %s' % task_id)
+    except FileNotFoundError:
+        if resumed:
+            print("Can't resume %s: its first leader died before saving its arguments. Start it again." % task_id)
+            sys.exit(1)
+        procs_per_pod = sys.argv[3]
+        parallel_opts = sys.argv[4:]
+        with open(state_dir / 'args.json.part', 'w', encoding='utf-8') as fp:
+            json.dump([procs_per_pod, parallel_opts], fp)
+        os.rename(state_dir / 'args.json.part', state_dir / 'args.json')
+
+    if not (state_dir / 'stdin').exists():
+        if resumed:
+            # nobody is attached to our stdin to give it to us again
+            print("Can't resume %s: its first leader died before it had all of its input. Start it again." % task_id)
+            sys.exit(1)
+        # this is the first leader and the client is attached to our stdin
+        with open(state_dir / 'stdin.part', 'wb') as fp:
+            for chunk in iter(lambda: sys.stdin.buffer.read(1024 * 1024), b''):
+                fp.write(chunk)
+        os.rename(state_dir / 'stdin.part', state_dir / 'stdin')
+
+    if not (state_dir / 'done').exists():
+        log_dir = leader_log_dir(task_id)
+        logstore.hold_lock(log_dir)
+        # the joblog is our checkpoint. --resume skips every job which made it in there
+        parallel_opts = ['--joblog', str(state_dir / 'joblog'), '--resume'] + parallel_opts
+        with heartbeat('job/womm-leader-' + task_id, leader_share_path()), \
+                fair_share(task_id), \
+                watch_deployment(task_id, [], procs_per_pod) as sshloginfile, \
+                open(state_dir / 'stdin', 'rb') as fp, \
+                metrics.exporter(parallel_opts, state_dir / 'joblog', '0.0.0.0', metrics.leader_port) as metrics_:
+            metrics_.sshloginfile = sshloginfile
+            cmd = [str(basedir / 'parallel'), '--sshloginfile', sshloginfile] + metrics_.parallel_opts
+            p = subprocess.Popen(cmd, stdin=fp, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            metrics_.process = p
+            logstore.record_process(log_dir, p)
+        (state_dir / 'done').touch()
 
     delete_deployment(task_id)
+    annotate('job/womm-leader-' + task_id, 'womm-completed', int(time.time()))
 
-def cmd_logs():
-    try:
-        task_id = sys.argv[2]
-    except IndexError:
-        task_id = '-'
+def usage_resume():
+    print("""\
+Usage: womm resume <id>
+
+Start a new leader for an async task whose leader has gone away. It picks up after the last job which completed.
+""")
+    sys.exit(0)
+
+def cmd_resume():
+    args = sys.argv[2:]
+    if len(args) != 1 or args[0].startswith('-'):
+        usage_resume()
+    task_id = args[0]
+
+    cfg = cfg_load()
+    if cfg is None:
+        print("Error: please run `womm setup` to initialize the current directory")
+        sys.exit(1)
+
+    if cfg['share_kind'] == 'none':
+        print("Tasks can only be resumed if the directory is shared, since that's where their checkpoints live.")
+        sys.exit(1)
 
-    if task_id.startswith('-'):
-        print('Usage: womm logs [id]')
+    connection_test()
+    deploy = subprocess.run(
+        ['kubectl', 'get', 'deploy', 'womm-task-' + task_id, '-o', 'json'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+    if deploy.returncode != 0:
+        print("No deployment for %s. Either it doesn't exist or it has already completed." % task_id)
+        sys.exit(1)
+    annotations = json.loads(deploy.stdout.decode())['metadata']['annotations']
+    if annotations['womm-host'] != hostname or annotations['womm-cwd'] != cwd:
+        print('%s is in the wrong directory (%s:%s).' % (task_id, annotations['womm-host'], annotations['womm-cwd']))
         sys.exit(1)
 
-    for line in subprocess.run(
-        ['kubectl', 'get', 'pods', '-o', 'custom-columns=NAME:.metadata.name,STATUS:.status.phase'],
+    active = subprocess.run(
+        ['kubectl', 'get', 'job', 'womm-leader-' + task_id, '-o', 'jsonpath', '--template', '{.status.active}'],
         stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    ).stdout.decode().strip()
+    if active not in ('', '0'):
+        print('The leader for %s is still running. Nothing to do.' % task_id)
+        sys.exit(1)
+
+    subprocess.run(
+        ['kubectl', 'delete', 'job', 'womm-leader-' + task_id, '--ignore-not-found'],
         check=True,
-    ).stdout.splitlines():
-        name, status = line.decode().split()
-        if name.startswith('womm-leader-%s-' % task_id):
-            break
+        stdout=sys.stderr,
+    )
+    make_leader(task_id, cfg, None, [], cmd_str=annotations['womm-cmd'].replace('"', '\\"'))
+    print("Task resumed. View output with 'womm logs %s'." % task_id)
+
+def cmd_attach():
+    # runs inside the leader pod on behalf of `womm logs`
+    task_id = sys.argv[2]
+    mode = sys.argv[3]
+    log_dir = leader_log_dir(task_id)
+    stream_dirs = [log_dir / stream for stream in logstore.streams]
+
+    if mode == '--offsets':
+        offsets = [int(x) for x in sys.argv[4:6]]
+    elif mode == '--tail':
+        offsets = [logstore.offset_for_tail(d, int(sys.argv[4])) for d in stream_dirs]
+    elif mode == '--since':
+        since = time.time() - float(sys.argv[4])
+        offsets = [logstore.offset_for_time(d, since) for d in stream_dirs]
     else:
+        offsets = [0, 0]
+
+    done = logstore.completion_event(log_dir)
+    threads = [
+        threading.Thread(target=logstore.follow, args=(d, offset, out, done), daemon=True)
+        for d, offset, out in zip(stream_dirs, offsets, (sys.stdout.buffer, sys.stderr.buffer))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    sys.exit(0 if (log_dir / 'complete').exists() else 2)
+
+def usage_logs():
+    print("""\
+Usage: womm logs [options] <id>
+
+By default, picks up where the last `womm logs` for this task left off.
+
+Options:
+  --tail N            Start from the last N lines of each stream
+  --since N           Start from output produced in the last N seconds (or Nm, Nh, Nd)
+  --all               Start from the beginning
+  --help              Show this message :)
+""")
+    sys.exit(0)
+
+def duration_arg(s, arg):
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    try:
+        if s and s[-1] in units:
+            return float(s[:-1]) * units[s[-1]]
+        return float(s)
+    except ValueError:
+        print('Expected duration argument to %s, got %s' % (arg, s))
+        sys.exit(1)
+
+def copy_counting(pipe, out, counts, idx):
+    while True:
+        data = os.read(pipe.fileno(), 65536)
+        if not data:
+            break
+        out.write(data)
+        out.flush()
+        counts[idx] += len(data)
+
+def cmd_logs():
+    args = sys.argv[2:]
+    mode = None
+    task_id = None
+    iterable = iter(args)
+    for arg in iterable:
+        if arg.startswith('--tail='):
+            mode = ['--tail', str(int_arg(arg.split('=', 1)[1], '--tail'))]
+        elif arg == '--tail':
+            mode = ['--tail', str(int_arg(next_arg(iterable, '--tail'), '--tail'))]
+        elif arg.startswith('--since='):
+            mode = ['--since', str(duration_arg(arg.split('=', 1)[1], '--since'))]
+        elif arg == '--since':
+            mode = ['--since', str(duration_arg(next_arg(iterable, '--since'), '--since'))]
+        elif arg == '--all':
+            mode = ['--all']
+        elif arg.startswith('-') or task_id is not None:
+            usage_logs()
+        else:
+            task_id = arg
+
+    if task_id is None:
+        usage_logs()
+
+    offsets_file = log_offsets_path / task_id
+    if mode is None:
+        try:
+            with open(offsets_file, 'r', encoding='utf-8') as fp:
+                mode = ['--offsets'] + fp.read().split()
+        except FileNotFoundError:
+            mode = ['--all']
+
+    # the newest leader pod, in case an earlier one was evicted
+    status = subprocess.run(
+        [
+            'kubectl', 'get', 'pods',
+            '-l', 'job-name=womm-leader-' + task_id,
+            '--sort-by', '.metadata.creationTimestamp',
+            '-o', 'jsonpath', '--template', '{range .items[*]}{.status.phase}{"\\n"}{end}',
+        ],
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout.decode().split()
+    if not status:
         print('No such id %s' % task_id)
         sys.exit(1)
+    status = status[-1]
 
     if status == 'Pending':
         print("Leader process hasn't started yet. Sit tight!")
@@ -495,13 +1089,43 @@ def cmd_logs():
         print("Leader process has status %s. What are you trying to do?" % status)
         sys.exit(1)
 
+    if mode[0] == '--offsets':
+        counts = [int(x) for x in mode[1:]]
+    else:
+        counts = None
+
+    p = subprocess.Popen(
+        ['kubectl', 'exec', 'jobs/womm-leader-' + task_id, '--', 'python3', '-m', 'womm', 'attach', task_id] + mode,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    received = [0, 0]
+    threads = [
+        threading.Thread(target=copy_counting, args=(pipe, out, received, idx), daemon=True)
+        for idx, (pipe, out) in enumerate(((p.stdout, sys.stdout.buffer), (p.stderr, sys.stderr.buffer)))
+    ]
+    for thread in threads:
+        thread.start()
     try:
-        subprocess.run(
-            ['kubectl', 'exec', 'jobs/womm-leader-' + task_id, '--', '/opt/womm/attach.sh', task_id],
-            check=False
-        )
+        code = p.wait()
+        for thread in threads:
+            thread.join()
     except KeyboardInterrupt:
-        pass
+        code = None
+        p.kill()
+
+    # with --tail/--since we don't know where we started in absolute terms, so only remember the position if we did
+    if counts is not None or mode[0] == '--all':
+        counts = counts or [0, 0]
+        log_offsets_path.mkdir(exist_ok=True)
+        with open(offsets_file, 'w', encoding='utf-8') as fp:
+            fp.write('%d %d\n' % (counts[0] + received[0], counts[1] + received[1]))
+
+    if code == 0:
+        print("Task completed. Run 'womm finish %s' to clean up when you're done with the logs." % task_id,
+              file=sys.stderr)
+    elif code == 2:
+        print("The leader process went away before finishing. Uh oh!", file=sys.stderr)
 
 def usage_finish():
     print("""\
@@ -532,9 +1156,13 @@ def cmd_finish():
     else:
         cfg = None
 
+    if not args:
+        usage_finish()
+
     connection_test()
-    datas = get_status()
+    datas = get_status(args)
 
+    task_ids = []
     for task_id in args:
         if task_id not in datas:
             print(task_id, 'not found. Skipping.')
@@ -544,20 +1172,27 @@ def cmd_finish():
         if not force and (data.host != hostname or data.cwd != cwd):
             print(task_id, '%s is in the wrong directory (%s:%s). Skipping.' % (task_id, data.host, data.cwd))
             continue
+        task_ids.append(task_id)
 
-        subprocess.run(
-            [
-                'kubectl',
-                'delete',
-                'jobs/womm-leader-' + task_id,
-                'deploy/womm-task-' + task_id,
-                '--ignore-not-found',
-            ],
-            check=True
-        )
+    if not task_ids:
+        return
+    delete_tasks(task_ids)
 
-        if not force:
-            session_finish_share(cfg)
+    if not force:
+        session_finish_share(cfg)
+        if cfg['share_kind'] != 'none':
+            subprocess.run(
+                ['kubectl', 'exec', '-i', server_ref(cfg['share_path']), '--', 'rm', '-rf']
+                + ['%s/%s/%s' % (cfg['share_path'], state_dirname, task_id) for task_id in task_ids],
+                stdin=subprocess.DEVNULL,
+                check=False,
+            )
+
+    for task_id in task_ids:
+        try:
+            os.unlink(log_offsets_path / task_id)
+        except FileNotFoundError:
+            pass
 
 RawMetadata = namedtuple('RawMetadata', (
     'async_',
@@ -570,107 +1205,279 @@ RawMetadata = namedtuple('RawMetadata', (
     'created_time',
     'cpu',
     'mem',
+    'heartbeat',
+    'completed',
+    'requested_instances',
+    'granted_instances',
+    'leader_pods',
+    'leader_ready',
+    'leader_failed',
 ))
 
-def get_status():
-    jobs = subprocess.run(['kubectl', 'get', 'jobs', '-o', 'json'], stdout=subprocess.PIPE, check=True).stdout
-    deploy = subprocess.run(['kubectl', 'get', 'deploy', '-o', 'json'], stdout=subprocess.PIPE, check=True).stdout
-
-    jobs = json.loads(jobs.decode())
-    deploy = json.loads(deploy.decode())
-
-    jobs = {
-        item['metadata']['name'].split('-')[2]: item
-        for item in jobs['items']
-        if item['metadata']['name'].startswith('womm-leader-')
-    }
-    deploy = {
-        item['metadata']['name'].split('-')[2]: item
-        for item in deploy['items']
-        if item['metadata']['name'].startswith('womm-task-')
-    }
+# the fields of a job or deployment which status needs, so that's all we ask kubectl for. the command goes last since
+# it's the only one which might contain a tab.
+StatusObject = namedtuple('StatusObject', (
+    'kind',
+    'task_id',
+    'created_time',
+    'replicas',
+    'ready_replicas',
+    'cpu',
+    'mem',
+    'host',
+    'cwd',
+    'controller_pid',
+    'heartbeat',
+    'completed',
+    'requested',
+    'granted',
+    'active',
+    'ready',
+    'failed',
+    'cmd',
+))
+status_fields = (
+    '.kind',
+    '.metadata.labels.womm_task',
+    '.metadata.creationTimestamp',
+    '.spec.replicas',
+    '.status.readyReplicas',
+    '.spec.template.spec.containers[0].resources.requests.cpu',
+    '.spec.template.spec.containers[0].resources.requests.memory',
+    '.metadata.annotations.womm-host',
+    '.metadata.annotations.womm-cwd',
+    '.metadata.annotations.womm-controller-pid',
+    '.metadata.annotations.womm-heartbeat',
+    '.metadata.annotations.womm-completed',
+    '.metadata.annotations.womm-requested-pods',
+    '.metadata.annotations.womm-granted-pods',
+    '.status.active',
+    '.status.ready',
+    '.status.failed',
+    '.metadata.annotations.womm-cmd',
+)
+status_template = '{range .items[*]}' + '{"\\t"}'.join('{%s}' % f for f in status_fields) + '{"\\n"}{end}'
+
+def json_field(item, field):
+    # the tiny subset of jsonpath which status_fields uses
+    for name, index in re.findall(r'\.([\w-]+)(?:\[(\d+)\])?', field):
+        item = item.get(name) if isinstance(item, dict) else None
+        if index:
+            item = item[int(index)] if isinstance(item, list) and len(item) > int(index) else None
+    return '' if item is None else str(item)
+
+def merge_status(objects):
+    jobs = {obj.task_id: obj for obj in objects if obj.kind == 'Job'}
+    deploy = {obj.task_id: obj for obj in objects if obj.kind == 'Deployment'}
 
     results = {}
-
     for task_id in set(jobs) | set(deploy):
-        job_item = jobs.get(task_id, None)
-        deploy_item = deploy.get(task_id, None)
-
-        if job_item:
-            labels = job_item['metadata']['annotations']
-            created_time = job_item['metadata']['creationTimestamp']
-        else:
-            labels = deploy_item['metadata']['annotations']
-            created_time = deploy_item['metadata']['creationTimestamp']
-
-        async_ = job_item is not None
-        host = labels['womm-host']
-        job_cwd = labels['womm-cwd']
-        controller_pid = labels['womm-controller-pid']
-        cmd = labels['womm-cmd']
-        created_time = dateutil.parser.parse(created_time)
-
-        if deploy_item:
-            running_instances = deploy_item['status'].get('readyReplicas', 0)
-            target_instances = deploy_item['spec']['replicas']
-            cpu = deploy_item['spec']['template']['spec']['containers'][0]['resources']['requests']['cpu']
-            mem = deploy_item['spec']['template']['spec']['containers'][0]['resources']['requests']['memory']
-        else:
-            running_instances = 0
-            target_instances = 0
-            cpu = '0'
-            mem = '0'
+        job_obj = jobs.get(task_id, None)
+        deploy_obj = deploy.get(task_id, None)
+        obj = job_obj or deploy_obj
 
         results[task_id] = RawMetadata(
-            async_=async_,
-            host=host,
-            cwd=job_cwd,
-            controller_pid=int(controller_pid),
-            cmd=cmd,
-            running_instances=running_instances,
-            target_instances=target_instances,
-            created_time=created_time,
-            cpu=cpu,
-            mem=mem,
+            async_=job_obj is not None,
+            host=obj.host,
+            cwd=obj.cwd,
+            controller_pid=int(obj.controller_pid or 0),
+            cmd=obj.cmd,
+            running_instances=int(deploy_obj.ready_replicas or 0) if deploy_obj else 0,
+            target_instances=int(deploy_obj.replicas or 0) if deploy_obj else 0,
+            created_time=dateutil.parser.parse(obj.created_time),
+            cpu=deploy_obj.cpu if deploy_obj else '0',
+            mem=deploy_obj.mem if deploy_obj else '0',
+            heartbeat=float(obj.heartbeat or 0),
+            completed=float(obj.completed or 0),
+            # tasks from before admission got all they asked for
+            requested_instances=int(deploy_obj.requested or deploy_obj.replicas or 0) if deploy_obj else 0,
+            granted_instances=int(deploy_obj.granted or deploy_obj.replicas or 0) if deploy_obj else 0,
+            # the leader's pods which exist, running or not, the ones which are running, and the ones which died
+            leader_pods=int(job_obj.active or 0) if job_obj else 0,
+            leader_ready=int(job_obj.ready or 0) if job_obj else 0,
+            leader_failed=int(job_obj.failed or 0) if job_obj else 0,
         )
 
     return results
 
-def cmd_status():
-    all_hosts = '-A' in sys.argv
+def get_status(task_ids=None):
+    # everything womm creates is labelled with its task id, so the server only sends us our own objects
+    selector = 'womm_task' if task_ids is None else 'womm_task in (%s)' % ','.join(task_ids)
+    output = subprocess.run(
+        ['kubectl', 'get', 'deploy,jobs', '-l', selector, '-o', 'jsonpath', '--template', status_template],
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout.decode()
+
+    objects = [
+        StatusObject(*line.split('\t', len(status_fields) - 1))
+        for line in output.splitlines()
+        if line.count('\t') >= len(status_fields) - 1
+    ]
+    results = merge_status(objects)
+    missing = [task_id for task_id in task_ids or () if task_id not in results]
+    if missing:
+        results.update(get_status_by_name(missing))
+    return results
 
-    results = get_status()
+def get_status_by_name(task_ids):
+    # tasks from before everything was labelled can still be found by name. asking for two or more objects by name
+    # always gets a list back, even if only one of them exists.
+    output = subprocess.run(
+        ['kubectl', 'get', '--ignore-not-found', '-o', 'json']
+        + ['deploy/womm-task-' + task_id for task_id in task_ids]
+        + ['job/womm-leader-' + task_id for task_id in task_ids],
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout.decode()
+    objects = []
+    for item in json.loads(output or '{}').get('items', []):
+        obj = StatusObject(*(json_field(item, field) for field in status_fields))
+        # womm-task-<id> or womm-leader-<id>
+        objects.append(obj._replace(task_id=item['metadata']['name'].split('-', 2)[2]))
+    return merge_status(objects)
+
+def task_state(data, timeout=None):
+    # the leader deletes the deployment when it's done. a deployment with no replicas is waiting for its share.
+    if data.async_ and (data.completed or not data.requested_instances):
+        return 'COMPLETE'
+    if data.heartbeat:
+        # an async leader might still be waiting for a node, so give it the benefit of the doubt for longer
+        alive = time.time() - data.heartbeat < (timeout or heartbeat_timeout * (3 if data.async_ else 1))
+        if alive:
+            return 'RUNNING'
+        if data.async_ and not data.leader_ready and (data.leader_pods or not data.leader_failed):
+            # its leader is waiting for a node, or for room in the quota to be created at all
+            return 'QUEUED'
+        if data.async_ and data.leader_ready and data.heartbeat - data.created_time.timestamp() < heartbeat_interval:
+            # a leader which is running but has never got a heartbeat through, most likely because its role is too old
+            # to let it. there's no telling whether it's stuck, so it's left alone.
+            return 'RUNNING'
+        return 'ORPHANED'
+    # from before heartbeats. all we can do is check the controller, if it's ours
+    if data.async_:
+        return 'RUNNING'
+    if data.host != hostname:
+        return 'UNKNOWN'
+    if psutil.pid_exists(data.controller_pid):
+        return 'RUNNING'
+    return 'ORPHANED'
+
+def status_table(results, all_hosts):
     output = []
-    for task_id, data in results.items():
+    queue = admission.queue_positions(results)
+    for task_id, data in sorted(results.items(), key=lambda item: item[1].created_time):
         if not all_hosts and data.host != hostname:
             continue
 
-        if data.async_ and data.target_instances == 0:
-            status = 'COMPLETE'
-        elif data.async_:
-            status = 'RUNNING'
-        elif data.host != hostname:
-            status = 'UNKNOWN'
-        elif psutil.pid_exists(data.controller_pid):
-            status = 'RUNNING'
-        else:
-            status = 'ORPHANED'
-
+        status = task_state(data)
         health = f'{data.running_instances}/{data.target_instances}'
         age = relative_date_fmt(data.created_time)
 
         columns = [task_id, age, status, data.cpu, data.mem, health]
         if all_hosts:
-            columns.append(data.host)
+            granted = f'{data.granted_instances}/{data.requested_instances}' if data.requested_instances else '-'
+            columns.extend([granted, queue.get(task_id, '-'), data.host])
         columns.extend([data.cwd, data.cmd])
         output.append(columns)
 
     headers = ['ID', 'AGE', 'STATUS', 'CPU', 'MEM', 'HEALTH']
     if all_hosts:
-        headers.append('HOST')
+        headers.extend(['GRANTED', 'QUEUE', 'HOST'])
     headers.extend(['PWD', 'COMMAND'])
 
-    print(tabulate(output, headers=headers))
+    return tabulate(output, headers=headers)
+
+def status_watcher(kind, objects, cond):
+    # keeps objects up to date with every womm object of one kind. kubectl can only watch one kind at a time.
+    while True:
+        p = subprocess.Popen(
+            ['kubectl', 'get', kind, '-l', 'womm_task', '--watch', '--output-watch-events', '-o', 'json'],
+            stdout=subprocess.PIPE,
+        )
+        decoder = json.JSONDecoder()
+        text = codecs.getincrementaldecoder('utf-8')()
+        buf = ''
+        seen = set()
+        for chunk in iter(lambda: os.read(p.stdout.fileno(), 65536), b''):  # pylint: disable=cell-var-from-loop
+            buf += text.decode(chunk)
+            while True:
+                buf = buf.lstrip()
+                try:
+                    event, end = decoder.raw_decode(buf)
+                except ValueError:
+                    break
+                buf = buf[end:]
+                if event.get('type') not in ('ADDED', 'MODIFIED', 'DELETED'):
+                    continue
+                obj = StatusObject(*(json_field(event['object'], field) for field in status_fields))
+                with cond:
+                    if event['type'] == 'DELETED':
+                        objects.pop((obj.kind, obj.task_id), None)
+                    else:
+                        objects[(obj.kind, obj.task_id)] = obj
+                    seen.add((obj.kind, obj.task_id))
+                    cond.notify_all()
+        p.wait()
+
+        # the server ends watches every so often. whatever went away in the meantime won't be in the new listing.
+        with cond:
+            for key in [key for key in objects if key not in seen and key[0].lower() in kind]:
+                del objects[key]
+            cond.notify_all()
+        time.sleep(1)
+
+def redraw(lines, previous):
+    # only rewrite the lines which changed since last time
+    for i, line in enumerate(lines):
+        if i >= len(previous) or previous[i] != line:
+            sys.stdout.write('\x1b[%d;1H%s\x1b[K' % (i + 1, line))
+    if len(lines) < len(previous):
+        sys.stdout.write('\x1b[%d;1H\x1b[J' % (len(lines) + 1))
+    sys.stdout.flush()
+    return lines
+
+def watch_status(all_hosts):
+    objects = {}
+    cond = threading.Condition()
+    for kind in ('deployments', 'jobs'):
+        threading.Thread(target=status_watcher, args=(kind, objects, cond), daemon=True).start()
+
+    previous = []
+    sys.stdout.write('\x1b[H\x1b[2J')
+    try:
+        while True:
+            with cond:
+                # nothing to do with the server - the ages in the table tick over even when nothing happens
+                cond.wait(1)
+                snapshot = list(objects.values())
+            previous = redraw(status_table(merge_status(snapshot), all_hosts).splitlines(), previous)
+    except KeyboardInterrupt:
+        sys.stdout.write('\x1b[%d;1H' % (len(previous) + 1))
+
+def cmd_status():
+    all_hosts = '-A' in sys.argv
+
+    if '--watch' in sys.argv or '-w' in sys.argv:
+        watch_status(all_hosts)
+        return
+
+    print(status_table(get_status(), all_hosts))
+
+    cfg = cfg_load()
+    if cfg is not None and cfg['share_kind'] != 'none':
+        info = share_info(cfg['share_path'])
+        if info is not None:
+            used, quota, last_used, read_only = info
+            print('\nShare: %s, %s used%s, last used %s ago%s' % (
+                cfg['share_path'],
+                format_size(used),
+                ' of %s' % format_size(quota) if quota else '',
+                relative_date_fmt(datetime.fromtimestamp(last_used, timezone.utc)),
+                ' (over quota, read-only)' if read_only else '',
+            ))
+        elif not is_share_allocated(cfg['share_path']):
+            print('\nShare: %s (evicted, will be reallocated on next use)' % cfg['share_path'])
 
 def relative_date_fmt(d):
     diff = datetime.now(timezone.utc) - d
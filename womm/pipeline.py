@@ -0,0 +1,222 @@
+# `womm pipeline`: several steps of parallel jobs on one set of pods, each feeding the next as it goes.
+#
+# every step is its own gnu parallel, with its own sshloginfile giving it its own jobslots on each pod. each line a
+# step prints is an item for the next step, and is handed over as soon as it's printed, through a bounded queue. when
+# the queue is full we stop reading from the step before it, so its output backs up and parallel stops starting jobs
+# until the next step catches up.
+import threading
+import tempfile
+import queue
+import time
+
+from tabulate import tabulate
+
+from .common import *  # pylint: disable=wildcard-import,unused-wildcard-import
+from .parallel import womm_session, int_arg, next_arg, fmt_seconds
+
+default_buffer = 1000
+report_interval = 30
+
+def usage_pipeline():
+    print("""\
+Usage: womm pipeline [options] --step N:CMD --step N:CMD ... -- [input sources]
+
+Runs each CMD with gnu parallel, all on the same pods. The first step gets its arguments from the
+input sources (::: and :::: as for parallel) or stdin, and every line a step prints becomes an
+argument for the next step as soon as it's printed. The last step prints to stdout.
+
+Options:
+  --step N:CMD        Add a step which runs CMD with N jobslots per pod. Give it once per step, in order
+  --kube-pods N       Spin up N pods to dispatch jobs to
+  --kube-cpu N        Reserve N cpus per pod, for all of its steps together (default 1)
+  --kube-mem N        Reserve N memory per pod, for all of its steps together (default 512Mi)
+  --buffer N          Let at most N items wait between two steps before holding up the earlier one
+                      (default 1000)
+  --help              Show this message :)
+
+Other options will be interpreted by every step's gnu parallel.
+""")
+    sys.exit(0)
+
+class Step:
+    def __init__(self, spec, buffer):
+        slots, _, self.command = spec.partition(':')
+        if not slots.isdigit() or int(slots) < 1 or not self.command.strip():
+            print('Expected --step N:CMD, with N jobslots per pod, got %s' % spec)
+            sys.exit(1)
+        self.slots = int(slots)
+        self.name = self.command.split()[0]
+        self.login_file = tempfile.NamedTemporaryFile('w', encoding='utf-8')  # pylint: disable=consider-using-with
+        # items from the step before, waiting to be handed to this one
+        self.queue = queue.Queue(buffer)
+        self.process = None
+        self.items_in = 0
+        self.items_out = 0
+        self.peak_backlog = 0
+        self.finished = None
+
+    def write_logins(self, live):
+        self.login_file.seek(0)
+        self.login_file.truncate()
+        self.login_file.write(''.join(f'{self.slots}/{sys.executable} -m womm ssh {pod}\n' for pod in live))
+        self.login_file.flush()
+
+    def put(self, item):
+        self.queue.put(item)
+        self.peak_backlog = max(self.peak_backlog, self.queue.qsize())
+
+def pump(step, next_step):
+    # from step's output into the queue in front of next_step, or to stdout after the last step
+    for line in step.process.stdout:
+        if not line.endswith(b'\n'):
+            line += b'\n'
+        step.items_out += 1
+        if next_step is None:
+            sys.stdout.buffer.write(line)
+            sys.stdout.flush()
+        else:
+            next_step.put(line)
+    step.finished = time.time()
+    if next_step is not None:
+        next_step.put(None)
+
+def feed(step):
+    broken = False
+    while True:
+        item = step.queue.get()
+        if item is None:
+            break
+        step.items_in += 1
+        if broken:
+            # keep draining, so that the step before doesn't hang on a full queue
+            continue
+        try:
+            step.process.stdin.write(item)
+            if step.queue.empty():
+                step.process.stdin.flush()
+        except OSError:
+            broken = True
+    try:
+        step.process.stdin.close()
+    except OSError:
+        pass
+
+def report(steps, start, done):
+    previous = [0] * len(steps)
+    last = start
+    while not done.wait(report_interval):
+        now = time.time()
+        parts = []
+        for i, step in enumerate(steps):
+            rate = (step.items_out - previous[i]) / (now - last)
+            previous[i] = step.items_out
+            part = '%s %d out (%.1f/s)' % (step.name, step.items_out, rate)
+            if i:
+                part = '%s, %d waiting' % (part, step.queue.qsize())
+            parts.append(part)
+        last = now
+        print('womm: %s: %s' % (fmt_seconds(now - start), ' | '.join(parts)), file=sys.stderr)
+
+def summary(steps, start):
+    output = []
+    for i, step in enumerate(steps):
+        elapsed = max((step.finished or time.time()) - start, 1e-9)
+        output.append([
+            i + 1,
+            step.name,
+            step.slots,
+            step.items_in if i else '-',
+            step.items_out,
+            '%.1f' % (step.items_out / elapsed),
+            step.peak_backlog if i else '-',
+        ])
+    return tabulate(
+        output,
+        headers=['STEP', 'COMMAND', 'SLOTS/POD', 'IN', 'OUT', 'OUT/S', 'PEAK BACKLOG'],
+        disable_numparse=True,
+    )
+
+def cmd_pipeline():
+    parallelism = 0
+    cpu = '1000m'
+    mem = '512Mi'
+    buffer = default_buffer
+    specs = []
+    parallel_opts = []
+    sources = []
+
+    iterable = iter(sys.argv[2:])
+    for opt in iterable:
+        name, eq, value = opt.partition('=')
+        if opt == '--':
+            sources = list(iterable)
+            break
+        if opt in ('--help', '-h', '-?'):
+            usage_pipeline()
+        if name not in ('--step', '--kube-pods', '--kube-cpu', '--kube-mem', '--buffer'):
+            parallel_opts.append(opt)
+            continue
+        if not eq:
+            value = next_arg(iterable, name)
+        if name == '--step':
+            specs.append(value)
+        elif name == '--kube-pods':
+            parallelism = int_arg(value, name)
+        elif name == '--kube-cpu':
+            cpu = value
+        elif name == '--kube-mem':
+            mem = value
+        elif name == '--buffer':
+            buffer = max(1, int_arg(value, name))
+
+    if not specs:
+        usage_pipeline()
+    if parallelism == 0:
+        print("Error: must specify --kube-pods")
+        sys.exit(1)
+
+    cfg = cfg_load()
+    if cfg is None:
+        print("Error: please run `womm setup` to initialize the current directory")
+        sys.exit(1)
+    connection_test()
+
+    steps = [Step(spec, buffer) for spec in specs]
+    procs_per_pod = sum(step.slots for step in steps)
+
+    def login_lines(live):
+        for step in steps:
+            step.write_logins(live)
+        return [f'{procs_per_pod}/{sys.executable} -m womm ssh {pod}' for pod in live]
+
+    cmd = ['pipeline'] + [step.command for step in steps]
+    with womm_session(cfg, mem, cpu, [], parallelism, procs_per_pod, cmd, login_lines):
+        start = time.time()
+        threads = []
+        for i, step in enumerate(steps):
+            step.process = subprocess.Popen(  # pylint: disable=consider-using-with
+                [str(basedir / 'parallel'), '--sshloginfile', step.login_file.name] + parallel_opts
+                + [step.command] + (sources if i == 0 else []),
+                stdin=None if i == 0 else subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+            if i:
+                threads.append(threading.Thread(target=feed, args=(step,), daemon=True))
+        for i, step in enumerate(steps):
+            threads.append(threading.Thread(
+                target=pump, args=(step, steps[i + 1] if i + 1 < len(steps) else None), daemon=True
+            ))
+
+        done = threading.Event()
+        threading.Thread(target=report, args=(steps, start, done), daemon=True).start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        failures = sum(step.process.wait() for step in steps)
+        done.set()
+
+    print(summary(steps, start), file=sys.stderr)
+    for step in steps:
+        step.login_file.close()
+    sys.exit(min(failures, 101))
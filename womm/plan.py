@@ -0,0 +1,282 @@
+# `womm plan`: predict how a run will go before paying for it.
+#
+# a small discrete-event simulation of how womm dispatches jobs. pods come up after a startup delay, but parallel only
+# starts once the sshloginfile has something in it, and after that it only rereads the file when a job finishes, so a
+# pod which comes up while everything is busy sits idle until then. each job then pays the kubectl exec overhead on
+# top of its own runtime. the delays are sampled from distributions which are either given on the command line or
+# taken from what past runs of the same command recorded (see sizing.py).
+from collections import deque
+import tempfile
+import statistics
+import random
+import heapq
+import math
+
+from tabulate import tabulate
+
+from .common import *  # pylint: disable=wildcard-import,unused-wildcard-import
+from .parallel import int_arg, next_arg
+from . import sizing
+
+default_startup = '30:15'
+default_overhead = '0.5:0.2'
+default_procs_per_pod = [1, 2, 4]
+default_trials = 20
+# parallel starts jobs one at a time
+dispatch_interval = 0.01
+
+def usage_plan():
+    print("""\
+Usage: womm plan [options] -- [command]
+
+Simulate running the command with a few choices of --kube-pods and --procs-per-pod, and show how
+long each would take and what it would cost. The command and its input sources are given the same
+way as to womm parallel, and are only used to count the jobs and look up past runs.
+
+Options:
+  --jobs N            Plan for N jobs instead of counting them
+  --kube-pods N,...   Pod counts to try (default: powers of two, up to one jobslot per job)
+  --procs-per-pod N,...
+                      Jobslots per pod to try (default 1,2,4)
+  --local-procs N     As for womm parallel, N local jobslots in addition to the pods
+  --runtime DIST      How long a job takes (default: from past runs of the command)
+  --startup DIST      How long a pod takes to come up, image pull and all (default: from past runs,
+                      else 30:15)
+  --overhead DIST     How long kubectl exec adds to each job (default 0.5:0.2)
+  --slot-cpu N        Cpus reserved per jobslot, for the cost (default: from the last run, else 1)
+  --trials N          Simulate each configuration N times (default 20)
+  --seed N            Seed for the simulation, to get the same numbers twice
+  --help              Show this message :)
+
+DIST is a number of seconds, MEAN:STDDEV for a lognormal distribution, or MIN-MAX for a uniform one.
+""")
+    sys.exit(0)
+
+def constant(value):
+    return lambda rng: value
+
+def lognormal(mean, stddev):
+    if stddev <= 0:
+        return constant(mean)
+    sigma = math.sqrt(math.log(1 + (stddev / mean) ** 2))
+    mu = math.log(mean) - sigma ** 2 / 2
+    return lambda rng: rng.lognormvariate(mu, sigma)
+
+def uniform(low, high):
+    return lambda rng: rng.uniform(low, high)
+
+def empirical(values, jitter=0.):
+    # resample what we've seen. jitter covers values which were only recorded to the second.
+    return lambda rng: max(0., rng.choice(values) + rng.uniform(-jitter, jitter))
+
+def parse_dist(s, arg):
+    try:
+        if ':' in s:
+            mean, stddev = (float(x) for x in s.split(':'))
+            if mean > 0 and stddev >= 0:
+                return lognormal(mean, stddev)
+        elif '-' in s[1:]:
+            low, high = (float(x) for x in s.split('-'))
+            if 0 <= low <= high:
+                return uniform(low, high)
+        elif float(s) >= 0:
+            return constant(float(s))
+    except ValueError:
+        pass
+    print('Expected a number of seconds, MEAN:STDDEV or MIN-MAX for %s, got %s' % (arg, s))
+    sys.exit(1)
+
+def int_list(s, arg):
+    try:
+        result = sorted({int(x) for x in s.split(',')})
+    except ValueError:
+        result = []
+    if not result or result[0] < 1:
+        print('Expected a comma-separated list of positive numbers for %s, got %s' % (arg, s))
+        sys.exit(1)
+    return result
+
+def simulate(rng, jobs, pods, procs_per_pod, local_procs, startup, overhead, runtime):
+    # returns (makespan, busy jobslot-seconds)
+    pending = deque(sorted(startup(rng) for _ in range(pods)))
+    # parallel waits for the sshloginfile to have something in it
+    now = 0. if local_procs else pending[0]
+    free = local_procs
+    dispatcher = now
+    running = []
+    started = 0
+    busy = 0.
+    seq = 0
+
+    while True:
+        # (re)reading the sshloginfile picks up every pod which is up by now
+        while pending and pending[0] <= now:
+            pending.popleft()
+            free += procs_per_pod
+        while free and started < jobs:
+            free -= 1
+            started += 1
+            dispatcher = max(dispatcher, now) + dispatch_interval
+            duration = runtime(rng)
+            busy += duration
+            seq += 1
+            heapq.heappush(running, (dispatcher + overhead(rng) + duration, seq))
+        if running:
+            now, _ = heapq.heappop(running)
+            free += 1
+        elif started < jobs:
+            # nothing to wait for but the next pod
+            now = pending[0]
+        else:
+            return now, busy
+
+def default_pods(jobs, procs_list, local_procs):
+    most = max(1, math.ceil((jobs - local_procs) / min(procs_list)))
+    result = []
+    n = 1
+    while n < most:
+        result.append(n)
+        n *= 2
+    return result[-5:] + [most]
+
+def calibrate(key):
+    # returns (runtime, startup, slot cpu) from past runs of the command, each None if there's nothing to go on
+    entry = sizing.load_usage().get(key) if key is not None else None
+    if not entry:
+        return None, None, None
+    runtime = None
+    if entry['jobs']:
+        runtime = empirical([wall for _, _, wall in entry['jobs']], 0.5)
+    startup = None
+    startups = [t for run in entry['runs'] for t in run.get('startup', ()) if t >= 0]
+    if startups:
+        startup = empirical(startups)
+    slot_cpu = None
+    if entry['runs']:
+        last = entry['runs'][-1]
+        slot_cpu = parse_quantity(last['cpu']) / last['procs_per_pod']
+    return runtime, startup, slot_cpu
+
+def count_jobs(parallel_opts):
+    opts, rest = split_opts(parallel_opts)
+    _, sources = split_command(rest)
+    if not sources and sys.stdin.isatty():
+        print('Nothing to count jobs from. Give input sources, pipe them in, or use --jobs.')
+        sys.exit(1)
+    with tempfile.TemporaryDirectory(prefix='womm-plan-') as tmp:
+        stdin_path = spool_stdin(Path(tmp) / 'stdin')
+        # the command doesn't matter, only how many times it would run
+        return len(expand_cmdlines(opts, ['true'] + sources, stdin_path))
+
+def fmt_duration(seconds):
+    seconds = round(seconds)
+    if seconds < 60:
+        return '%ds' % seconds
+    if seconds < 3600:
+        return '%dm%02ds' % divmod(seconds, 60)
+    return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60)
+
+def cmd_plan():
+    args = sys.argv[2:]
+    parallel_opts = []
+    jobs = None
+    pods_list = None
+    procs_list = default_procs_per_pod
+    local_procs = 0
+    runtime = startup = overhead = None
+    slot_cpu = None
+    trials = default_trials
+    seed = None
+
+    iterable = iter(args)
+    for opt in iterable:
+        name, eq, value = opt.partition('=')
+        if opt == '--':
+            parallel_opts += ['--'] + list(iterable)
+            break
+        if opt in ('--help', '-h', '-?'):
+            usage_plan()
+        if name not in ('--jobs', '--kube-pods', '--procs-per-pod', '--local-procs', '--runtime', '--startup',
+                        '--overhead', '--slot-cpu', '--trials', '--seed'):
+            parallel_opts.append(opt)
+            continue
+        if not eq:
+            value = next_arg(iterable, name)
+        if name == '--jobs':
+            jobs = int_arg(value, name)
+        elif name == '--kube-pods':
+            pods_list = int_list(value, name)
+        elif name == '--procs-per-pod':
+            procs_list = int_list(value, name)
+        elif name == '--local-procs':
+            local_procs = int_arg(value, name)
+        elif name == '--runtime':
+            runtime = parse_dist(value, name)
+        elif name == '--startup':
+            startup = parse_dist(value, name)
+        elif name == '--overhead':
+            overhead = parse_dist(value, name)
+        elif name == '--slot-cpu':
+            slot_cpu = parse_quantity(value)
+        elif name == '--trials':
+            trials = max(1, int_arg(value, name))
+        elif name == '--seed':
+            seed = int_arg(value, name)
+
+    key = sizing.usage_key(parallel_opts) if '--' in parallel_opts else None
+    past_runtime, past_startup, past_slot_cpu = calibrate(key)
+    if runtime is None:
+        runtime = past_runtime
+    if runtime is None:
+        print('No past runs of this command to go on. Give --runtime.')
+        sys.exit(1)
+    startup = startup or past_startup or parse_dist(default_startup, '--startup')
+    overhead = overhead or parse_dist(default_overhead, '--overhead')
+    slot_cpu = slot_cpu or past_slot_cpu or 1.
+
+    if jobs is None:
+        if '--' not in parallel_opts:
+            usage_plan()
+        jobs = count_jobs(parallel_opts)
+    if jobs < 1:
+        print('Nothing to plan, the command would run no jobs.')
+        sys.exit(0)
+    if pods_list is None:
+        pods_list = default_pods(jobs, procs_list, local_procs)
+
+    sources = []
+    if past_runtime is not None:
+        sources.append('job runtimes')
+    if past_startup is not None:
+        sources.append('pod startup times')
+    if sources:
+        print('womm: using %s recorded by past runs' % ' and '.join(sources), file=sys.stderr)
+
+    rng = random.Random(seed)
+    output = []
+    for pods in pods_list:
+        for procs_per_pod in procs_list:
+            makespans = []
+            utilizations = []
+            for _ in range(trials):
+                makespan, busy = simulate(
+                    rng, jobs, pods, procs_per_pod, local_procs, startup, overhead, runtime
+                )
+                makespans.append(makespan)
+                utilizations.append(busy / max(makespan * (pods * procs_per_pod + local_procs), 1e-9))
+            mean = statistics.mean(makespans)
+            output.append([
+                pods,
+                procs_per_pod,
+                '%dm' % round(1000 * slot_cpu * procs_per_pod),
+                fmt_duration(mean),
+                fmt_duration(sizing.percentile(makespans, 0.9)),
+                '%d%%' % round(100 * statistics.mean(utilizations)),
+                '%.2f' % (pods * procs_per_pod * slot_cpu * mean / 3600),
+            ])
+    print('%d jobs' % jobs)
+    print(tabulate(
+        output,
+        headers=['PODS', 'PROCS/POD', 'CPU/POD', 'MAKESPAN', 'P90', 'UTILIZATION', 'CORE-HOURS'],
+        disable_numparse=True,
+    ))
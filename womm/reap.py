@@ -0,0 +1,98 @@
+# `womm reap`: tear down tasks whose coordinator is gone, and async tasks which finished long ago.
+#
+# this goes by the heartbeat annotations rather than by controller pids, so it works from any machine, including from
+# the cronjob which `womm cluster-setup` installs.
+from datetime import datetime, timezone
+import time
+
+from tabulate import tabulate
+
+from .common import *  # pylint: disable=wildcard-import,unused-wildcard-import
+from .parallel import get_status, task_state, delete_tasks, duration_arg, next_arg, relative_date_fmt
+
+default_keep = 3 * 86400
+
+def usage_reap():
+    print("""\
+Usage: womm reap [options]
+
+Options:
+  --dry-run           Show what would be torn down, but leave it alone
+  --stale N           Consider a task orphaned once its coordinator has been silent for N seconds (or Nm, Nh, Nd)
+                      (default: 5m, or 15m for async tasks)
+  --keep N            Tear down completed async tasks N seconds after they finish (default 3d)
+  --loop N            Keep reaping every N seconds instead of just once
+  --help              Show this message :)
+""")
+    sys.exit(0)
+
+def reap_once(dry_run, stale, keep):
+    now = time.time()
+    doomed = []
+    for task_id, data in sorted(get_status().items(), key=lambda item: item[1].created_time):
+        state = task_state(data, stale)
+        if state == 'ORPHANED':
+            reason = 'orphaned'
+        elif state == 'COMPLETE' and data.completed and now - data.completed > keep:
+            reason = 'completed %s ago' % relative_date_fmt(datetime.fromtimestamp(data.completed, timezone.utc))
+        else:
+            continue
+        doomed.append([task_id, reason, data.host, data.cwd, data.target_instances, data.cmd])
+
+    if not doomed:
+        return
+    print(tabulate(doomed, headers=['ID', 'REASON', 'HOST', 'PWD', 'PODS', 'COMMAND']))
+    if not dry_run:
+        delete_tasks([row[0] for row in doomed])
+    sys.stdout.flush()
+
+def reap_volumes(dry_run):
+    # persistent volumes from --nfs-profile which a leader let go of but couldn't delete. the cronjob can't see them.
+    output = subprocess.run(
+        [
+            'kubectl', 'get', 'pv', '-l', 'womm_task', '-o', 'jsonpath', '--template',
+            '{range .items[*]}{.metadata.name} {.status.phase}{"\\n"}{end}',
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    ).stdout.decode()
+    released = [line.split()[0] for line in output.splitlines() if line.endswith(' Released')]
+    if not released:
+        return
+    print('Released share volumes: %s' % ' '.join(released))
+    if not dry_run:
+        subprocess.run(
+            ['kubectl', 'delete', '--wait=false'] + ['pv/' + name for name in released],
+            stdout=sys.stderr,
+            check=False,
+        )
+
+def cmd_reap():
+    dry_run = False
+    stale = None
+    keep = default_keep
+    loop = None
+
+    iterable = iter(sys.argv[2:])
+    for arg in iterable:
+        name, _, value = arg.partition('=')
+        if arg == '--dry-run':
+            dry_run = True
+        elif name in ('--stale', '--keep', '--loop'):
+            value = duration_arg(value or next_arg(iterable, name), name)
+            if name == '--stale':
+                stale = value
+            elif name == '--keep':
+                keep = value
+            else:
+                loop = value
+        else:
+            usage_reap()
+
+    while True:
+        reap_once(dry_run, stale, keep)
+        reap_volumes(dry_run)
+        if loop is None:
+            break
+        time.sleep(loop)
@@ -1,6 +1,14 @@
-from contextlib import contextmanager
+import hashlib
+import json
 
 from .common import *  # pylint: disable=wildcard-import,unused-wildcard-import
+from . import changes
+
+bootstrap_repo = 'womm-bootstrap'
+bootstrap_files = ('sudo', 'bestsh', 'trapper')
+base_layers_label = 'womm.base-layers'
+# each setup session adds a layer to the image. once there are more than this many, squash the image back into one.
+squash_layers = 8
 
 def environment_check():
     success = True
@@ -58,9 +66,29 @@ def environment_check():
         print("We need to have perl installed")
         sys.exit(1)
 
-@contextmanager
+def image_inspect(image, fmt):
+    r = subprocess.run(
+        ['docker', 'image', 'inspect', '-f', fmt, image],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+    if r.returncode != 0:
+        return None
+    return r.stdout.decode().strip()
+
+def image_layers(image):
+    layers = image_inspect(image, '{{json .RootFS.Layers}}')
+    return None if layers is None else json.loads(layers) or []
+
+def base_layers(image):
+    # how many of the image's layers came from bootstrapping (or the last squash), as opposed to setup sessions
+    label = image_inspect(image, '{{index .Config.Labels "%s"}}' % base_layers_label)
+    if label and label.isdigit():
+        return int(label)
+    return len(image_layers(image))
+
 def bootstrap_image(base_img_name):
-    tmp_image = 'womm-buildertmp-' + make_id()
     with open(basedir / 'Dockerfile', 'r', encoding='utf-8') as fp:
         template = fp.read()
     template = template \
@@ -69,15 +97,50 @@ def bootstrap_image(base_img_name):
             .replace('$USER', os.getlogin()) \
             .replace('$PWD', cwd)
 
+    # docker build doesn't pull a base image it already has, so the template and the files it adds are all that
+    # can change the result
+    h = hashlib.sha256(template.encode())
+    for filename in bootstrap_files:
+        h.update((basedir / filename).read_bytes())
+    image = '%s:%s' % (bootstrap_repo, h.hexdigest()[:16])
+    if image_inspect(image, '{{.Id}}') is not None:
+        print("Reusing bootstrap image %s" % image)
+        return image
+
     subprocess.run(
-        ['docker', 'build', '-q', '-t', tmp_image, '-f', '-', str(basedir)],
+        ['docker', 'build', '-q', '-t', image, '-f', '-', str(basedir)],
         input=template.encode(),
         check=True
     )
+    return image
+
+def squash_image(image, out_name):
+    # export/import flattens the whole filesystem into one layer, and forgets the config, so bring that along by hand
+    config = json.loads(image_inspect(image, '{{json .Config}}'))
+    instructions = []
+    for env in config.get('Env') or []:
+        key, _, value = env.partition('=')
+        instructions.append('ENV %s=%s' % (key, json.dumps(value)))
+    for key, instruction in (('Entrypoint', 'ENTRYPOINT'), ('Cmd', 'CMD')):
+        if config.get(key):
+            instructions.append('%s %s' % (instruction, json.dumps(config[key])))
+    for key, instruction in (('User', 'USER'), ('WorkingDir', 'WORKDIR')):
+        if config.get(key):
+            instructions.append('%s %s' % (instruction, config[key]))
+
+    tmp_container = 'womm-tmpcontainer-' + make_id()
+    subprocess.run(['docker', 'create', '--name', tmp_container, image], stdout=subprocess.DEVNULL, check=True)
     try:
-        yield tmp_image
+        export = subprocess.Popen(['docker', 'export', tmp_container], stdout=subprocess.PIPE)
+        cmd = ['docker', 'import']
+        for instruction in instructions:
+            cmd += ['--change', instruction]
+        subprocess.run(cmd + ['-', out_name], stdin=export.stdout, stdout=subprocess.DEVNULL, check=True)
+        export.stdout.close()
+        if export.wait() != 0:
+            raise subprocess.CalledProcessError(export.returncode, export.args)
     finally:
-        subprocess.run(['docker', 'rmi', tmp_image], stdout=subprocess.DEVNULL, check=True)
+        subprocess.run(['docker', 'rm', tmp_container], stdout=subprocess.DEVNULL, check=True)
 
 def update_img(in_name, out_name, mount=False):
     tmp_container = 'womm-tmpcontainer-' + make_id()
@@ -96,12 +159,18 @@ def update_img(in_name, out_name, mount=False):
             print("Make it work!")
             print("Also make sure our dependencies are installed: perl")
             subprocess.run(cmd, check=False)
-            subprocess.run(['docker', 'commit', tmp_container, tmp_image], check=True)
-            subprocess.run(['docker', 'rm', tmp_container], check=True)
-            run_image = tmp_image
+            if changes.prune(changes.container_diff(tmp_container), changes.history_patterns):
+                # only what changed in the session goes in the new layer
+                label = 'LABEL %s=%d' % (base_layers_label, base_layers(in_name))
+                subprocess.run(
+                    ['docker', 'commit', '--change', label, tmp_container, tmp_image],
+                    check=True,
+                )
+                run_image = tmp_image
+            subprocess.run(['docker', 'rm', tmp_container], stdout=subprocess.DEVNULL, check=True)
 
             if subprocess.run(
-                ['docker', 'run', '--rm', '--entrypoint=perl', tmp_image, '-v'],
+                ['docker', 'run', '--rm', '--entrypoint=perl', run_image, '-v'],
                 stdout=subprocess.DEVNULL,
                 check=False
             ).returncode != 0:
@@ -117,10 +186,34 @@ def update_img(in_name, out_name, mount=False):
         working = choice(['y', 'n'], default='y')
         if working == 'n':
             return False
-        else:
-            subprocess.run(['docker', 'tag', tmp_image, out_name], check=True)
-            subprocess.run(['docker', 'push', out_name], check=True)
+
+        if run_image == in_name == out_name:
+            print("Nothing changed, so there's nothing to push.")
             return True
+
+        layers = image_layers(run_image)
+        session_layers = len(layers) - base_layers(run_image)
+        if session_layers > squash_layers:
+            print("Squashing %d layers from setup sessions into one. The next pull will be a big one." % session_layers)
+            old_id = image_inspect(run_image, '{{.Id}}')
+            squash_image(run_image, tmp_image)
+            if run_image == tmp_image:
+                subprocess.run(
+                    ['docker', 'rmi', old_id],
+                    check=False,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL
+                )
+            run_image = tmp_image
+            layers = image_layers(run_image)
+
+        old_layers = set(image_layers(out_name) or ())
+        new_layers = [layer for layer in layers if layer not in old_layers]
+        if old_layers:
+            print("Pushing %d new layers, %d are unchanged" % (len(new_layers), len(layers) - len(new_layers)))
+        subprocess.run(['docker', 'tag', run_image, out_name], check=True)
+        subprocess.run(['docker', 'push', out_name], check=True)
+        return True
     finally:
         # TODO don't airtight-rm the image so that we can recover a crashed session
         subprocess.run(
@@ -138,7 +231,10 @@ def cmd_setup():
     namespace = None if existing_cfg is None else existing_cfg.get('namespace', None)
     secret_name = None if existing_cfg is None else existing_cfg.get('secret_name', None)
 
-    reinitialize_share = existing_cfg is None or not is_share_allocated(existing_cfg['share_path'])
+    reinitialize_share = existing_cfg is None
+    share_evicted = existing_cfg is not None and not is_share_allocated(existing_cfg['share_path'])
+    if share_evicted:
+        print("Your share was evicted from the server for sitting idle. You'll get a new one.")
     if not reinitialize_share:
         print('Do you want to change the share type? y/n')
         if choice(['y', 'n'], default='n') == 'y':
@@ -184,9 +280,8 @@ def cmd_setup():
         if not base_image.strip():
             base_image = img_default
         img_name = get_prefix() + 'womm-image-' + make_id()
-        with bootstrap_image(base_image) as tmp_image:
-            if not update_img(tmp_image, img_name, mount=share_method != 'none'):
-                return
+        if not update_img(bootstrap_image(base_image), img_name, mount=share_method != 'none'):
+            return
     else:
         img_name = existing_cfg['image']
         print("Do you want to edit your image? y/n")
@@ -195,7 +290,7 @@ def cmd_setup():
                 return
 
     teardown_share()
-    if reinitialize_share:
+    if reinitialize_share or share_evicted:
         share_path = allocate_share()
     else:
         share_path = existing_cfg['share_path']
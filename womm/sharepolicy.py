@@ -0,0 +1,163 @@
+# per-subtree share policy, from a .wommshare file next to .womm:
+#
+#   # datasets are big, and jobs only read a little of each
+#   lazy data
+#   ignore build .venv
+#   eager build/config
+#
+# each line is a policy and the paths it applies to, relative to the directory. the most specific rule for a path
+# wins, and anything no rule covers follows the share kind from `womm setup`. only eager shares mix policies: ignored
+# and lazy subtrees are left out of the rsync, and each lazy one is mounted into the share through its own export
+# container instead. a lazy subtree is served whole, so there can't be any rules inside one.
+from tabulate import tabulate
+
+from .common import *  # pylint: disable=wildcard-import,unused-wildcard-import
+
+policy_path = Path('.wommshare')
+policies = ('eager', 'lazy', 'ignore')
+
+def load_rules():
+    # {relative path: policy}
+    try:
+        with open(policy_path, 'r', encoding='utf-8') as fp:
+            lines = fp.read().splitlines()
+    except FileNotFoundError:
+        return {}
+
+    rules = {}
+    for lineno, line in enumerate(lines, 1):
+        words = line.split('#', 1)[0].split()
+        if not words:
+            continue
+        if words[0] not in policies or len(words) < 2:
+            print('%s:%d: expected eager, lazy or ignore, followed by one or more paths' % (policy_path, lineno))
+            sys.exit(1)
+        for word in words[1:]:
+            path = os.path.normpath(word.strip('/'))
+            if path == '.' or path == '..' or path.startswith('../'):
+                print('%s:%d: %s is not inside the directory' % (policy_path, lineno, word))
+                sys.exit(1)
+            rules[path] = words[0]
+
+    for path in rules:
+        if governing(rules, path)[1] == 'lazy':
+            print('%s: %s is inside a lazy directory, which is shared as a whole' % (policy_path, path))
+            sys.exit(1)
+    return rules
+
+def governing(rules, path):
+    # the nearest rule strictly above path, as (path, policy), or (None, None)
+    while '/' in path:
+        path = path.rsplit('/', 1)[0]
+        if path in rules:
+            return path, rules[path]
+    return None, None
+
+def effective(rules, path, default):
+    if path in rules:
+        return rules[path]
+    return governing(rules, path)[1] or default
+
+def rsync_filters(rules):
+    # rsync goes with the first filter that matches, so the most specific go first. an eager subtree inside an ignored
+    # one needs every directory on the way down to it included, and everything else in those directories excluded.
+    filters = set()
+    for path, policy in rules.items():
+        depth = path.count('/') + 1
+        if policy == 'eager':
+            if governing(rules, path)[1] != 'ignore':
+                continue
+            filters.add((depth, '+', '/' + path))
+            parent = path
+            while '/' in parent:
+                parent = parent.rsplit('/', 1)[0]
+                if effective(rules, parent, 'eager') != 'ignore':
+                    break
+                filters.add((parent.count('/') + 2, '-', '/%s/*' % parent))
+                filters.add((parent.count('/') + 1, '+', '/%s/' % parent))
+        elif policy == 'lazy' or not any(
+            other.startswith(path + '/') and rules[other] == 'eager' for other in rules
+        ):
+            filters.add((depth, '-', '/' + path))
+
+    result = []
+    for _, sign, pattern in sorted(filters, key=lambda f: (-f[0], f[1] != '+', f[2])):
+        result += ['--filter', '%s %s' % (sign, pattern)]
+    return result
+
+def lazy_paths(rules):
+    result = []
+    for path, policy in sorted(rules.items()):
+        if policy != 'lazy':
+            continue
+        if not os.path.isdir(path) or os.path.islink(path):
+            print('womm: %s: %s is not a directory, so it will not be shared lazily' % (policy_path, path),
+                  file=sys.stderr)
+            continue
+        result.append(path)
+    return result
+
+def profile(rules, default):
+    # [files, bytes] under each rule, and under '.' for everything no rule covers
+    totals = {path: [0, 0] for path in rules}
+    totals['.'] = [0, 0]
+    stack = [('', '.')]
+    while stack:
+        relpath, key = stack.pop()
+        try:
+            entries = list(os.scandir(relpath or '.'))
+        except OSError:
+            continue
+        for entry in entries:
+            child = relpath + '/' + entry.name if relpath else entry.name
+            if child == state_dirname:
+                continue
+            child_key = child if child in rules else key
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((child, child_key))
+                    continue
+                size = entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                continue
+            totals[child_key][0] += 1
+            totals[child_key][1] += size
+    # a rule for a path that doesn't exist still gets a row, with nothing in it
+    return [(path, rules.get(path, default), files, size) for path, (files, size) in sorted(totals.items())]
+
+def cmd_share_profile():
+    if len(sys.argv) > 2:
+        print("""\
+Usage: womm share-profile
+
+Show how many files and bytes each rule in .wommshare covers, and how much in total would be shared
+eagerly, lazily, or not at all.
+""")
+        sys.exit(0)
+
+    cfg = cfg_load()
+    if cfg is None:
+        print("Error: please run `womm setup` to initialize the current directory")
+        sys.exit(1)
+    if cfg['share_kind'] == 'none':
+        print("This directory isn't shared at all.")
+        return
+
+    rules = load_rules()
+    if cfg['share_kind'] == 'lazy':
+        if rules:
+            print('%s only applies to eager shares. Everything in a lazy share is shared lazily.' % policy_path)
+        rules = {}
+    rows = profile(rules, 'eager' if cfg['share_kind'] != 'lazy' else 'lazy')
+
+    print(tabulate(
+        [[policy, path, files, format_size(size)] for path, policy, files, size in rows],
+        headers=['POLICY', 'PATH', 'FILES', 'SIZE'],
+        disable_numparse=True,
+    ))
+    print()
+    for policy in policies:
+        files = sum(row[2] for row in rows if row[1] == policy)
+        size = sum(row[3] for row in rows if row[1] == policy)
+        if files:
+            print('%-8s%s in %d files' % (policy + ':', format_size(size), files))
@@ -0,0 +1,192 @@
+# usage-based right-sizing for `womm parallel`.
+#
+# while a task runs, every job on a pod is wrapped in a little perl supervisor which appends its cpu time, peak memory
+# and wall time to /tmp/.womm-usage in the pod. when the task is torn down we collect those, plus any OOM kills, into
+# .womm-usage next to .womm, keyed by the job command. the next run of the same command can then be sized from them.
+from concurrent.futures import ThreadPoolExecutor
+import math
+import shlex
+import json
+import time
+
+import dateutil.parser
+
+from .common import *  # pylint: disable=wildcard-import,unused-wildcard-import
+
+usage_path = Path('.womm-usage')
+usage_env = 'WOMM_RECORD_USAGE'
+remote_usage_path = '/tmp/.womm-usage'
+# how many jobs' worth of records to remember per command
+max_records = 1000
+default_oom_risk = 5.
+# the most we're willing to pack into one pod
+max_pod_cpu = 4.
+max_pod_mem = 8 * 1024**3
+# for the shell, kubectl exec and the supervisor itself
+job_mem_overhead = 32 * 1024**2
+
+# runs the job as a child, samples the total rss of its process tree twice a second, and records the results when it
+# exits. exits however the job exited.
+supervisor = r'''
+use POSIX ":sys_wait_h";
+my $start = time;
+my $pid = fork;
+defined $pid or die "fork: $!";
+if (!$pid) { exec @ARGV or exit 127; }
+my $peak = 0;
+while (waitpid($pid, WNOHANG) == 0) {
+    my (%parent, %rss);
+    opendir(my $dh, "/proc") or last;
+    for my $p (grep { /^\d+$/ } readdir $dh) {
+        open(my $fh, "<", "/proc/$p/stat") or next;
+        my $stat = <$fh>;
+        $stat =~ s/^.*\) // or next;
+        my @f = split / /, $stat;
+        ($parent{$p}, $rss{$p}) = ($f[1], $f[21] * 4096);
+    }
+    my $total = 0;
+    for my $p (keys %rss) {
+        my ($q, $n) = ($p, 0);
+        $q = $parent{$q} while defined $q && $q != $pid && $q > 1 && $n++ < 64;
+        $total += $rss{$p} if defined $q && $q == $pid;
+    }
+    $peak = $total if $total > $peak;
+    select(undef, undef, undef, 0.5);
+}
+my $status = $?;
+my (undef, undef, $cuser, $csys) = times;
+if (open(my $out, ">>", "/tmp/.womm-usage")) {
+    printf $out "%.3f %d %d\n", $cuser + $csys, $peak, time - $start;
+}
+exit($status & 127 ? 128 + ($status & 127) : $status >> 8);
+'''
+
+def wrap_command(cmdline):
+    # cmdline is the shell command which kubectl exec is about to run
+    return 'exec perl -e %s sh -c %s' % (shlex.quote(supervisor), shlex.quote(cmdline))
+
+def record_env():
+    return dict(os.environ, **{usage_env: '1'})
+
+def usage_key(parallel_opts):
+    _, rest = split_opts(parallel_opts)
+    command, _ = split_command(rest)
+    return json.dumps(command or parallel_opts)
+
+def load_usage():
+    try:
+        with open(usage_path, 'r', encoding='utf-8') as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {}
+
+def store_usage(usage):
+    with open(str(usage_path) + '.part', 'w', encoding='utf-8') as fp:
+        json.dump(usage, fp)
+    os.rename(str(usage_path) + '.part', usage_path)
+
+def pod_usage(pod):
+    r = subprocess.run(
+        ['kubectl', 'exec', '-i', pod, '--', 'cat', remote_usage_path],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+    records = []
+    for line in r.stdout.decode(errors='replace').splitlines():
+        parts = line.split()
+        if len(parts) == 3:
+            records.append([float(parts[0]), int(parts[1]), float(parts[2])])
+    return records
+
+def collect(task_id, key, cpu, mem, pods, procs_per_pod, start):
+    wall = time.time() - start
+    output = subprocess.run(
+        [
+            'kubectl', 'get', 'pods', '-l', 'womm_task=' + task_id, '-o', 'jsonpath', '--template',
+            '{range .items[*]}{.metadata.name} {.status.phase} {.status.containerStatuses[0].state.running.startedAt} '
+            '{.status.containerStatuses[0].lastState.terminated.reason}{"\\n"}{end}',
+        ],
+        stdout=subprocess.PIPE,
+        check=False,
+    ).stdout.decode()
+    running = []
+    startup = []
+    ooms = 0
+    for line in output.splitlines():
+        parts = line.split(' ')
+        if len(parts) < 4:
+            continue
+        if parts[1] == 'Running':
+            running.append(parts[0])
+        if parts[2]:
+            # from creating the deployment to the pod's container running, image pull and all
+            startup.append(round(dateutil.parser.parse(parts[2]).timestamp() - start, 1))
+        if parts[3] == 'OOMKilled':
+            ooms += 1
+
+    with ThreadPoolExecutor(max_workers=32) as pool:
+        records = [record for records in pool.map(pod_usage, running) for record in records]
+    if not records and not ooms:
+        return
+
+    usage = load_usage()
+    entry = usage.setdefault(key, {'jobs': [], 'runs': []})
+    entry['jobs'] = (entry['jobs'] + records)[-max_records:]
+    entry['runs'] = (entry['runs'] + [{
+        'cpu': cpu,
+        'mem': mem,
+        'pods': pods,
+        'procs_per_pod': procs_per_pod,
+        'wall': wall,
+        'jobs': len(records),
+        'ooms': ooms,
+        'startup': startup,
+    }])[-20:]
+    store_usage(usage)
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+def suggest(key, slots, oom_risk):
+    # returns (cpu, mem, pods, procs_per_pod, core-hours saved per run) or None if we have nothing to go on
+    entry = load_usage().get(key)
+    if not entry or not entry['jobs']:
+        return None
+    jobs = entry['jobs']
+    last = entry['runs'][-1]
+
+    job_mem = percentile([peak for _, peak, _ in jobs], 1 - oom_risk / 100) + job_mem_overhead
+    if last['ooms']:
+        # whatever got killed didn't get to report its usage, so all we know is that it needed more than it had
+        job_mem = max(job_mem, 1.5 * parse_quantity(last['mem']) / last['procs_per_pod'])
+    # going over on cpu only means getting throttled, so the typical job is what counts
+    job_cpu = max(0.1, math.ceil(20 * percentile([cpu / max(wall, 1) for cpu, _, wall in jobs], 0.5)) / 20)
+
+    procs_per_pod = max(1, min(slots, int(max_pod_cpu / job_cpu), int(max_pod_mem / job_mem)))
+    pods = math.ceil(slots / procs_per_pod)
+    cpu = '%dm' % round(1000 * job_cpu * procs_per_pod)
+    mem = '%dMi' % math.ceil(job_mem * procs_per_pod / 1024**2)
+
+    hours = last['wall'] / 3600
+    saved = (last['pods'] * parse_quantity(last['cpu']) - pods * parse_quantity(cpu)) * hours
+    return cpu, mem, pods, procs_per_pod, saved
+
+def size_task(key, cpu, mem, pods, procs_per_pod, oom_risk, auto):
+    # returns the (cpu, mem, pods, procs_per_pod) to run with
+    suggestion = suggest(key, pods * procs_per_pod, oom_risk)
+    if suggestion is None:
+        return cpu, mem, pods, procs_per_pod
+    new_cpu, new_mem, new_pods, new_procs, saved = suggestion
+    if (new_cpu, new_mem, new_pods, new_procs) == (cpu, mem, pods, procs_per_pod):
+        return cpu, mem, pods, procs_per_pod
+
+    flags = '--kube-pods %d --procs-per-pod %d --kube-cpu %s --kube-mem %s' % (new_pods, new_procs, new_cpu, new_mem)
+    if auto:
+        print('womm: sizing from past runs: %s (about %.1f core-hours saved)' % (flags, saved), file=sys.stderr)
+        return new_cpu, new_mem, new_pods, new_procs
+    print('womm: past runs of this command suggest %s (about %.1f core-hours saved). '
+          'Use --kube-auto to apply.' % (flags, saved), file=sys.stderr)
+    return cpu, mem, pods, procs_per_pod
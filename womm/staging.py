@@ -0,0 +1,170 @@
+# node-local staging for `womm parallel --stage` and `--scratch`.
+#
+# staged inputs are copied out of the share once per node, into a hostPath cache which every pod of every task on that
+# node can use. the copy is keyed on the contents of the inputs, so a rerun with the same inputs doesn't copy anything.
+# scratch outputs go to an emptyDir, and a sidecar moves finished files into the share in batches.
+from collections import namedtuple
+import hashlib
+import shlex
+import json
+
+from .common import *  # pylint: disable=wildcard-import,unused-wildcard-import
+
+node_cache_path = '/var/cache/womm'
+# how long a file in scratch has to sit still before we consider it finished
+upload_interval = 10
+# node cache entries which haven't been used in this many days are deleted
+node_cache_days = 7
+
+Staging = namedtuple('Staging', ('inputs', 'key', 'scratch'))
+
+def share_relpath(path, arg):
+    real = os.path.realpath(path)
+    if not real.startswith(cwd + '/'):
+        print('%s must be inside the current directory, got %s' % (arg, path))
+        sys.exit(1)
+    return os.path.relpath(real, cwd)
+
+def inputs_key(cfg, inputs):
+    h = hashlib.sha256(cfg['share_path'].encode())
+    for path in inputs:
+        h.update(b'\0' + path.encode())
+        if os.path.isfile(path):
+            walk = [(os.path.dirname(path), [], [os.path.basename(path)])]
+        else:
+            walk = os.walk(path)
+        for dirpath, dirnames, filenames in walk:
+            dirnames.sort()
+            for filename in sorted(filenames):
+                st = os.lstat(os.path.join(dirpath, filename))
+                h.update(('\0%s\0%d\0%d' % (os.path.join(dirpath, filename), st.st_size, st.st_mtime_ns)).encode())
+    return h.hexdigest()[:16]
+
+def make_staging(cfg, inputs, scratch):
+    if not inputs and scratch is None:
+        return None
+    if cfg['share_kind'] == 'none':
+        print('--stage and --scratch need a shared directory.')
+        sys.exit(1)
+    inputs = sorted({share_relpath(path, '--stage') for path in inputs})
+    for path in inputs:
+        if not os.path.exists(path):
+            print('--stage: %s does not exist' % path)
+            sys.exit(1)
+    if scratch is not None:
+        scratch = share_relpath(scratch, '--scratch')
+    return Staging(inputs=inputs, key=inputs_key(cfg, inputs) if inputs else None, scratch=scratch)
+
+def indent(text, n):
+    return ''.join(' ' * n + line + '\n' for line in text.splitlines())
+
+def stage_script(staging):
+    # runs once per pod, as root. the first pod on a node to get to an input copies it while the others wait.
+    paths = ' '.join(shlex.quote(path) for path in staging.inputs)
+    return f'''\
+mkdir -p /womm-node/{staging.key} && cd /womm-node/{staging.key} && touch .
+find /womm-node -mindepth 1 -maxdepth 1 -type d -mtime +{node_cache_days} -exec rm -rf {{}} + 2>/dev/null
+i=0
+for p in {paths}; do
+  until [ -e $i.done ]; do
+    if mkdir $i.lock 2>/dev/null; then
+      rm -rf $i.tmp $i && mkdir $i.tmp && cp -a "/womm-share/$p" $i.tmp/ && mv "$i.tmp/$(basename "$p")" $i && touch $i.done
+      rm -rf $i.tmp; rmdir $i.lock
+      [ -e $i.done ] || exit 1
+    else
+      find . -maxdepth 1 -name $i.lock -mmin +60 -exec rmdir {{}} \\;
+      sleep 2
+    fi
+  done
+  i=$((i+1))
+done
+'''
+
+def upload_script(staging):
+    dest = shlex.quote('/womm-share/' + staging.scratch)
+    return f'''\
+cd /womm-scratch
+upload() {{
+  if [ -s /tmp/womm-batch ]; then
+    mkdir -p {dest} && tar cf - -T /tmp/womm-batch | tar xf - -C {dest} && tr '\\n' '\\0' </tmp/womm-batch | xargs -0 rm -f
+  fi
+}}
+trap 'find . -type f >/tmp/womm-batch; upload; exit 0' TERM
+touch /tmp/womm-mark
+while true; do
+  sleep {upload_interval} & wait $!
+  touch /tmp/womm-mark.new
+  find . -type f ! -newer /tmp/womm-mark >/tmp/womm-batch
+  upload
+  mv /tmp/womm-mark.new /tmp/womm-mark
+done
+'''
+
+def render(staging):
+    # returns the replacements for the placeholders in task-deployment.yml
+    mounts = ''
+    sidecars = ''
+    pod_extra = ''
+    volumes = ''
+    share_mount = indent('''\
+- name: womm-mount-$ID
+  mountPath: /womm-share''', 12)
+
+    if staging.inputs:
+        for i, path in enumerate(staging.inputs):
+            mounts += indent(f'''\
+- name: womm-node-$ID
+  mountPath: {json.dumps(cwd + '/' + path)}
+  subPath: {json.dumps('%s/%d' % (staging.key, i))}
+  readOnly: true''', 12)
+        pod_extra += indent('''\
+initContainers:
+  - name: womm-stage-$ID
+    image: $IMAGE
+    imagePullPolicy: Always
+    securityContext:
+      runAsUser: 0
+    command:
+      - sh
+      - -c
+      - |''', 6)
+        pod_extra += indent(stage_script(staging), 14)
+        pod_extra += indent('''\
+    volumeMounts:
+      - name: womm-node-$ID
+        mountPath: /womm-node''', 6) + share_mount
+        volumes += indent(f'''\
+- name: womm-node-$ID
+  hostPath:
+    path: {node_cache_path}
+    type: DirectoryOrCreate''', 8)
+
+    if staging.scratch is not None:
+        mounts += indent(f'''\
+- name: womm-scratch-$ID
+  mountPath: {json.dumps(cwd + '/' + staging.scratch)}''', 12)
+        sidecars += indent('''\
+- name: womm-upload-$ID
+  image: $IMAGE
+  imagePullPolicy: Always
+  command:
+    - sh
+    - -c
+    - |''', 8)
+        sidecars += indent(upload_script(staging), 14)
+        sidecars += indent('''\
+  volumeMounts:
+    - name: womm-scratch-$ID
+      mountPath: /womm-scratch''', 8) + share_mount
+        # leave the uploader plenty of time to flush when the deployment goes away
+        pod_extra += indent('terminationGracePeriodSeconds: 600', 6)
+        volumes += indent('''\
+- name: womm-scratch-$ID
+  emptyDir: {}''', 8)
+
+    return {
+        '$EXTRA_MOUNTS': mounts,
+        '$SIDECARS': sidecars,
+        '$POD_EXTRA': pod_extra,
+        '$EXTRA_VOLUMES': volumes,
+    }
@@ -0,0 +1,268 @@
+# `womm top`: what the pods of a task are actually using, as opposed to what they asked for.
+#
+# every interval we exec into each pod and read its cgroup counters and nfs mountstats, then report the rates between
+# consecutive samples. works with both cgroup v1 and v2.
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from tabulate import tabulate
+
+from .common import *  # pylint: disable=wildcard-import,unused-wildcard-import
+from .parallel import get_status, duration_arg, next_arg, redraw
+
+max_workers = 32
+# a pod using less than this much of its cpu and memory could make do with a smaller request
+over_threshold = 0.25
+# a pod throttled in more than this many periods, or using more than this much of its memory, needs a bigger one
+throttled_threshold = 0.1
+mem_threshold = 0.9
+# how many times --once samples before giving up on pods which won't answer
+once_tries = 3
+
+probe_script = '''\
+cd /sys/fs/cgroup
+for f in cpu.stat cpu.max memory.current memory.max \\
+        cpuacct/cpuacct.usage cpu/cpu.stat cpu/cpu.cfs_quota_us cpu/cpu.cfs_period_us \\
+        memory/memory.usage_in_bytes memory/memory.limit_in_bytes; do
+    [ -r $f ] && echo "== $f" && cat $f
+done
+echo "== mountstats"
+cat /proc/self/mountstats
+'''
+
+def read_counters(text):
+    # (cpu seconds, throttled periods, periods, memory bytes, memory limit, cpu limit in cores, nfs read, nfs write)
+    files = {}
+    name = None
+    for line in text.splitlines():
+        if line.startswith('== '):
+            name = line[3:]
+            files[name] = []
+        elif name is not None:
+            files[name].append(line)
+
+    def stat(name):
+        return {parts[0]: int(parts[1]) for parts in (line.split() for line in files.get(name, [])) if len(parts) == 2}
+
+    def number(name):
+        try:
+            return int(files[name][0])
+        except (KeyError, IndexError, ValueError):
+            return None
+
+    if 'cpu.stat' in files:
+        cpu_stat = stat('cpu.stat')
+        cpu = cpu_stat.get('usage_usec', 0) / 1e6
+        mem = number('memory.current') or 0
+        mem_limit = number('memory.max')
+        quota, _, period = (files.get('cpu.max') or ['max'])[0].partition(' ')
+        cpu_limit = int(quota) / int(period) if quota.isdigit() and period.isdigit() else None
+    else:
+        cpu_stat = stat('cpu/cpu.stat')
+        cpu = (number('cpuacct/cpuacct.usage') or 0) / 1e9
+        mem = number('memory/memory.usage_in_bytes') or 0
+        mem_limit = number('memory/memory.limit_in_bytes')
+        quota, period = number('cpu/cpu.cfs_quota_us'), number('cpu/cpu.cfs_period_us')
+        cpu_limit = quota / period if quota and quota > 0 and period else None
+    # v1 reports "no limit" as a huge number
+    if mem_limit is not None and mem_limit >= 1 << 60:
+        mem_limit = None
+
+    nfs_read = nfs_write = 0
+    nfs = False
+    for line in files.get('mountstats', []):
+        if line.startswith('device '):
+            nfs = ' with fstype nfs' in line
+        elif nfs and line.strip().startswith('bytes:'):
+            # normal read, normal write, direct read, direct write, server read, server write, ...
+            values = [int(x) for x in line.split()[1:]]
+            nfs_read += values[4]
+            nfs_write += values[5]
+
+    return (cpu, cpu_stat.get('nr_throttled', 0), cpu_stat.get('nr_periods', 0), mem, mem_limit, cpu_limit,
+            nfs_read, nfs_write)
+
+def sample(pod):
+    try:
+        r = subprocess.run(
+            ['kubectl', 'exec', '-i', pod, '--', 'sh', '-c', probe_script],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            timeout=30,
+            check=False,
+        )
+    except subprocess.TimeoutExpired:
+        return None
+    if r.returncode != 0:
+        return None
+    return time.monotonic(), read_counters(r.stdout.decode(errors='replace'))
+
+def list_pods(task_ids):
+    output = subprocess.run(
+        [
+            'kubectl', 'get', 'pods',
+            '-l', 'womm_task in (%s)' % ','.join(task_ids),
+            '--field-selector', 'status.phase=Running',
+            '-o', 'jsonpath', '--template', '{range .items[*]}{.metadata.labels.womm_task} {.metadata.name}{"\\n"}{end}',
+        ],
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout.decode()
+    return [tuple(line.split()) for line in output.splitlines() if line.strip()]
+
+def usage(before, after):
+    # per-pod rates between two samples
+    t0, (cpu0, throttled0, periods0, _, _, _, read0, write0) = before
+    t1, (cpu1, throttled1, periods1, mem, mem_limit, cpu_limit, read1, write1) = after
+    elapsed = max(t1 - t0, 1e-6)
+    cores = (cpu1 - cpu0) / elapsed
+    throttled = (throttled1 - throttled0) / (periods1 - periods0) if periods1 > periods0 else 0.
+    if throttled > throttled_threshold or (mem_limit and mem > mem_threshold * mem_limit):
+        flag = 'UNDER'
+    elif cpu_limit and cores < over_threshold * cpu_limit and (not mem_limit or mem < over_threshold * mem_limit):
+        flag = 'OVER'
+    else:
+        flag = ''
+    return {
+        'cores': cores,
+        'cpu_limit': cpu_limit,
+        'throttled': throttled,
+        'mem': mem,
+        'mem_limit': mem_limit,
+        'read': (read1 - read0) / elapsed,
+        'write': (write1 - write0) / elapsed,
+        'flag': flag,
+    }
+
+def fmt_cpu(u):
+    if u['cpu_limit']:
+        return '%.2f/%.2f (%d%%)' % (u['cores'], u['cpu_limit'], 100 * u['cores'] / u['cpu_limit'])
+    return '%.2f' % u['cores']
+
+def fmt_mem(u):
+    if u['mem_limit']:
+        return '%s/%s (%d%%)' % (format_size(u['mem']), format_size(u['mem_limit']), 100 * u['mem'] / u['mem_limit'])
+    return format_size(u['mem'])
+
+def fmt_rate(n):
+    return format_size(int(n)) + '/s'
+
+def total(usages):
+    cpu_limits = [u['cpu_limit'] for u in usages]
+    mem_limits = [u['mem_limit'] for u in usages]
+    return {
+        'cores': sum(u['cores'] for u in usages),
+        'cpu_limit': sum(cpu_limits) if all(cpu_limits) else None,
+        'throttled': sum(u['throttled'] for u in usages) / len(usages),
+        'mem': sum(u['mem'] for u in usages),
+        'mem_limit': sum(mem_limits) if all(mem_limits) else None,
+        'read': sum(u['read'] for u in usages),
+        'write': sum(u['write'] for u in usages),
+        'flag': ' '.join(
+            '%d %s' % (n, flag) for flag in ('UNDER', 'OVER')
+            for n in [sum(1 for u in usages if u['flag'] == flag)] if n
+        ),
+    }
+
+def row(name, u):
+    return [name, fmt_cpu(u), '%d%%' % (100 * u['throttled']), fmt_mem(u), fmt_rate(u['read']), fmt_rate(u['write']),
+            u['flag']]
+
+def top_table(pods, usages, per_pod):
+    by_task = {}
+    for task_id, pod in pods:
+        if pod in usages:
+            by_task.setdefault(task_id, []).append((pod, usages[pod]))
+
+    output = []
+    for task_id, entries in sorted(by_task.items()):
+        if per_pod:
+            output.extend(row(pod, u) for pod, u in sorted(entries))
+        output.append(row(task_id + (' (total)' if per_pod else ''), total([u for _, u in entries])))
+    headers = ['POD' if per_pod else 'ID', 'CPU', 'THROTTLED', 'MEM', 'NFS READ', 'NFS WRITE', 'FLAG']
+    return tabulate(output, headers=headers, disable_numparse=True)
+
+def usage_top():
+    print("""\
+Usage: womm top [options] [id ..]
+
+Show the cpu, memory, throttling and NFS traffic of the pods of your tasks, as measured in the pods. With ids, show
+every pod of those tasks; otherwise show a total for each of your tasks.
+
+Pods flagged UNDER are being throttled or are close to their memory limit, and need bigger --kube-cpu/--kube-mem.
+Pods flagged OVER are using less than a quarter of both, and could make do with smaller ones.
+
+Options:
+  --interval N        Sample every N seconds (default 5)
+  --once              Take two samples, print one table and exit
+  -A                  Include everyone's tasks, not just the ones started from this machine
+  --help              Show this message :)
+""")
+    sys.exit(0)
+
+def cmd_top():
+    interval = 5.
+    once = False
+    all_hosts = False
+    task_ids = []
+    iterable = iter(sys.argv[2:])
+    for arg in iterable:
+        if arg.startswith('--interval='):
+            interval = duration_arg(arg.split('=', 1)[1], '--interval')
+        elif arg == '--interval':
+            interval = duration_arg(next_arg(iterable, '--interval'), '--interval')
+        elif arg == '--once':
+            once = True
+        elif arg == '-A':
+            all_hosts = True
+        elif arg.startswith('-'):
+            usage_top()
+        else:
+            task_ids.append(arg)
+
+    per_pod = bool(task_ids)
+    if not task_ids:
+        task_ids = [
+            task_id for task_id, data in get_status().items()
+            if data.target_instances and (all_hosts or data.host == hostname)
+        ]
+        if not task_ids:
+            print('No running tasks.')
+            return
+
+    samples = {}
+    previous = []
+    tries = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        if not once:
+            sys.stdout.write('\x1b[H\x1b[2J')
+        try:
+            while True:
+                start = time.monotonic()
+                pods = list_pods(task_ids)
+                if not pods:
+                    if previous:
+                        sys.stdout.write('\x1b[%d;1H' % (len(previous) + 1))
+                    print('No running pods for %s.' % ', '.join(task_ids))
+                    sys.exit(1)
+                tries += 1
+                new_samples = dict(zip((pod for _, pod in pods), pool.map(sample, (pod for _, pod in pods))))
+                usages = {
+                    pod: usage(samples[pod], s) for pod, s in new_samples.items()
+                    if s is not None and samples.get(pod) is not None
+                }
+                samples = new_samples
+                if once and (usages or tries > once_tries):
+                    # pending pods, pods without cgroup files to read, or pods we may not exec into
+                    missing = [pod for _, pod in pods if pod not in usages]
+                    if usages:
+                        print(top_table(pods, usages, per_pod))
+                    if missing:
+                        print('Could not sample %s.' % ', '.join(missing))
+                    sys.exit(0 if usages else 1)
+                if usages:
+                    previous = redraw(top_table(pods, usages, per_pod).splitlines(), previous)
+                time.sleep(max(0., interval - (time.monotonic() - start)))
+        except KeyboardInterrupt:
+            sys.stdout.write('\x1b[%d;1H' % (len(previous) + 1))